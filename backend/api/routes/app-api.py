@@ -12,11 +12,17 @@ import json
 from datetime import datetime
 import zipfile
 import tempfile
+import threading
+import asyncio
 
 # Import des services
 from services.extraction import StoryboardExtractor
 from services.comfyui import ComfyUIService
 from services.file_manager import FileManager
+from services import project_manager
+from services.scene_store import get_scene_store
+from generation.job_journal import get_job_journal
+from generation.cancellation import get_cancel_token, release_cancel_token
 
 app = FastAPI(title="Madsea API", description="API pour transformer des storyboards en séquences visuelles")
 
@@ -64,6 +70,18 @@ class GenerationRequest(BaseModel):
     controlnet_weight: float = 1.0
     guidance_scale: float = 7.5
     steps: int = 40
+    # Mode variantes: chaque scène donne plusieurs images (graines et/ou poids ControlNet)
+    variants: int = 1
+    seed: Optional[int] = None
+    variant_seeds: Optional[List[int]] = None
+    variant_strengths: Optional[List[float]] = None
+    project_id: Optional[str] = None  # Projet project_manager où historiser les groupes de variantes
+    # "draft": rendu rapide (peu d'étapes, même résolution) pour valider les plans; "final": qualité complète
+    mode: str = "final"
+    draft_job_id: Optional[str] = None  # Rendu final de plans validés: mêmes graines et conditionnement que ce brouillon
+
+class CancelRequest(BaseModel):
+    scene_id: Optional[str] = None  # Annule uniquement cette scène (sinon tout le job)
 
 class GenerationJob(BaseModel):
     job_id: str
@@ -78,6 +96,19 @@ class GenerationJob(BaseModel):
 # Gestionnaire d'états de génération
 generation_jobs = {}
 
+# Scènes indexées par id (SQLite WAL); les anciens fichiers data/scenes/*.json sont importés au démarrage
+scene_store = get_scene_store(os.path.join(os.getcwd(), "data", "scenes.db"),
+                              legacy_dir=os.path.join(os.getcwd(), "data", "scenes"))
+
+# Brouillons: seul le nombre d'étapes est plafonné. La taille de l'image latente est conservée:
+# le bruit initial en dépend, et seule la même graine à la même taille donne au rendu final
+# la composition du brouillon validé
+DRAFT_MAX_STEPS = 10
+
+# Journal des jobs sur disque: un redémarrage du serveur reprend les jobs interrompus
+JOBS_JOURNAL_FILE = os.path.join(os.getcwd(), "data", "generation_jobs.jsonl")
+jobs_journal = get_job_journal(JOBS_JOURNAL_FILE)
+
 # Fonctions utilitaires
 def load_projects():
     if os.path.exists(PROJECTS_FILE):
@@ -103,19 +134,34 @@ def find_episode(project, episode_id):
     return None
 
 def get_scenes_for_episode(episode_id):
-    scenes_file = os.path.join(os.getcwd(), "data", "scenes", f"{episode_id}.json")
-    if os.path.exists(scenes_file):
-        with open(scenes_file, 'r') as f:
-            return json.load(f)
-    return []
+    return scene_store.get_episode(episode_id)
 
 def save_scenes_for_episode(episode_id, scenes):
-    scenes_dir = os.path.join(os.getcwd(), "data", "scenes")
-    os.makedirs(scenes_dir, exist_ok=True)
-    
-    scenes_file = os.path.join(scenes_dir, f"{episode_id}.json")
-    with open(scenes_file, 'w') as f:
-        json.dump(scenes, f, indent=2)
+    scene_store.save_episode(episode_id, scenes)
+
+def record_variant_group(project_id, plan_base_id, style, prompt, group):
+    """Historise un groupe de variantes dans le plan, avec des noms de fichiers versionnés"""
+    succeeded = [variant for variant in group["variants"] if variant["status"] == "success"]
+    if not succeeded:
+        return
+    try:
+        filenames = project_manager.get_next_ai_filenames(project_id, plan_base_id, style, len(succeeded))
+        variants = []
+        for variant, filename in zip(succeeded, filenames):
+            # Renommer selon la nomenclature stricte du projet
+            versioned_path = os.path.join(os.path.dirname(variant["output_path"]), filename)
+            os.replace(variant["output_path"], versioned_path)
+            variant["output_path"] = versioned_path
+            variants.append({
+                "filename": filename,
+                "seed": variant["seed"],
+                "controlnet_weight": variant["controlnet_weight"]
+            })
+        project_manager.add_variant_group_to_history(project_id, plan_base_id, group["group_id"], prompt,
+                                                     style, variants)
+    except (FileNotFoundError, ValueError) as e:
+        # Scène hors projet: les images restent dans le dossier du job
+        group["history_error"] = str(e)
 
 # Routes API
 @app.get("/api/status")
@@ -421,26 +467,22 @@ async def generate_images(request: GenerationRequest, background_tasks: Backgrou
         raise HTTPException(status_code=503, detail="ComfyUI n'est pas disponible")
     
     # Collecter les informations des scènes
-    all_scenes = []
-    scene_ids_set = set(request.scene_ids)
-    
-    # Pour une implémentation complète, on devrait chercher dans tous les épisodes
-    # Ici on simplifie en parcourant les fichiers de scènes
-    scenes_dir = os.path.join(os.getcwd(), "data", "scenes")
-    if os.path.exists(scenes_dir):
-        for scene_file in os.listdir(scenes_dir):
-            if scene_file.endswith('.json'):
-                with open(os.path.join(scenes_dir, scene_file), 'r') as f:
-                    scenes = json.load(f)
-                    for scene in scenes:
-                        if scene["id"] in scene_ids_set:
-                            all_scenes.append(scene)
+    # Recherche par id dans l'index, quel que soit l'épisode
+    all_scenes = scene_store.get_scenes(request.scene_ids)
     
     if not all_scenes:
         raise HTTPException(status_code=404, detail="Aucune scène trouvée avec les IDs fournis")
     
-    # Créer un job de génération
-    job_id = f"gen_{int(time.time())}"
+    if request.mode not in ("draft", "final"):
+        raise HTTPException(status_code=400, detail="Mode invalide: 'draft' ou 'final'")
+    variant_mode = request.variants > 1 or request.variant_seeds or request.variant_strengths
+    if variant_mode and (request.mode == "draft" or request.draft_job_id):
+        raise HTTPException(status_code=400, detail="Les modes brouillon/final ne s'appliquent pas aux variantes")
+    if request.draft_job_id:
+        all_scenes, request = apply_draft(request, all_scenes)
+    
+    # Créer un job de génération (identifiant unique: clé du journal et du jeton d'annulation)
+    job_id = f"gen_{uuid.uuid4().hex}"
     
     generation_job = GenerationJob(
         job_id=job_id,
@@ -449,30 +491,107 @@ async def generate_images(request: GenerationRequest, background_tasks: Backgrou
     )
     
     generation_jobs[job_id] = generation_job.dict()
+    jobs_journal.start_job(job_id, "generate", {"request": request.dict(), "scenes": all_scenes})
+    get_cancel_token(job_id)  # Le job est annulable dès maintenant
     
-    # Fonction de génération en arrière-plan
-    def generate_images_task():
-        try:
-            job = generation_jobs[job_id]
-            job["status"] = "processing"
-            job["start_time"] = time.time()
-            
-            # Configurer le répertoire de sortie
-            output_dir = os.path.join(OUTPUT_DIR, "generated", job_id)
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Préparer la liste des scènes pour la génération par lot
-            scene_list = []
-            for scene in all_scenes:
-                # Si un prompt override est fourni, on l'utilise pour toutes les scènes
-                prompt = request.prompt_override if request.prompt_override else extractor.auto_generate_prompt(scene)
-                
-                scene_list.append({
-                    "id": scene["id"],
-                    "image_path": scene["image_path"],
-                    "prompt": prompt
-                })
+    # Lancer la génération en arrière-plan
+    background_tasks.add_task(run_generation_job, job_id, request, all_scenes)
+    
+    return generation_job
+
+def apply_draft(request: GenerationRequest, all_scenes: List[Dict[str, Any]]):
+    """
+    Prépare le rendu final de plans validés à partir de leur brouillon
+    
+    Chaque scène reprend la graine et le prompt de son image brouillon; le style, le poids
+    ControlNet et la guidance du brouillon remplacent ceux de la requête, afin que l'image
+    finale corresponde au brouillon validé.
+    
+    Returns:
+        (scènes complétées par draft_seed et draft_prompt, requête ajustée)
+    """
+    scenes = []
+    draft_parameters = None
+    for scene in all_scenes:
+        drafts = [image for image in scene.get("generated_images", [])
+                  if image.get("draft") and image.get("job_id") == request.draft_job_id]
+        if not drafts:
+            raise HTTPException(status_code=404,
+                                detail=f"La scène {scene['id']} n'a pas de brouillon dans le job {request.draft_job_id}")
+        draft = drafts[-1]
+        draft_parameters = draft_parameters or {**draft["parameters"], "style": draft["style"]}
+        scenes.append({**scene, "draft_seed": draft["parameters"]["seed"], "draft_prompt": draft.get("prompt")})
+    request = request.copy(update={
+        "mode": "final",
+        "style": draft_parameters["style"],
+        "controlnet_weight": draft_parameters["controlnet_weight"],
+        "guidance_scale": draft_parameters["guidance_scale"],
+    })
+    return scenes, request
+
+def run_generation_job(job_id: str, request: GenerationRequest, all_scenes: List[Dict[str, Any]]):
+    """Exécute un job de génération (en arrière-plan); les scènes déjà notées dans le journal sont reprises"""
+    try:
+        job = generation_jobs[job_id]
+        job["status"] = "processing"
+        job["start_time"] = job.get("start_time") or time.time()
+        cancel_token = get_cancel_token(job_id)
+        journaled = (jobs_journal.job_state(job_id) or {}).get("scenes", {})
+        
+        # Configurer le répertoire de sortie
+        output_dir = os.path.join(OUTPUT_DIR, "generated", job_id)
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # Préparer la liste des scènes pour la génération par lot
+        scene_list = []
+        for scene in all_scenes:
+            # Si un prompt override est fourni, on l'utilise pour toutes les scènes
+            prompt = request.prompt_override if request.prompt_override else extractor.auto_generate_prompt(scene)
             
+            scene_list.append({
+                "id": scene["id"],
+                "image_path": scene["image_path"],
+                # Rendu final d'un brouillon: même prompt et même graine
+                "prompt": scene.get("draft_prompt") or prompt,
+                "seed": scene.get("draft_seed")
+            })
+        prompts = {scene["id"]: scene["prompt"] for scene in scene_list}
+        draft = request.mode == "draft"
+        
+        variant_mode = request.variants > 1 or request.variant_seeds or request.variant_strengths
+        if variant_mode:
+            # Toutes les variantes d'une scène sont soumises à la suite (cache ComfyUI)
+            results = []
+            for index, scene in enumerate(scene_list):
+                entry = journaled.get(str(scene["id"]))
+                if entry and entry["status"] == "done":
+                    # Groupe terminé avant le redémarrage
+                    results.append(entry["result"])
+                    continue
+                if cancel_token.is_cancelled(str(scene["id"])):
+                    results.append({"status": "cancelled", "scene_id": scene["id"], "group_id": None, "variants": []})
+                    continue
+                group = comfyui_service.generate_variants(
+                    image_path=scene["image_path"],
+                    output_dir=output_dir,
+                    style=request.style,
+                    prompt=scene["prompt"],
+                    count=request.variants,
+                    seed=request.seed,
+                    seeds=request.variant_seeds,
+                    strengths=request.variant_strengths,
+                    controlnet_weight=request.controlnet_weight,
+                    guidance_scale=request.guidance_scale,
+                    steps=request.steps,
+                    scene_id=scene["id"],
+                    cancel_token=cancel_token
+                )
+                if request.project_id:
+                    record_variant_group(request.project_id, scene["id"], request.style, scene["prompt"], group)
+                results.append(group)
+                jobs_journal.scene_done(job_id, scene["id"], group)
+                job["progress"] = 100 * (index + 1) / len(scene_list)
+        else:
             # Lancer la génération par lot
             results = comfyui_service.batch_generate(
                 scene_list=scene_list,
@@ -480,61 +599,96 @@ async def generate_images(request: GenerationRequest, background_tasks: Backgrou
                 output_dir=output_dir,
                 controlnet_weight=request.controlnet_weight,
                 guidance_scale=request.guidance_scale,
-                steps=request.steps
+                steps=min(request.steps, DRAFT_MAX_STEPS) if draft else request.steps,
+                journal=jobs_journal,
+                job_id=job_id,
+                output_suffix="_draft" if draft else "",
+                cancel_token=cancel_token
             )
-            
-            # Mettre à jour le job avec les résultats
-            job["results"] = results
-            job["status"] = "completed"
-            job["progress"] = 100
-            job["end_time"] = time.time()
-            
-            # Mettre à jour les scènes avec les nouvelles images générées
-            for result in results:
-                if result["status"] == "success":
-                    scene_id = result["scene_id"]
-                    # Trouver l'épisode contenant cette scène
-                    for scene_file in os.listdir(scenes_dir):
-                        if scene_file.endswith('.json'):
-                            with open(os.path.join(scenes_dir, scene_file), 'r') as f:
-                                scenes = json.load(f)
-                                updated = False
-                                for i, scene in enumerate(scenes):
-                                    if scene["id"] == scene_id:
-                                        # Ajouter l'image générée à la scène
-                                        if "generated_images" not in scene:
-                                            scene["generated_images"] = []
-                                        
-                                        scene["generated_images"].append({
-                                            "path": result["output_path"],
-                                            "style": request.style,
-                                            "timestamp": time.time(),
-                                            "parameters": {
-                                                "controlnet_weight": request.controlnet_weight,
-                                                "guidance_scale": request.guidance_scale,
-                                                "steps": request.steps,
-                                                "seed": result.get("seed", -1)
-                                            }
-                                        })
-                                        
-                                        scenes[i] = scene
-                                        updated = True
-                                        break
-                                
-                                if updated:
-                                    with open(os.path.join(scenes_dir, scene_file), 'w') as f:
-                                        json.dump(scenes, f, indent=2)
         
-        except Exception as e:
-            job = generation_jobs.get(job_id, {})
-            job["status"] = "error"
-            job["message"] = str(e)
-            job["end_time"] = time.time()
-    
-    # Lancer la génération en arrière-plan
-    background_tasks.add_task(generate_images_task)
-    
-    return generation_job
+        # Mettre à jour le job avec les résultats
+        job["results"] = results
+        job["status"] = "cancelled" if cancel_token.cancelled else "completed"
+        job["progress"] = 100
+        job["end_time"] = time.time()
+        
+        # Mettre à jour les scènes avec les nouvelles images générées
+        new_images = {}
+        for result in results:
+            if "variants" in result:
+                generated = [{
+                    "path": variant["output_path"],
+                    "style": request.style,
+                    "timestamp": time.time(),
+                    "group_id": result["group_id"],
+                    "parameters": {
+                        "controlnet_weight": variant["controlnet_weight"],
+                        "guidance_scale": request.guidance_scale,
+                        "steps": request.steps,
+                        "seed": variant["seed"]
+                    }
+                } for variant in result["variants"] if variant["status"] == "success"]
+            else:
+                generated = [] if result["status"] != "success" else [{
+                    "path": result["output_path"],
+                    "style": request.style,
+                    "timestamp": time.time(),
+                    "job_id": job_id,
+                    "draft": draft,
+                    "prompt": prompts.get(result["scene_id"]),
+                    "parameters": {
+                        "controlnet_weight": request.controlnet_weight,
+                        "guidance_scale": request.guidance_scale,
+                        "steps": min(request.steps, DRAFT_MAX_STEPS) if draft else request.steps,
+                        "seed": result.get("seed", -1)
+                    }
+                }]
+            if generated:
+                new_images.setdefault(result["scene_id"], []).extend(generated)
+        
+        # Une seule transaction pour toutes les scènes du job (les doublons d'une reprise sont ignorés)
+        scene_store.add_generated_images(new_images)
+        
+        jobs_journal.end_job(job_id, job["status"])
+    
+    except Exception as e:
+        job = generation_jobs.get(job_id, {})
+        job["status"] = "error"
+        job["message"] = str(e)
+        job["end_time"] = time.time()
+        jobs_journal.end_job(job_id, "error", str(e))
+    finally:
+        release_cancel_token(job_id)
+
+@app.on_event("startup")
+def resume_generation_jobs():
+    """Reprend les jobs de génération interrompus par un arrêt du serveur"""
+    jobs_journal.compact()
+    for state in jobs_journal.unfinished_jobs(kind="generate"):
+        job_id = state["job_id"]
+        request = GenerationRequest(**state["params"]["request"])
+        job = GenerationJob(job_id=job_id, scene_ids=request.scene_ids, style=request.style,
+                            status="resuming", start_time=state.get("started"))
+        generation_jobs[job_id] = job.dict()
+        # Les prompts encore présents dans ComfyUI sont attendus, seules les scènes inachevées sont relancées
+        threading.Thread(target=run_generation_job, args=(job_id, request, state["params"]["scenes"]),
+                         name=f"resume-{job_id}", daemon=True).start()
+
+@app.post("/api/generations/{job_id}/cancel")
+async def cancel_generation(job_id: str, cancel: Optional[CancelRequest] = None):
+    """Annule un job de génération (ou une de ses scènes): les prompts en file sont retirés de ComfyUI
+    et celui en cours est interrompu s'il appartient au job"""
+    if job_id not in generation_jobs:
+        raise HTTPException(status_code=404, detail="Job de génération non trouvé")
+    token = get_cancel_token(job_id, create=False)
+    if token is None:
+        raise HTTPException(status_code=409, detail=f"Job déjà terminé ({generation_jobs[job_id]['status']})")
+    scene_id = cancel.scene_id if cancel else None
+    # Appels HTTP bloquants vers ComfyUI: hors de la boucle d'événements
+    summary = await asyncio.get_running_loop().run_in_executor(None, token.cancel, scene_id)
+    if scene_id is None:
+        generation_jobs[job_id]["status"] = "cancelling"
+    return {"job_id": job_id, "scene_id": scene_id, **summary}
 
 @app.get("/api/generations/{job_id}")
 async def get_generation_status(job_id: str):
@@ -584,10 +738,10 @@ async def get_available_styles():
     }
 
 # Montage des fichiers statiques
-@app.mount("/files", StaticFiles(directory=OUTPUT_DIR), name="files")
+app.mount("/files", StaticFiles(directory=OUTPUT_DIR), name="files")
 
 # Pour le développement, monter le frontend
-@app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
+app.mount("/", StaticFiles(directory="frontend", html=True), name="frontend")
 
 if __name__ == "__main__":
     import uvicorn
@@ -2,11 +2,21 @@ import requests
 import json
 import uuid
 import os
+import sys
 import shutil
 from urllib.parse import urlparse
 
-COMFYUI_API_URL = "http://127.0.0.1:8188/prompt"
-COMFYUI_UPLOAD_URL = "http://127.0.0.1:8188/upload/image"
+# Racine du dépôt, pour partager le gestionnaire d'uploads avec le module generation
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if root_dir not in sys.path:
+    sys.path.append(root_dir)
+
+from generation.comfyui_uploads import get_upload_manager
+
+COMFYUI_BASE_URL = "http://127.0.0.1:8188"
+COMFYUI_API_URL = f"{COMFYUI_BASE_URL}/prompt"
+COMFYUI_UPLOAD_URL = f"{COMFYUI_BASE_URL}/upload/image"
+COMFYUI_UPLOAD_STATE_DIR = os.path.join(root_dir, 'cache')
 
 # Chemin vers le template de workflow ComfyUI
 # S'assurer que ce chemin est correct par rapport à l'emplacement de comfyui_bridge.py
@@ -85,21 +95,24 @@ def rename_ai_concept_placeholder(original_placeholder_path, new_sequence_number
         return plan_data['ai_concept_placeholder_path'], plan_data['ai_concept_filename']
 
 def upload_image_to_comfyui(image_path):
-    """Télécharge une image vers le serveur ComfyUI."""
+    """
+    Envoie une image dans le dossier input de ComfyUI.
+
+    L'image est nommée d'après le hash de son contenu et n'est envoyée que si
+    ComfyUI ne l'a pas déjà : régénérer un plan ne ré-uploade pas sa référence.
+    Le fichier est lu en streaming et toujours refermé.
+    """
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image source non trouvée: {image_path}")
-    
-    files = {'image': (os.path.basename(image_path), open(image_path, 'rb'), 'image/png')}
-    data = {'overwrite': "true"} # Permet de remplacer si le fichier existe déjà avec le même nom
+
+    manager = get_upload_manager(COMFYUI_BASE_URL, COMFYUI_UPLOAD_STATE_DIR)
     try:
-        response = requests.post(COMFYUI_UPLOAD_URL, files=files, data=data)
-        response.raise_for_status()
-        return response.json() # Devrait contenir le nom du fichier sur ComfyUI, son sous-dossier, etc.
-    except requests.exceptions.RequestException as e:
+        name = manager.ensure_uploaded(image_path)
+    except Exception as e:
         print(f"Erreur d'upload vers ComfyUI: {e}")
-        if e.response is not None:
-            print(f"Réponse de ComfyUI: {e.response.text}")
         raise
+    # Même forme que la réponse de /upload/image
+    return {'name': name, 'subfolder': '', 'type': 'input'}
 
 def trigger_comfyui_workflow(workflow_payload):
     """Déclenche un workflow sur ComfyUI avec le payload donné."""
@@ -1,13 +1,24 @@
 import os
 import sys
 import json
+import random
 import requests
-import base64
 from PIL import Image
 import io
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Tuple, Union, Any
 
+# Racine du dépôt, pour partager le gestionnaire d'uploads avec le module generation
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if root_dir not in sys.path:
+    sys.path.append(root_dir)
+
+from generation.comfyui_uploads import get_upload_manager
+from generation.affinity import model_signature, order_by_affinity
+from generation.cancellation import GenerationCancelled
+from generation.workflow_validator import get_workflow_validator
+
 class ComfyUIService:
     """
     Service d'intégration avec ComfyUI pour Madsea
@@ -24,6 +35,12 @@ class ComfyUIService:
         self.comfyui_url = comfyui_url
         self.client_id = self._get_client_id()
         self.workflows_dir = os.path.join(os.path.dirname(__file__), "workflows")
+        # Les images sources sont envoyées une seule fois par contenu, puis référencées par nom
+        self.upload_manager = get_upload_manager(comfyui_url, os.path.join(root_dir, "cache"))
+        # Les workflows sont vérifiés contre le schéma /object_info (mis en cache) avant la mise en file
+        self.validator = get_workflow_validator(comfyui_url)
+        # Workflows chargés: style -> (mtime, workflow). Ne jamais modifier ces objets.
+        self._workflow_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
         
         # Styles disponibles et fichiers de workflow associés
         self.available_styles = {
@@ -64,72 +81,554 @@ class ComfyUIService:
             raise ValueError(f"Style {style} non disponible. Styles valides: {list(self.available_styles.keys())}")
         
         workflow_path = os.path.join(self.workflows_dir, self.available_styles[style])
+        mtime = os.path.getmtime(workflow_path)
+        cached = self._workflow_cache.get(style)
+        if cached and cached[0] == mtime:
+            return cached[1]
         
         with open(workflow_path, 'r') as f:
             workflow_data = json.load(f)
         
+        self._workflow_cache[style] = (mtime, workflow_data)
         return workflow_data
     
-    def _encode_image_to_base64(self, image_path: str) -> str:
+
+    @staticmethod
+    def _copy_workflow(workflow: Dict[str, Any]) -> Dict[str, Any]:
         """
-        Encode une image en base64 pour ComfyUI
+        Copie un workflow pour pouvoir modifier ses entrées sans toucher au template
         
-        Args:
-            image_path: Chemin vers le fichier image
-            
-        Returns:
-            Image encodée en base64
+        Seuls les nœuds et leurs dictionnaires d'entrées sont copiés: les liens et
+        valeurs littérales restent partagés et ne doivent pas être modifiés en place.
+        Beaucoup moins coûteux qu'un copy.deepcopy du workflow complet.
         """
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-        return encoded_string
+        if "nodes" in workflow:
+            nodes = workflow["nodes"]
+            if isinstance(nodes, dict):
+                copied_nodes = {node_id: {**node, "inputs": dict(node.get("inputs", {}))}
+                                for node_id, node in nodes.items()}
+            else:
+                copied_nodes = [{**node, "inputs": dict(node.get("inputs", {}))} for node in nodes]
+            return {**workflow, "nodes": copied_nodes}
+        return {node_id: {**node, "inputs": dict(node.get("inputs", {}))} for node_id, node in workflow.items()}
+    
+    @staticmethod
+    def _iter_nodes(workflow: Dict[str, Any]):
+        """
+        Parcourt les nœuds d'un workflow, au format "nodes" ou au format API
+        
+        Yields:
+            Tuples (node_id, type de nœud, titre en minuscules, nœud)
+        """
+        nodes = workflow.get("nodes", workflow)
+        items = nodes.items() if isinstance(nodes, dict) else ((str(node.get("id")), node) for node in nodes)
+        for node_id, node in items:
+            if not isinstance(node, dict):
+                continue
+            node_type = node.get("type") or node.get("class_type")
+            title = node.get("title") or node.get("_meta", {}).get("title", "")
+            yield node_id, node_type, title.lower(), node
+    
+    def _to_api_format(self, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """Convertit un workflow au format attendu par /prompt (id -> class_type, inputs)"""
+        if "nodes" not in workflow:
+            return workflow
+        return {node_id: {"class_type": node_type, "inputs": node.get("inputs", {})}
+                for node_id, node_type, _, node in self._iter_nodes(workflow)}
     
     def _prepare_input_nodes(self, workflow: Dict[str, Any], 
-                            image_path: str, 
+                            image_name: str, 
                             prompt: str,
                             negative_prompt: str = "",
-                            controlnet_weight: float = 1.0) -> Dict[str, Any]:
+                            controlnet_weight: float = 1.0,
+                            guidance_scale: Optional[float] = None,
+                            steps: Optional[int] = None,
+                            seed: Optional[int] = None) -> Dict[str, Any]:
         """
         Prépare les nœuds d'entrée du workflow avec les paramètres spécifiques
         
         Args:
-            workflow: Workflow ComfyUI
-            image_path: Chemin de l'image source
+            workflow: Workflow ComfyUI (template, non modifié)
+            image_name: Nom de l'image source dans le dossier input de ComfyUI
             prompt: Prompt de génération
             negative_prompt: Prompt négatif
             controlnet_weight: Poids du ControlNet
+            guidance_scale: Échelle de guidance (cfg) du sampler
+            steps: Nombre d'étapes du sampler
+            seed: Graine du sampler
             
         Returns:
             Workflow modifié avec les entrées mises à jour
         """
-        # Copier le workflow pour éviter de modifier l'original
-        workflow_modified = workflow.copy()
-        
-        # Encoder l'image en base64
-        image_b64 = self._encode_image_to_base64(image_path)
+        # Copier le workflow pour éviter de modifier l'original (mis en cache par load_workflow)
+        workflow_modified = self._copy_workflow(workflow)
         
         # Mettre à jour les nœuds (à adapter selon la structure du workflow)
-        for node_id, node in workflow_modified["nodes"].items():
-            # Mise à jour du nœud d'image source (Load Image)
-            if node["type"] == "LoadImage":
-                node["inputs"]["image"] = image_b64
+        for node_id, node_type, title, node in self._iter_nodes(workflow_modified):
+            inputs = node["inputs"]
+            # Mise à jour du nœud d'image source (Load Image): référence par nom, pas de base64
+            if node_type == "LoadImage":
+                inputs["image"] = image_name
             
             # Mise à jour du nœud de prompt texte (CLIPTextEncode)
-            elif node["type"] == "CLIPTextEncode" and "positive" in node["title"].lower():
-                node["inputs"]["text"] = prompt
+            elif node_type == "CLIPTextEncode" and "positive" in title:
+                inputs["text"] = prompt
                 
             # Mise à jour du nœud de prompt négatif
-            elif node["type"] == "CLIPTextEncode" and "negative" in node["title"].lower():
-                node["inputs"]["text"] = negative_prompt
+            elif node_type == "CLIPTextEncode" and "negative" in title:
+                inputs["text"] = negative_prompt
             
             # Mise à jour du poids ControlNet
-            elif node["type"] == "ControlNetApply":
-                node["inputs"]["strength"] = controlnet_weight
+            elif node_type in ("ControlNetApply", "ControlNetApplyAdvanced"):
+                inputs["strength"] = controlnet_weight
+            
+            # Paramètres du sampler
+            elif node_type in ("KSampler", "KSamplerAdvanced"):
+                if guidance_scale is not None:
+                    inputs["cfg"] = guidance_scale
+                if steps is not None:
+                    inputs["steps"] = steps
+                if seed is not None:
+                    inputs["noise_seed" if "noise_seed" in inputs else "seed"] = seed
         
         return workflow_modified
     
+    def upload_image(self, image_path: str) -> str:
+        """
+        Envoie une image source à ComfyUI (sauf si elle y est déjà)
+        
+        Args:
+            image_path: Chemin de l'image source
+            
+        Returns:
+            Nom de l'image dans le dossier input de ComfyUI
+        """
+        return self.upload_manager.ensure_uploaded(image_path)
+    
+    def queue_prompt(self, workflow: Dict[str, Any]) -> str:
+        """
+        Soumet un workflow à la file d'attente de ComfyUI
+        
+        Args:
+            workflow: Workflow préparé
+            
+        Returns:
+            Identifiant du prompt (prompt_id)
+        """
+        prompt = self._to_api_format(workflow)
+        if self.validator is not None:
+            # Lève WorkflowValidationError (nœud inconnu, entrée manquante, modèle absent) sans solliciter le GPU
+            self.validator.check(prompt)
+        payload = {"prompt": prompt, "client_id": self.client_id}
+        for attempt in range(2):
+            response = requests.post(f"{self.comfyui_url}/prompt", json=payload, timeout=30)
+            data, error = {}, None
+            if not response.ok:
+                error = response.text
+            else:
+                data = response.json()
+                if data.get("node_errors"):
+                    error = json.dumps(data["node_errors"])
+            # Dossier input de ComfyUI vidé entre-temps: l'image est ré-uploadée sous le même nom, puis le prompt resoumis
+            if error is None or attempt or not self.upload_manager.recover_missing(error):
+                break
+        response.raise_for_status()
+        if data.get("node_errors"):
+            raise ValueError(f"Workflow refusé par ComfyUI: {data['node_errors']}")
+        return data["prompt_id"]
+    
+    def prompt_state(self, prompt_id: str) -> str:
+        """
+        Indique où en est un prompt déjà soumis, pour s'y rattacher après un redémarrage
+        
+        Args:
+            prompt_id: Identifiant du prompt
+            
+        Returns:
+            "finished" (présent dans /history), "queued" (en attente ou en cours) ou "unknown"
+            (ComfyUI a redémarré entre-temps: le prompt doit être soumis à nouveau)
+        """
+        try:
+            response = requests.get(f"{self.comfyui_url}/history/{prompt_id}", timeout=10)
+            response.raise_for_status()
+            if response.json().get(prompt_id):
+                return "finished"
+            response = requests.get(f"{self.comfyui_url}/queue", timeout=10)
+            response.raise_for_status()
+            queue = response.json()
+            for item in queue.get("queue_running", []) + queue.get("queue_pending", []):
+                if len(item) > 1 and item[1] == prompt_id:
+                    return "queued"
+        except requests.RequestException:
+            pass
+        return "unknown"
+    
+    def _wait_for_output(self, prompt_id: str, timeout: float = 600, poll_interval: float = 1.0,
+                         is_cancelled: Optional[Any] = None) -> Dict[str, Any]:
+        """
+        Attend la fin d'un prompt et retourne la description de sa première image
+        
+        Args:
+            prompt_id: Identifiant du prompt
+            timeout: Délai maximum en secondes
+            poll_interval: Intervalle entre deux interrogations de /history
+            is_cancelled: Fonction sans argument, vraie si l'attente doit cesser (annulation)
+            
+        Returns:
+            Description de l'image (filename, subfolder, type)
+        
+        Raises:
+            GenerationCancelled: Si is_cancelled devient vraie pendant l'attente
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if is_cancelled and is_cancelled():
+                raise GenerationCancelled(f"Prompt {prompt_id} annulé")
+            response = requests.get(f"{self.comfyui_url}/history/{prompt_id}", timeout=10)
+            response.raise_for_status()
+            history = response.json().get(prompt_id)
+            if history:
+                status = history.get("status", {})
+                if status.get("status_str") == "error":
+                    raise RuntimeError(f"ComfyUI a signalé une erreur pour le prompt {prompt_id}")
+                for node_output in history.get("outputs", {}).values():
+                    if node_output.get("images"):
+                        return node_output["images"][0]
+                if status.get("completed"):
+                    raise RuntimeError(f"Le prompt {prompt_id} s'est terminé sans image")
+            time.sleep(poll_interval)
+        raise TimeoutError(f"Pas de résultat pour le prompt {prompt_id} après {timeout}s")
+    
+    def _download_image(self, image_info: Dict[str, Any], output_path: str) -> str:
+        """Télécharge une image générée depuis /view vers output_path"""
+        params = {
+            "filename": image_info["filename"],
+            "subfolder": image_info.get("subfolder", ""),
+            "type": image_info.get("type", "output"),
+        }
+        with requests.get(f"{self.comfyui_url}/view", params=params, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            tmp_path = f"{output_path}.part"
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=256 * 1024):
+                    f.write(chunk)
+        os.replace(tmp_path, output_path)
+        return output_path
+    
+    def _output_path(self, output_dir: str, image_path: str, style: str, seed: int, scene_id: Any = None,
+                     suffix: str = "") -> str:
+        base_name = str(scene_id) if scene_id is not None else os.path.splitext(os.path.basename(image_path))[0]
+        return os.path.join(output_dir, f"{base_name}_{style}_{seed}{suffix}.png")
+    
     def generate_image(self, 
                       image_path: str, 
                       output_dir: str,
                       style: str = "laboratoire",
-                      prompt
\ No newline at end of file
+                      prompt: str = "",
+                      negative_prompt: str = "",
+                      controlnet_weight: float = 1.0,
+                      guidance_scale: float = 7.5,
+                      steps: int = 30,
+                      seed: Optional[int] = None,
+                      scene_id: Any = None) -> Dict[str, Any]:
+        """
+        Génère une image stylisée à partir d'une image de storyboard
+        
+        Args:
+            image_path: Chemin de l'image source
+            output_dir: Répertoire de sortie
+            style: Nom du style
+            prompt: Prompt de génération
+            negative_prompt: Prompt négatif
+            controlnet_weight: Poids du ControlNet
+            guidance_scale: Échelle de guidance (cfg)
+            steps: Nombre d'étapes
+            seed: Graine (aléatoire si None)
+            scene_id: Identifiant de la scène, utilisé pour nommer le fichier
+            
+        Returns:
+            Résultat: status, output_path, seed, prompt_id (ou message en cas d'erreur)
+        """
+        seed = seed if seed is not None else random.randint(0, 2**32 - 1)
+        try:
+            workflow = self.load_workflow(style)
+            image_name = self.upload_image(image_path)
+            prepared = self._prepare_input_nodes(workflow, image_name, prompt, negative_prompt,
+                                                 controlnet_weight, guidance_scale, steps, seed)
+            prompt_id = self.queue_prompt(prepared)
+            return self._collect_result(prompt_id, image_path, output_dir, style, seed, scene_id)
+        except Exception as e:
+            return {"status": "error", "scene_id": scene_id, "message": str(e), "seed": seed}
+    
+    def _collect_result(self, prompt_id: str, image_path: str, output_dir: str, style: str,
+                        seed: int, scene_id: Any = None, suffix: str = "",
+                        is_cancelled: Optional[Any] = None) -> Dict[str, Any]:
+        """Attend le résultat d'un prompt soumis et l'enregistre dans output_dir"""
+        os.makedirs(output_dir, exist_ok=True)
+        image_info = self._wait_for_output(prompt_id, is_cancelled=is_cancelled)
+        output_path = self._download_image(image_info, self._output_path(output_dir, image_path, style, seed,
+                                                                         scene_id, suffix))
+        return {
+            "status": "success",
+            "scene_id": scene_id,
+            "output_path": output_path,
+            "seed": seed,
+            "prompt_id": prompt_id,
+        }
+    
+    def batch_generate(self,
+                       scene_list: List[Dict[str, Any]],
+                       style: str,
+                       output_dir: str,
+                       controlnet_weight: float = 1.0,
+                       guidance_scale: float = 7.5,
+                       steps: int = 30,
+                       negative_prompt: str = "",
+                       upload_workers: int = 4,
+                       affinity_window: int = 8,
+                       journal: Any = None,
+                       job_id: Optional[str] = None,
+                       output_suffix: str = "",
+                       cancel_token: Any = None) -> List[Dict[str, Any]]:
+        """
+        Génère les images d'une liste de scènes
+        
+        Les uploads des images sources partent tous en parallèle dès le début; chaque
+        prompt est soumis dès que l'upload de sa scène est terminé, sans attendre les
+        générations précédentes. ComfyUI a ainsi toujours du travail en file d'attente.
+        
+        Les scènes qui utilisent les mêmes modèles (checkpoint, LoRA, ControlNet) sont
+        soumises à la suite pour limiter les changements de modèles dans ComfyUI; une
+        scène n'est jamais repoussée de plus de affinity_window places.
+        
+        Args:
+            scene_list: Scènes (id, image_path, prompt, et optionnellement seed et style)
+            style: Nom du style par défaut
+            output_dir: Répertoire de sortie
+            controlnet_weight: Poids du ControlNet
+            guidance_scale: Échelle de guidance (cfg)
+            steps: Nombre d'étapes
+            negative_prompt: Prompt négatif commun
+            upload_workers: Nombre d'uploads simultanés
+            affinity_window: Fenêtre d'équité du regroupement par modèles (0 = ordre d'origine)
+            journal: Journal des jobs (generation.job_journal.JobJournal) où sont notés les
+                prompt_id et les résultats. Si le job y figure déjà (reprise après un redémarrage),
+                les scènes réussies sont reprises telles quelles et les prompts encore connus de
+                ComfyUI sont attendus au lieu d'être soumis à nouveau.
+            job_id: Identifiant du job dans le journal
+            output_suffix: Suffixe des fichiers générés (ex. "_draft")
+            cancel_token: Jeton d'annulation du job (generation.cancellation.CancelToken). Les scènes
+                annulées ne sont plus soumises et leurs prompts sont retirés de ComfyUI; leur résultat
+                a le statut "cancelled".
+            
+        Returns:
+            Un résultat par scène, dans l'ordre de scene_list
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(scene_list)
+        submitted = []  # (index, prompt_id, seed)
+        scene_styles = [scene.get("style") or style for scene in scene_list]
+        signatures = {}
+        for scene_style in set(scene_styles):
+            try:
+                signatures[scene_style] = model_signature(self._to_api_format(self.load_workflow(scene_style)))
+            except Exception:
+                signatures[scene_style] = None  # L'erreur sera signalée pour chaque scène concernée
+        order = order_by_affinity(list(range(len(scene_list))), lambda index: signatures[scene_styles[index]],
+                                  affinity_window)
+        
+        keys = [str(scene.get("id", index)) for index, scene in enumerate(scene_list)]
+        
+        # Reprise: scènes déjà générées et prompts encore présents dans ComfyUI
+        journaled = {}
+        if journal is not None and job_id:
+            journaled = (journal.job_state(job_id) or {}).get("scenes", {})
+        to_submit = []
+        for index in order:
+            entry = journaled.get(keys[index])
+            if entry is None:
+                to_submit.append(index)
+                continue
+            result = entry.get("result") or {}
+            if entry["status"] == "done" and result.get("status") == "success" \
+                    and os.path.exists(result.get("output_path", "")):
+                results[index] = result
+            elif entry["status"] == "submitted" and entry.get("prompt_id") \
+                    and self.prompt_state(entry["prompt_id"]) != "unknown":
+                submitted.append((index, entry["prompt_id"], entry["details"].get("seed")))
+            else:
+                to_submit.append(index)
+        
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            upload_futures = {index: executor.submit(self.upload_image, scene_list[index]["image_path"])
+                              for index in to_submit}
+            
+            for index in to_submit:
+                scene = scene_list[index]
+                seed = scene.get("seed")
+                seed = seed if seed is not None else random.randint(0, 2**32 - 1)
+                if cancel_token is not None and cancel_token.is_cancelled(keys[index]):
+                    results[index] = {"status": "cancelled", "scene_id": scene.get("id"), "seed": seed}
+                    continue
+                try:
+                    workflow = self.load_workflow(scene_styles[index])
+                    image_name = upload_futures[index].result()
+                    prepared = self._prepare_input_nodes(workflow, image_name, scene.get("prompt", ""),
+                                                         negative_prompt, controlnet_weight,
+                                                         guidance_scale, steps, seed)
+                    prompt_id = self.queue_prompt(prepared)
+                    submitted.append((index, prompt_id, seed))
+                    if cancel_token is not None:
+                        cancel_token.track(prompt_id, self.comfyui_url, keys[index])
+                    if journal is not None and job_id:
+                        journal.scene_submitted(job_id, keys[index], prompt_id, seed=seed, style=scene_styles[index])
+                except Exception as e:
+                    results[index] = {"status": "error", "scene_id": scene.get("id"), "message": str(e), "seed": seed}
+        
+        for index, prompt_id, seed in submitted:
+            scene = scene_list[index]
+            is_cancelled = (lambda key=keys[index]: cancel_token.is_cancelled(key)) if cancel_token is not None else None
+            try:
+                results[index] = self._collect_result(prompt_id, scene["image_path"], output_dir,
+                                                      scene_styles[index], seed, scene.get("id"), output_suffix,
+                                                      is_cancelled)
+            except GenerationCancelled:
+                results[index] = {"status": "cancelled", "scene_id": scene.get("id"), "seed": seed,
+                                  "prompt_id": prompt_id}
+            except Exception as e:
+                results[index] = {"status": "error", "scene_id": scene.get("id"), "message": str(e), "seed": seed}
+            if cancel_token is not None:
+                cancel_token.untrack(prompt_id)
+            if journal is not None and job_id:
+                journal.scene_done(job_id, keys[index], results[index])
+        
+        return results
+    
+    @staticmethod
+    def plan_variants(count: int = 4,
+                      seed: Optional[int] = None,
+                      seeds: Optional[List[int]] = None,
+                      strengths: Optional[List[float]] = None,
+                      controlnet_weight: float = 1.0) -> List[Dict[str, Any]]:
+        """
+        Calcule l'ordre de soumission des variantes d'un plan
+        
+        ComfyUI ne réexécute que les nœuds dont les entrées ont changé depuis le prompt
+        précédent. Les variantes sont donc groupées par poids ControlNet (boucle externe)
+        et ne diffèrent que par la graine à l'intérieur d'un groupe: entre deux prompts
+        consécutifs, seuls le sampler et le décodage sont recalculés; le chargement de
+        l'image, l'encodage des prompts et le ControlNet restent en cache.
+        
+        Args:
+            count: Nombre de graines si seeds n'est pas fourni
+            seed: Première graine (aléatoire si None); les suivantes sont consécutives
+            seeds: Graines explicites
+            strengths: Poids ControlNet à balayer (controlnet_weight seul si None)
+            controlnet_weight: Poids ControlNet utilisé sans balayage
+            
+        Returns:
+            Variantes ordonnées: index, seed, controlnet_weight
+        """
+        if not seeds:
+            first_seed = seed if seed is not None else random.randint(0, 2**32 - 1 - max(count, 1))
+            seeds = [first_seed + i for i in range(max(count, 1))]
+        strengths = list(strengths) if strengths else [controlnet_weight]
+        ordered = [(strength, variant_seed) for strength in strengths for variant_seed in seeds]
+        return [{"index": index, "seed": variant_seed, "controlnet_weight": strength}
+                for index, (strength, variant_seed) in enumerate(ordered)]
+    
+    def generate_variants(self,
+                          image_path: str,
+                          output_dir: str,
+                          style: str = "laboratoire",
+                          prompt: str = "",
+                          negative_prompt: str = "",
+                          count: int = 4,
+                          seed: Optional[int] = None,
+                          seeds: Optional[List[int]] = None,
+                          strengths: Optional[List[float]] = None,
+                          controlnet_weight: float = 1.0,
+                          guidance_scale: float = 7.5,
+                          steps: int = 30,
+                          scene_id: Any = None,
+                          cancel_token: Any = None) -> Dict[str, Any]:
+        """
+        Génère plusieurs variantes d'un même plan (balayage de graines et/ou de poids ControlNet)
+        
+        L'image source est envoyée une fois, puis toutes les variantes sont soumises à la
+        suite, dans l'ordre de plan_variants, avant d'attendre le premier résultat: aucun
+        autre plan ne s'intercale et ComfyUI réutilise ses sorties en cache d'un prompt
+        à l'autre.
+        
+        Args:
+            image_path: Chemin de l'image source
+            output_dir: Répertoire de sortie
+            style: Nom du style
+            prompt: Prompt de génération (identique pour toutes les variantes)
+            negative_prompt: Prompt négatif
+            count: Nombre de graines si seeds n'est pas fourni
+            seed: Première graine (aléatoire si None)
+            seeds: Graines explicites
+            strengths: Poids ControlNet à balayer
+            controlnet_weight: Poids ControlNet sans balayage
+            guidance_scale: Échelle de guidance (cfg)
+            steps: Nombre d'étapes
+            scene_id: Identifiant de la scène
+            cancel_token: Jeton d'annulation du job (les variantes annulées ont le statut "cancelled")
+            
+        Returns:
+            Groupe de variantes: status, scene_id, group_id, variants (un résultat par variante)
+        """
+        variants = self.plan_variants(count, seed, seeds, strengths, controlnet_weight)
+        group_id = f"var_{int(time.time() * 1000)}"
+        sweep_strengths = len({variant["controlnet_weight"] for variant in variants}) > 1
+        results: List[Optional[Dict[str, Any]]] = [None] * len(variants)
+        submitted = []  # (index, prompt_id)
+        
+        try:
+            workflow = self.load_workflow(style)
+            image_name = self.upload_image(image_path)
+        except Exception as e:
+            return {"status": "error", "scene_id": scene_id, "group_id": group_id, "message": str(e),
+                    "variants": []}
+        
+        cancel_key = str(scene_id)
+        is_cancelled = (lambda: cancel_token.is_cancelled(cancel_key)) if cancel_token is not None else None
+        for variant in variants:
+            if is_cancelled and is_cancelled():
+                results[variant["index"]] = {"status": "cancelled"}
+                continue
+            try:
+                prepared = self._prepare_input_nodes(workflow, image_name, prompt, negative_prompt,
+                                                     variant["controlnet_weight"], guidance_scale, steps,
+                                                     variant["seed"])
+                prompt_id = self.queue_prompt(prepared)
+                submitted.append((variant["index"], prompt_id))
+                if cancel_token is not None:
+                    cancel_token.track(prompt_id, self.comfyui_url, cancel_key)
+            except Exception as e:
+                results[variant["index"]] = {"status": "error", "message": str(e)}
+        
+        for index, prompt_id in submitted:
+            variant = variants[index]
+            suffix = f"_cn{variant['controlnet_weight']:.2f}" if sweep_strengths else ""
+            try:
+                results[index] = self._collect_result(prompt_id, image_path, output_dir, style,
+                                                      variant["seed"], scene_id, suffix, is_cancelled)
+            except GenerationCancelled:
+                results[index] = {"status": "cancelled"}
+            except Exception as e:
+                results[index] = {"status": "error", "message": str(e)}
+            if cancel_token is not None:
+                cancel_token.untrack(prompt_id)
+        
+        for variant, result in zip(variants, results):
+            result.update(scene_id=scene_id, seed=variant["seed"], controlnet_weight=variant["controlnet_weight"],
+                          variant_index=variant["index"])
+        
+        succeeded = sum(1 for result in results if result["status"] == "success")
+        return {
+            "status": "success" if succeeded == len(results) else ("partial" if succeeded else "error"),
+            "scene_id": scene_id,
+            "group_id": group_id,
+            "variants": results,
+        }
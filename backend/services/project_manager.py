@@ -10,7 +10,7 @@ Tout est pensé pour être simple, pédagogique et robuste.
 import os
 import json
 import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 # Chemin où sont stockés les fichiers project_data.json
 PROJECTS_BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'projects'))
@@ -111,11 +111,27 @@ def get_next_ai_filename(project_id: str, plan_base_id: str, task: str, ext: str
     count = 0
     for hist in plan['history']:
         if hist['task'] == task:
-            count += 1
+            # Un groupe de variantes compte pour autant de versions que de variantes
+            count += len(hist['variants']) if 'variants' in hist else 1
     version = count + 1
     filename = f"{nomenclature_base}_{task}_v{version:04d}.{ext}"
     return filename
 
+# 7b. Noms de fichiers IA pour un groupe de variantes (versions consécutives)
+def get_next_ai_filenames(project_id: str, plan_base_id: str, task: str, count: int, ext: str = "png") -> List[str]:
+    """
+    Comme get_next_ai_filename, pour count variantes enregistrées ensemble.
+    Ex : -> ["E202_SQ0010-0001_AI-concept_v0003.png", "E202_SQ0010-0001_AI-concept_v0004.png"]
+    """
+    data = load_project_data(project_id)
+    plan = next((p for p in data['plans'] if p['plan_base_id'] == plan_base_id), None)
+    if not plan:
+        raise ValueError(f"Plan '{plan_base_id}' non trouvé dans le projet '{project_id}'.")
+    nomenclature_base = plan['current_nomenclature_base']
+    done = sum(len(hist['variants']) if 'variants' in hist else 1
+               for hist in plan['history'] if hist['task'] == task)
+    return [f"{nomenclature_base}_{task}_v{done + i + 1:04d}.{ext}" for i in range(count)]
+
 # 8. Ajouter une génération IA à l'historique du plan
 def add_ai_generation_to_history(project_id: str, plan_base_id: str, generated_filename: str, prompt_used: str, task: str):
     data = load_project_data(project_id)
@@ -131,6 +147,45 @@ def add_ai_generation_to_history(project_id: str, plan_base_id: str, generated_f
     plan['history'].append(entry)
     save_project_data(project_id, data)
 
+# 9. Ajouter un groupe de variantes (balayage de graines / poids ControlNet) à l'historique du plan
+def add_variant_group_to_history(project_id: str, plan_base_id: str, group_id: str, prompt_used: str, task: str,
+                                 variants: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Enregistre les variantes d'une même demande comme une seule entrée d'historique.
+    - variants : une entrée par variante, ex {"filename": ..., "seed": 42, "controlnet_weight": 0.8}
+      Les variantes sont versionnées à la suite (v0003, v0004...) dans l'ordre de la liste.
+    """
+    data = load_project_data(project_id)
+    plan = next((p for p in data['plans'] if p['plan_base_id'] == plan_base_id), None)
+    if not plan:
+        raise ValueError(f"Plan '{plan_base_id}' non trouvé dans le projet '{project_id}'.")
+    entry = {
+        "group_id": group_id,
+        "prompt": prompt_used,
+        "task": task,
+        "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+        "variants": variants,
+        "selected": None  # Variante retenue par l'artiste (nom de fichier)
+    }
+    plan['history'].append(entry)
+    save_project_data(project_id, data)
+    return entry
+
+# 10. Retenir une variante d'un groupe
+def select_variant(project_id: str, plan_base_id: str, group_id: str, filename: str) -> Dict[str, Any]:
+    data = load_project_data(project_id)
+    plan = next((p for p in data['plans'] if p['plan_base_id'] == plan_base_id), None)
+    if not plan:
+        raise ValueError(f"Plan '{plan_base_id}' non trouvé dans le projet '{project_id}'.")
+    for hist in plan['history']:
+        if hist.get('group_id') == group_id:
+            if filename not in [variant['filename'] for variant in hist['variants']]:
+                raise ValueError(f"Variante '{filename}' absente du groupe '{group_id}'.")
+            hist['selected'] = filename
+            save_project_data(project_id, data)
+            return hist
+    raise ValueError(f"Groupe de variantes '{group_id}' non trouvé pour le plan '{plan_base_id}'.")
+
 # ---
 # Chaque fonction est prévue pour être appelée par le reste du backend (extraction, comfyui, API)
 # et garantir la cohérence de la nomenclature et de l'historique.
@@ -0,0 +1,182 @@
+"""
+scene_store.py
+--------------
+Stockage indexé des scènes extraites des storyboards (SQLite en mode WAL).
+
+Chaque scène est une ligne (id, épisode, position, données JSON): retrouver une scène
+par son id passe par la clé primaire au lieu de relire tous les fichiers d'épisode, et
+les résultats de génération sont enregistrés par lots, dans une seule transaction.
+
+Les anciens fichiers data/scenes/<episode>.json sont importés automatiquement au
+premier démarrage.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    id TEXT PRIMARY KEY,
+    episode_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scenes_episode ON scenes (episode_id, position);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Nombre de scènes modifiées par transaction lors des mises à jour groupées
+UPDATE_BATCH_SIZE = 500
+
+
+class SceneStore:
+    """Scènes des épisodes, indexées par id, avec mises à jour transactionnelles par lots"""
+
+    def __init__(self, db_path: str, legacy_dir: Optional[str] = None):
+        """
+        Ouvre (ou crée) la base des scènes
+
+        Args:
+            db_path: Fichier SQLite
+            legacy_dir: Dossier des anciens fichiers <episode>.json à importer une fois
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._local = threading.local()
+        # Les écritures sont sérialisées; les lectures profitent du WAL et ne bloquent pas
+        self._write_lock = threading.Lock()
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        if legacy_dir:
+            self._import_legacy(legacy_dir)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connexion propre au thread courant (les tâches de fond tournent dans d'autres threads)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _import_legacy(self, legacy_dir: str):
+        """Importe les fichiers JSON d'épisode existants (une seule fois)"""
+        conn = self._connection()
+        if conn.execute("SELECT value FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return
+        if os.path.isdir(legacy_dir):
+            for filename in sorted(os.listdir(legacy_dir)):
+                if not filename.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(legacy_dir, filename), "r") as f:
+                        scenes = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self.save_episode(os.path.splitext(filename)[0], scenes)
+        with self._write_lock:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', '1')")
+
+    # --- Lecture ---
+
+    def get_episode(self, episode_id: str) -> List[Dict[str, Any]]:
+        """Scènes d'un épisode, dans l'ordre d'extraction"""
+        rows = self._connection().execute(
+            "SELECT data FROM scenes WHERE episode_id = ? ORDER BY position", (episode_id,)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def get_scenes(self, scene_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        """
+        Scènes correspondant à des ids (les ids inconnus sont ignorés)
+
+        Returns:
+            Scènes dans l'ordre des ids demandés
+        """
+        conn = self._connection()
+        scenes = []
+        for scene_id in dict.fromkeys(scene_ids):
+            row = conn.execute("SELECT data FROM scenes WHERE id = ?", (scene_id,)).fetchone()
+            if row:
+                scenes.append(json.loads(row[0]))
+        return scenes
+
+    def episode_of(self, scene_id: str) -> Optional[str]:
+        """Épisode contenant une scène"""
+        row = self._connection().execute("SELECT episode_id FROM scenes WHERE id = ?", (scene_id,)).fetchone()
+        return row[0] if row else None
+
+    # --- Écriture ---
+
+    def save_episode(self, episode_id: str, scenes: List[Dict[str, Any]]):
+        """Remplace toutes les scènes d'un épisode (une transaction)"""
+        conn = self._connection()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM scenes WHERE episode_id = ?", (episode_id,))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO scenes (id, episode_id, position, data) VALUES (?, ?, ?, ?)",
+                    [(scene["id"], episode_id, position, json.dumps(scene))
+                     for position, scene in enumerate(scenes)])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def add_generated_images(self, images_by_scene: Dict[str, List[Dict[str, Any]]]) -> int:
+        """
+        Ajoute des images générées à des scènes, par lots de UPDATE_BATCH_SIZE scènes par transaction
+
+        Une image dont le chemin figure déjà dans la scène n'est pas ajoutée une seconde fois.
+
+        Args:
+            images_by_scene: id de scène -> images à ajouter à generated_images
+
+        Returns:
+            Nombre de scènes mises à jour
+        """
+        conn = self._connection()
+        items = [(scene_id, images) for scene_id, images in images_by_scene.items() if images]
+        updated = 0
+        for start in range(0, len(items), UPDATE_BATCH_SIZE):
+            with self._write_lock:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = []
+                    for scene_id, images in items[start:start + UPDATE_BATCH_SIZE]:
+                        row = conn.execute("SELECT data FROM scenes WHERE id = ?", (scene_id,)).fetchone()
+                        if not row:
+                            continue
+                        scene = json.loads(row[0])
+                        generated = scene.setdefault("generated_images", [])
+                        known = {image.get("path") for image in generated}
+                        generated.extend(image for image in images if image.get("path") not in known)
+                        rows.append((json.dumps(scene), scene_id))
+                    conn.executemany("UPDATE scenes SET data = ? WHERE id = ?", rows)
+                    conn.execute("COMMIT")
+                    updated += len(rows)
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+        return updated
+
+
+_stores: Dict[str, SceneStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_scene_store(db_path: str, legacy_dir: Optional[str] = None) -> SceneStore:
+    """Store partagé par fichier de base (une seule importation des anciens fichiers)"""
+    key = os.path.abspath(db_path)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = SceneStore(db_path, legacy_dir)
+        return _stores[key]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Model Affinity Ordering
+
+Switching checkpoints or LoRAs between consecutive prompts makes ComfyUI
+unload and reload models, which costs seconds to minutes. Work is therefore
+grouped by its model signature (the checkpoint, LoRA and ControlNet files it
+references), but only within a fairness window: an item is never passed over
+more than `window` times, so a batch of one style cannot hold back another
+indefinitely.
+"""
+
+from generation.result_cache import extract_model_names
+
+
+def model_signature(workflow, extra_models=None):
+    """
+    Compute the model signature of a workflow.
+
+    Args:
+        workflow (dict): Workflow (API format)
+        extra_models (list, optional): Models applied outside the workflow (e.g. a style LoRA)
+
+    Returns:
+        tuple or None: Sorted model names, None if the workflow references no model
+    """
+    names = set(extract_model_names(workflow))
+    names.update(name for name in (extra_models or []) if name)
+    return tuple(sorted(names)) or None
+
+
+def pick_affine(candidates, last_signature, window, signature_of=lambda item: item.signature,
+                bypass_count=lambda item: item.bypassed):
+    """
+    Choose the next item among candidates listed in fair serving order.
+
+    The first candidate sharing last_signature is preferred, unless the head
+    of the list has already been passed over `window` times.
+
+    Args:
+        candidates (list): Items in their fair serving order (the head is the fair choice)
+        last_signature: Signature of the previously served item
+        window (int): Number of items considered and maximum number of times an item can be passed over
+        signature_of (callable): Returns the signature of an item
+        bypass_count (callable): Returns how many times an item has been passed over
+
+    Returns:
+        int: Index of the chosen candidate (0 if nothing matches)
+    """
+    if not candidates or window <= 0 or last_signature is None:
+        return 0
+    if bypass_count(candidates[0]) >= window:
+        return 0
+    for index, item in enumerate(candidates[:window]):
+        if signature_of(item) == last_signature:
+            return index
+    return 0
+
+
+def order_by_affinity(items, signature_of, window=8, last_signature=None):
+    """
+    Reorder items so that items with the same model signature run consecutively.
+
+    Greedy and stable: after each item, the next one with the same signature
+    within the first `window` pending items is taken; otherwise the oldest
+    pending item is. No item is moved back by more than `window` positions.
+
+    Args:
+        items (list): Items in their submission order
+        signature_of (callable): Returns the model signature of an item
+        window (int): Fairness window (0 keeps the original order)
+        last_signature: Signature currently loaded on the backend, if known
+
+    Returns:
+        list: Reordered items
+    """
+    pending = [[item, signature_of(item), 0] for item in items]  # item, signature, times bypassed
+    ordered = []
+    while pending:
+        index = pick_affine(pending, last_signature, window, signature_of=lambda entry: entry[1],
+                            bypass_count=lambda entry: entry[2])
+        for entry in pending[:index]:
+            entry[2] += 1
+        item, last_signature, _ = pending.pop(index)
+        ordered.append(item)
+    return ordered
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generation Cancellation
+
+A CancelToken is shared by a job and whoever may cancel it. Code that submits
+prompts checks the token before each submission and registers every ComfyUI
+prompt it queues; cancelling the token (for the whole job or one scene) then
+removes the job's pending prompts from ComfyUI's queue and interrupts the
+running prompt if, and only if, it belongs to the job, so the GPU is freed
+within seconds instead of working through an abandoned episode.
+
+Async code deep in the generators finds the token of the current scene
+through a context variable set by the caller (see cancel_scope).
+"""
+
+import contextlib
+import contextvars
+import logging
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+_current_scope = contextvars.ContextVar("generation_cancel_scope", default=None)
+
+
+class GenerationCancelled(Exception):
+    """Raised when a job or scene is cancelled."""
+
+
+def cancel_comfyui_prompts(base_url, prompt_ids, timeout=10):
+    """
+    Remove prompts from a ComfyUI server: delete the queued ones, interrupt the running one.
+
+    The interrupt is only sent when the running prompt is one of prompt_ids, so
+    other users' work is never interrupted.
+
+    Args:
+        base_url (str): ComfyUI base URL
+        prompt_ids (list): Prompt ids to remove
+        timeout (float): HTTP timeout in seconds
+
+    Returns:
+        dict: {"deleted": [prompt ids removed from the queue], "interrupted": [prompt id or nothing]}
+    """
+    base_url = base_url.rstrip("/")
+    wanted = set(prompt_ids)
+    summary = {"deleted": [], "interrupted": []}
+    if not wanted:
+        return summary
+    try:
+        response = requests.get(f"{base_url}/queue", timeout=timeout)
+        response.raise_for_status()
+        queue = response.json()
+    except Exception as e:
+        logger.warning(f"Could not read the ComfyUI queue of {base_url} to cancel prompts: {e}")
+        return summary
+
+    pending = [item[1] for item in queue.get("queue_pending", []) if len(item) > 1 and item[1] in wanted]
+    running = [item[1] for item in queue.get("queue_running", []) if len(item) > 1 and item[1] in wanted]
+    if pending:
+        try:
+            requests.post(f"{base_url}/queue", json={"delete": pending}, timeout=timeout).raise_for_status()
+            summary["deleted"] = pending
+        except Exception as e:
+            logger.warning(f"Could not delete {len(pending)} queued prompt(s) on {base_url}: {e}")
+    for prompt_id in running:
+        try:
+            # Recent ComfyUI versions only interrupt the given prompt; older ones interrupt the running one,
+            # which was just checked to be ours
+            requests.post(f"{base_url}/interrupt", json={"prompt_id": prompt_id}, timeout=timeout).raise_for_status()
+            summary["interrupted"].append(prompt_id)
+        except Exception as e:
+            logger.warning(f"Could not interrupt prompt {prompt_id} on {base_url}: {e}")
+    if summary["deleted"] or summary["interrupted"]:
+        logger.info(f"Cancelled on {base_url}: {len(summary['deleted'])} queued prompt(s) deleted, "
+                    f"{len(summary['interrupted'])} interrupted")
+    return summary
+
+
+class CancelToken:
+    """Cancellation state of one job: whole-job and per-scene flags plus the prompts the job has queued."""
+
+    def __init__(self, job_id=None):
+        """
+        Initialize the token
+
+        Args:
+            job_id (str, optional): Job the token belongs to (for logs)
+        """
+        self.job_id = job_id
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._cancelled_scenes = set()
+        self._prompts = {}  # prompt_id -> (scene key, base_url, on_cancel callback)
+        # Called with (prompt_id, base_url, scene_key, details) for every prompt the job queues,
+        # e.g. to journal it so that a restart can reattach to it
+        self.on_track = None
+
+    @property
+    def cancelled(self):
+        """ True once the whole job has been cancelled. """
+        return self._cancelled
+
+    def is_cancelled(self, scene_key=None):
+        """
+        Check whether the job, or one of its scenes, was cancelled.
+
+        Args:
+            scene_key (optional): Scene to check (None checks the whole job only)
+
+        Returns:
+            bool: True if no further work should be submitted for it
+        """
+        with self._lock:
+            return self._cancelled or (scene_key is not None and str(scene_key) in self._cancelled_scenes)
+
+    def raise_if_cancelled(self, scene_key=None):
+        """ Raises GenerationCancelled if the job or scene was cancelled. """
+        if self.is_cancelled(scene_key):
+            raise GenerationCancelled(f"Job {self.job_id} cancelled" if scene_key is None
+                                      else f"Scene {scene_key} of job {self.job_id} cancelled")
+
+    def track(self, prompt_id, base_url, scene_key=None, on_cancel=None, details=None):
+        """
+        Register a prompt queued by the job.
+
+        A prompt registered after its scene was cancelled (submission racing the
+        cancel request) is cancelled immediately.
+
+        Args:
+            prompt_id (str): ComfyUI prompt id
+            base_url (str): ComfyUI server the prompt was queued on
+            scene_key (optional): Scene the prompt belongs to
+            on_cancel (callable, optional): Called with the prompt id once it has been cancelled
+            details (dict, optional): What is needed to collect the prompt's result (seed, output node...),
+                passed to the on_track hook
+        """
+        scene_key = None if scene_key is None else str(scene_key)
+        with self._lock:
+            self._prompts[prompt_id] = (scene_key, base_url, on_cancel)
+            late = self._cancelled or (scene_key is not None and scene_key in self._cancelled_scenes)
+        if self.on_track is not None:
+            try:
+                self.on_track(prompt_id, base_url, scene_key, dict(details or {}))
+            except Exception as e:
+                logger.warning(f"Could not record prompt {prompt_id} of job {self.job_id}: {e}")
+        if late:
+            self._cancel_prompts([prompt_id])
+
+    def untrack(self, prompt_id):
+        """ Forget a prompt that finished. """
+        with self._lock:
+            self._prompts.pop(prompt_id, None)
+
+    def cancel(self, scene_key=None):
+        """
+        Cancel the whole job, or one scene.
+
+        Args:
+            scene_key (optional): Scene to cancel (None cancels the job)
+
+        Returns:
+            dict: {"deleted": [...], "interrupted": [...]} prompt ids removed from ComfyUI
+        """
+        scene_key = None if scene_key is None else str(scene_key)
+        with self._lock:
+            if scene_key is None:
+                self._cancelled = True
+                prompt_ids = list(self._prompts)
+            else:
+                self._cancelled_scenes.add(scene_key)
+                prompt_ids = [pid for pid, (key, _, _) in self._prompts.items() if key == scene_key]
+        logger.info(f"Cancelling {'job' if scene_key is None else f'scene {scene_key} of job'} {self.job_id}: "
+                    f"{len(prompt_ids)} prompt(s) in flight")
+        return self._cancel_prompts(prompt_ids)
+
+    def _cancel_prompts(self, prompt_ids):
+        with self._lock:
+            records = {pid: self._prompts[pid] for pid in prompt_ids if pid in self._prompts}
+        by_server = {}
+        for prompt_id, (_, base_url, _) in records.items():
+            by_server.setdefault(base_url, []).append(prompt_id)
+        summary = {"deleted": [], "interrupted": []}
+        for base_url, ids in by_server.items():
+            result = cancel_comfyui_prompts(base_url, ids)
+            summary["deleted"] += result["deleted"]
+            summary["interrupted"] += result["interrupted"]
+        # Waiters are released for every cancelled prompt, including those that were no longer queued
+        for prompt_id, (_, _, on_cancel) in records.items():
+            self.untrack(prompt_id)
+            if on_cancel:
+                try:
+                    on_cancel(prompt_id)
+                except Exception as e:
+                    logger.debug(f"Cancel callback failed for prompt {prompt_id}: {e}")
+        return summary
+
+
+@contextlib.contextmanager
+def cancel_scope(token, scene_key=None):
+    """
+    Make a token the current one for the code run inside the block (including awaited coroutines).
+
+    Args:
+        token (CancelToken or None): Token of the running job
+        scene_key (optional): Scene being generated
+    """
+    reset = _current_scope.set((token, scene_key) if token is not None else None)
+    try:
+        yield token
+    finally:
+        _current_scope.reset(reset)
+
+
+def track_prompt(prompt_id, base_url, on_cancel=None, **details):
+    """
+    Register a queued prompt with the current cancel scope (no-op outside of one).
+
+    Args:
+        prompt_id (str): ComfyUI prompt id
+        base_url (str): ComfyUI server
+        on_cancel (callable, optional): Called with the prompt id once it has been cancelled
+        **details: What is needed to collect the prompt's result after a restart (seed, output node...)
+    """
+    scope = _current_scope.get()
+    if scope is not None:
+        token, scene_key = scope
+        token.track(prompt_id, base_url, scene_key, on_cancel, details)
+
+
+def release_prompt(prompt_id):
+    """ Forget a finished prompt in the current cancel scope (no-op outside of one). """
+    scope = _current_scope.get()
+    if scope is not None:
+        scope[0].untrack(prompt_id)
+
+
+def check_cancelled():
+    """ Raises GenerationCancelled if the job or scene of the current cancel scope was cancelled. """
+    scope = _current_scope.get()
+    if scope is not None:
+        scope[0].raise_if_cancelled(scope[1])
+
+
+def current_cancel_token():
+    """ Returns the token of the current cancel scope, or None. """
+    scope = _current_scope.get()
+    return scope[0] if scope else None
+
+
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+
+def get_cancel_token(job_id, create=True):
+    """
+    Get the cancel token of a job.
+
+    Args:
+        job_id (str): Job identifier
+        create (bool): Create the token if the job has none yet
+
+    Returns:
+        CancelToken or None: Token shared by the job and the cancel API
+    """
+    with _tokens_lock:
+        token = _tokens.get(job_id)
+        if token is None and create:
+            token = CancelToken(job_id)
+            _tokens[job_id] = token
+        return token
+
+
+def release_cancel_token(job_id):
+    """ Forget the token of a finished job. """
+    with _tokens_lock:
+        _tokens.pop(job_id, None)
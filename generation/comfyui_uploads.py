@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ComfyUI Input Uploads
+
+Reference images are uploaded to ComfyUI's input folder under a name derived
+from their content hash, so the same image always maps to the same input
+name and never has to be sent twice. The names each backend already holds
+are remembered on disk and checked once per process against the backend's
+LoadImage input list (a single cheap /object_info request), which drops
+names that were deleted on the ComfyUI side. When the input folder is cleaned
+while the app runs, ComfyUI rejects the next prompt naming a deleted input:
+the submitter passes the error to recover_missing(), which forgets the names
+it mentions and uploads them again from their local files.
+
+Files are streamed from disk for both the asyncio (aiohttp) and the
+synchronous (requests) upload paths.
+"""
+
+import asyncio
+import json
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+
+import aiohttp
+import requests
+
+from generation.result_cache import cached_file_sha256
+
+logger = logging.getLogger(__name__)
+
+INPUT_PREFIX = "madsea_"
+STATE_FILENAME = "comfyui_uploads.json"
+CHUNK_SIZE = 256 * 1024
+# Content-derived input names, as they appear in ComfyUI error messages
+INPUT_NAME_PATTERN = re.compile(rf"{INPUT_PREFIX}[0-9a-f]{{32}}\.[A-Za-z0-9]+")
+
+
+class ComfyUIUploadError(RuntimeError):
+    """Raised when ComfyUI rejects or fails an upload."""
+
+
+class _MultipartFileStream:
+    """
+    Multipart body that reads the file in chunks as requests sends it.
+
+    Exposes __len__ so requests sends a Content-Length instead of a chunked body
+    (aiohttp-based servers such as ComfyUI do not always accept chunked uploads).
+    """
+
+    def __init__(self, file_path, field_name, filename, content_type, fields=None):
+        self.file_path = file_path
+        self.boundary = uuid.uuid4().hex
+        head = []
+        for name, value in (fields or {}).items():
+            head.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n')
+        head.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field_name}"; '
+                    f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n')
+        self._head = "".join(head).encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self._head) + os.path.getsize(self.file_path) + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        with open(self.file_path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+        yield self._tail
+
+
+class ComfyUIUploadManager:
+    """Content-addressed, deduplicated uploads of input images to one ComfyUI backend."""
+
+    def __init__(self, base_url, state_dir="cache"):
+        """
+        Initialize the upload manager
+
+        Args:
+            base_url (str): ComfyUI base URL (e.g. http://127.0.0.1:8188)
+            state_dir (str or Path): Directory holding the persisted upload state
+        """
+        self.base_url = base_url.rstrip("/")
+        self.state_path = Path(state_dir) / STATE_FILENAME
+        self._lock = threading.Lock()
+        self._known = set(self._load_state().get(self.base_url, []))
+        self._verified = False
+        self._sources = {}  # input name -> local file it was made from (this process only)
+        self.uploads = 0
+        self.skipped = 0
+
+    # --- Persisted state ---
+
+    def _load_state(self):
+        if not self.state_path.exists():
+            return {}
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not read ComfyUI upload state {self.state_path}: {e}")
+            return {}
+
+    def _save_state(self):
+        """ Writes the known names for this backend, keeping the other backends' entries. Caller holds the lock. """
+        with _state_file_lock:
+            state = self._load_state()
+            state[self.base_url] = sorted(self._known)
+            try:
+                os.makedirs(self.state_path.parent, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=self.state_path.parent, prefix=".uploads-", suffix=".tmp")
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.state_path)
+            except Exception as e:
+                logger.warning(f"Could not write ComfyUI upload state: {e}")
+
+    # --- Naming and verification ---
+
+    @staticmethod
+    def input_name(image_path):
+        """
+        Get the ComfyUI input name of an image, derived from its content.
+
+        Args:
+            image_path (str or Path): Local image path
+
+        Returns:
+            str: Input name (e.g. madsea_<hash>.png)
+        """
+        suffix = Path(image_path).suffix.lower() or ".png"
+        return f"{INPUT_PREFIX}{cached_file_sha256(image_path)[:32]}{suffix}"
+
+    @staticmethod
+    def _parse_input_list(object_info):
+        """ Extracts the file list of the LoadImage 'image' input from an /object_info response. """
+        try:
+            choices = object_info["LoadImage"]["input"]["required"]["image"][0]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return set(choices) if isinstance(choices, list) else None
+
+    def _apply_remote_inputs(self, remote_inputs):
+        with self._lock:
+            if remote_inputs is None:
+                return
+            before = len(self._known)
+            # Keep what is still there, and adopt content-named files uploaded by earlier sessions
+            self._known = {name for name in self._known if name in remote_inputs}
+            self._known.update(name for name in remote_inputs if name.startswith(INPUT_PREFIX))
+            self._verified = True
+            if len(self._known) != before:
+                self._save_state()
+        logger.info(f"ComfyUI inputs verified on {self.base_url}: {len(self._known)} known uploads.")
+
+    def verify(self, timeout=10):
+        """ Checks the known names against the backend's input folder (once per process). """
+        if self._verified:
+            return
+        try:
+            response = requests.get(f"{self.base_url}/object_info/LoadImage", timeout=timeout)
+            response.raise_for_status()
+            self._apply_remote_inputs(self._parse_input_list(response.json()))
+        except Exception as e:
+            logger.warning(f"Could not verify ComfyUI inputs on {self.base_url}: {e}")
+
+    async def verify_async(self, session, timeout=10):
+        """ Async variant of verify(). """
+        if self._verified:
+            return
+        try:
+            async with session.get(f"{self.base_url}/object_info/LoadImage",
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                self._apply_remote_inputs(self._parse_input_list(await response.json()))
+        except Exception as e:
+            logger.warning(f"Could not verify ComfyUI inputs on {self.base_url}: {e}")
+
+    def is_known(self, name):
+        with self._lock:
+            return name in self._known
+
+    def _note_source(self, name, image_path):
+        with self._lock:
+            self._sources[name] = str(image_path)
+
+    def _remember(self, name):
+        with self._lock:
+            self._known.add(name)
+            self.uploads += 1
+            self._save_state()
+
+    def forget(self, name):
+        """ Drops a name (e.g. after ComfyUI reported the input as missing) so the next call re-uploads it. """
+        with self._lock:
+            self._known.discard(name)
+            self._save_state()
+
+    def _missing_sources(self, error_text):
+        """ Forgets the input names an error message mentions; returns {name: local path} of those to re-upload. """
+        names = set(INPUT_NAME_PATTERN.findall(str(error_text or "")))
+        with self._lock:
+            names &= self._known | set(self._sources)
+            sources = {name: self._sources[name] for name in names if name in self._sources}
+        for name in names:
+            logger.warning(f"ComfyUI input {name} is missing on {self.base_url}, forgetting it.")
+            self.forget(name)
+        return {name: path for name, path in sources.items() if os.path.exists(path)}
+
+    def recover_missing(self, error_text):
+        """
+        Re-upload the inputs a rejected prompt reports as missing (input folder cleaned on the ComfyUI side).
+
+        Args:
+            error_text (str): ComfyUI error (response body or node_errors)
+
+        Returns:
+            bool: True if at least one input was uploaded again (the prompt can be resubmitted as is)
+        """
+        recovered = False
+        for name, image_path in self._missing_sources(error_text).items():
+            try:
+                recovered = self.ensure_uploaded(image_path) == name or recovered
+            except Exception as e:
+                logger.error(f"Could not upload {image_path} to {self.base_url} again: {e}")
+        return recovered
+
+    async def recover_missing_async(self, error_text, session=None):
+        """ Async variant of recover_missing(). """
+        recovered = False
+        for name, image_path in self._missing_sources(error_text).items():
+            try:
+                recovered = await self.ensure_uploaded_async(image_path, session) == name or recovered
+            except Exception as e:
+                logger.error(f"Could not upload {image_path} to {self.base_url} again: {e}")
+        return recovered
+
+    # --- Uploads ---
+
+    def ensure_uploaded(self, image_path, timeout=60):
+        """
+        Make sure an image is available in ComfyUI's input folder (blocking).
+
+        Args:
+            image_path (str or Path): Local image path
+
+        Returns:
+            str: Name to use in the LoadImage node
+
+        Raises:
+            FileNotFoundError: If the image does not exist
+            ComfyUIUploadError: If the upload fails
+        """
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found: {image_path}")
+        self.verify()
+        name = self.input_name(image_path)
+        self._note_source(name, image_path)
+        if self.is_known(name):
+            self.skipped += 1
+            return name
+
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        body = _MultipartFileStream(image_path, "image", name, content_type, fields={"overwrite": "true"})
+        try:
+            response = requests.post(f"{self.base_url}/upload/image", data=body,
+                                     headers={"Content-Type": body.content_type}, timeout=timeout)
+            response.raise_for_status()
+            uploaded_name = response.json().get("name", name)
+        except requests.exceptions.RequestException as e:
+            raise ComfyUIUploadError(f"Upload of {image_path} to {self.base_url} failed: {e}") from e
+        self._remember(uploaded_name)
+        logger.info(f"Uploaded {Path(image_path).name} to ComfyUI as {uploaded_name}")
+        return uploaded_name
+
+    async def ensure_uploaded_async(self, image_path, session=None, timeout=60):
+        """
+        Async variant of ensure_uploaded().
+
+        Args:
+            image_path (str or Path): Local image path
+            session (aiohttp.ClientSession, optional): Session to reuse
+
+        Returns:
+            str: Name to use in the LoadImage node
+        """
+        if session is None:
+            async with aiohttp.ClientSession() as own_session:
+                return await self.ensure_uploaded_async(image_path, own_session, timeout)
+
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found: {image_path}")
+        await self.verify_async(session)
+        loop = asyncio.get_running_loop()
+        name = await loop.run_in_executor(None, self.input_name, image_path)
+        self._note_source(name, image_path)
+        if self.is_known(name):
+            self.skipped += 1
+            return name
+
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        try:
+            with open(image_path, 'rb') as f:
+                form = aiohttp.FormData()
+                form.add_field("overwrite", "true")
+                # A file object is streamed by aiohttp rather than read into memory
+                form.add_field("image", f, filename=name, content_type=content_type)
+                async with session.post(f"{self.base_url}/upload/image", data=form,
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    response.raise_for_status()
+                    uploaded_name = (await response.json()).get("name", name)
+        except aiohttp.ClientError as e:
+            raise ComfyUIUploadError(f"Upload of {image_path} to {self.base_url} failed: {e}") from e
+        self._remember(uploaded_name)
+        logger.info(f"Uploaded {Path(image_path).name} to ComfyUI as {uploaded_name}")
+        return uploaded_name
+
+    def get_stats(self):
+        """ Returns upload statistics. """
+        with self._lock:
+            return {"known": len(self._known), "uploads": self.uploads, "skipped": self.skipped,
+                    "verified": self._verified}
+
+
+_state_file_lock = threading.Lock()
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_upload_manager(base_url, state_dir="cache"):
+    """
+    Get the shared upload manager of a ComfyUI backend.
+
+    Args:
+        base_url (str): ComfyUI base URL
+        state_dir (str or Path): Directory holding the persisted upload state
+
+    Returns:
+        ComfyUIUploadManager: Manager shared by every caller in the process
+    """
+    key = base_url.rstrip("/")
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = ComfyUIUploadManager(key, state_dir)
+            _managers[key] = manager
+        return manager
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming Image Downloads
+
+Generated images are streamed to a temporary file next to their destination
+in fixed-size chunks, checked (size against Content-Length, image header and
+structure), and only then renamed into place. Readers never see a partial
+file and the process never holds a whole high-resolution image in memory.
+Disk writes and the image check run in the default executor so the event
+loop is never blocked.
+"""
+
+import asyncio
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import aiohttp
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+
+class DownloadError(RuntimeError):
+    """Raised when a download fails or produces an invalid image."""
+
+
+def verify_image_file(file_path):
+    """
+    Check that a file is a readable image without decoding its pixels.
+
+    Args:
+        file_path (str or Path): Image file
+
+    Raises:
+        DownloadError: If the file is not a valid image
+    """
+    try:
+        with Image.open(file_path) as img:
+            # verify() checks the structure (and PNG CRCs) without loading the pixel data
+            img.verify()
+    except Exception as e:
+        raise DownloadError(f"Downloaded file is not a valid image: {e}") from e
+
+
+async def download_to_file(url, output_path, params=None, headers=None, session=None, timeout=120,
+                           verify_image=True):
+    """
+    Stream a URL to a file, atomically.
+
+    Args:
+        url (str): URL to download
+        output_path (str or Path): Destination file
+        params (dict, optional): Query parameters
+        headers (dict, optional): Request headers
+        session (aiohttp.ClientSession, optional): Session to reuse
+        timeout (float): Total timeout in seconds
+        verify_image (bool): Check that the result is a decodable image
+
+    Returns:
+        str: Destination path
+
+    Raises:
+        DownloadError: On HTTP error, truncated or empty body, or invalid image
+    """
+    if session is None:
+        async with aiohttp.ClientSession() as own_session:
+            return await download_to_file(url, output_path, params, headers, own_session, timeout, verify_image)
+
+    output_path = Path(output_path)
+    os.makedirs(output_path.parent, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    fd, tmp_path = tempfile.mkstemp(dir=output_path.parent, prefix=f".{output_path.stem}-", suffix=".part")
+    try:
+        written = 0
+        with os.fdopen(fd, 'wb') as f:
+            async with session.get(url, params=params, headers=headers,
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status != 200:
+                    body = (await response.content.read(512)).decode("utf-8", errors="replace")
+                    raise DownloadError(f"HTTP {response.status} while downloading {url}: {body}")
+                # Content-Length is the encoded size when the body is compressed
+                encoded = response.headers.get("Content-Encoding", "identity") != "identity"
+                expected = None if encoded else response.content_length
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    await loop.run_in_executor(None, f.write, chunk)
+                    written += len(chunk)
+
+        if written == 0:
+            raise DownloadError(f"Empty response while downloading {url}")
+        if expected is not None and written != expected:
+            raise DownloadError(f"Truncated download from {url}: {written} of {expected} bytes")
+        if verify_image:
+            await loop.run_in_executor(None, verify_image_file, tmp_path)
+
+        os.replace(tmp_path, output_path)
+        logger.debug(f"Downloaded {written} bytes to {output_path}")
+        return str(output_path)
+    except asyncio.TimeoutError as e:
+        raise DownloadError(f"Timeout while downloading {url}") from e
+    except aiohttp.ClientError as e:
+        raise DownloadError(f"Error while downloading {url}: {e}") from e
+    finally:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
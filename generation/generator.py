@@ -21,11 +21,11 @@ import asyncio
 from pathlib import Path
 from abc import ABC, abstractmethod
 from PIL import Image
-import numpy as np
-import cv2
 import hashlib
 import random
-import uuid
+import shutil
+import functools
+import tempfile
 import aiohttp
 
 # Import managers (assuming they are accessible via sys.path)
@@ -33,9 +33,38 @@ from utils.api_manager import APIManager
 from utils.model_manager import ModelManager
 from utils.cache_manager import CacheManager
 from utils.security import SecurityManager
+from generation.preprocessing import ReferencePreprocessor
+from generation.postprocessing import PostProcessor
+from generation.similarity import get_similarity_index
+from generation.comfyui_uploads import get_upload_manager
+from generation.downloads import DownloadError, download_to_file
+from generation.scheduler import Priority, get_scheduler
+from generation.affinity import model_signature
+from generation.prompt_enricher import get_prompt_enricher
+from generation.routing import ROUTE_CLOUD, ROUTE_LOCAL, get_generation_router
+from generation.cancellation import GenerationCancelled, check_cancelled, current_cancel_token, release_prompt, track_prompt
+from generation.single_flight import get_single_flight
+from generation.status_hub import get_status_hub
+from generation.workflow_templates import CompiledWorkflow, WorkflowTemplateError, template_registry
+from generation.workflow_validator import get_workflow_validator
+from generation.result_cache import get_result_cache, ModelIdentityResolver, cached_file_sha256, normalize_workflow, extract_model_names
 
 logger = logging.getLogger(__name__)
 
+# Square size sent to the DALL-E 2 edit endpoint (256, 512 or 1024)
+OPENAI_EDIT_SIZE = 1024
+
+# Quality tiers: drafts are quick reduced-step renders for review, finals use the full workflow.
+# Drafts keep the final resolution: the initial noise depends on the latent size, and only the
+# same seed at the same size gives the final render the composition of the approved draft.
+QUALITY_DRAFT = "draft"
+QUALITY_FINAL = "final"
+DEFAULT_DRAFT_SETTINGS = {"steps": 10}
+
+# Shared outcome of a generation that failed on the backend: every request sharing it
+# (see single_flight) writes its own placeholder, so none reports a placeholder as a result
+_BACKEND_FAILED = object()
+
 
 class ImageGenerator:
     """Main image generator class that orchestrates the generation process"""
@@ -64,6 +93,31 @@ class ImageGenerator:
         # Create output directory
         os.makedirs(self.output_dir, exist_ok=True)
         
+        # Reference image preprocessing (worker pool + on-disk cache)
+        self.preprocessor = ReferencePreprocessor(config, self.output_dir)
+        
+        # Delivery files (resize, colour, watermark, format) produced in a process pool
+        self.postprocessor = PostProcessor(config, self.output_dir)
+        
+        # Content-addressed cache of generated images
+        self.result_cache = get_result_cache(config)
+        self.model_identities = ModelIdentityResolver(config.get("local_models_path", "models"))
+        
+        # Shared admission control in front of the backends (previews before batch jobs)
+        self.scheduler = get_scheduler(config)
+        
+        # Draft tier: same seed and conditioning as the final render, smaller and with fewer steps
+        self.draft_settings = {**DEFAULT_DRAFT_SETTINGS, **(config.get("draft", {}) or {})}
+        
+        # Identical generations in flight anywhere in the process are run once
+        self.single_flight = get_single_flight()
+        
+        # Scene text -> image prompt rewriting by a text model (batched, cached)
+        self.prompt_enricher = get_prompt_enricher(config)
+        
+        # Past generations by reference panel and scene text, offered for reuse or as a warm start
+        self.similarity = get_similarity_index(config)
+        
         # Initialize the appropriate generator based on config
         if config.get("use_cloud", False):
             logger.info("Using cloud-based image generation")
@@ -71,19 +125,144 @@ class ImageGenerator:
         else:
             logger.info("Using local image generation")
             self.generator = LocalGenerator(config, api_manager, model_manager, cache_manager)
+        
+        # Extra equivalent ComfyUI servers: each model signature is pinned to one of them
+        self.local_generators = {}
+        if not config.get("use_cloud", False):
+            self.local_generators[self.generator.backend_key({})] = self.generator
+            for base_url in config.get("comfyui", {}).get("backends", []) or []:
+                base_url = base_url.rstrip("/")
+                if base_url not in self.local_generators:
+                    self.local_generators[base_url] = LocalGenerator(config, api_manager, model_manager, cache_manager,
+                                                                     base_url=base_url)
+        
+        # Adaptive routing: scenes go to the cloud when it is expected to finish first, within a budget
+        self.router = get_generation_router(config)
+        self.cloud_generator = None
+        if self.router.enabled and not config.get("use_cloud", False):
+            self.cloud_generator = CloudGenerator(config, api_manager, security_manager, cache_manager)
+    
+    def _select_generator(self, signature, style_params=None, deadline=None):
+        """
+        Returns the generator (backend) a generation is sent to.
+        
+        Among equivalent ComfyUI servers the model signature decides; with routing
+        enabled, the router then compares that server with the cloud (and reserves
+        the cloud cost if the cloud is chosen).
+        """
+        local = self.generator
+        if len(self.local_generators) > 1:
+            local = self.local_generators[self.scheduler.pin_backend(signature, list(self.local_generators))]
+        if self.cloud_generator is None or style_params is None or not self.cloud_generator.has_credentials(style_params):
+            return local
+        local_key = local.backend_key(style_params)
+        cloud_key = self.cloud_generator.backend_key(style_params)
+        route, reason = self.router.choose(
+            local_key, max(self.scheduler.load(local_key), local.queue_depth()),
+            cloud_key, self.scheduler.load(cloud_key), self.scheduler.window(cloud_key),
+            deadline=deadline
+        )
+        logger.debug(f"Routed to {route}: {reason}")
+        return self.cloud_generator if route == ROUTE_CLOUD else local
     
-    async def generate(self, image_path, text, style_name=None, scene_index=0):
+    async def _timed_generation(self, generator, style_params, *args, **kwargs):
+        """
+        Runs generator.generate_image and records its duration and outcome with the router.
+
+        A cloud generation that produces no image, or is cancelled, gives its reserved
+        cost back; cancellations are not recorded as measurements.
         """
-        Generate an image based on the storyboard scene. Uses cache.
+        route = ROUTE_CLOUD if isinstance(generator, CloudGenerator) else ROUTE_LOCAL
+        backend = generator.backend_key(style_params)
+        started = time.monotonic()
+        result = None
+        try:
+            result = await generator.generate_image(*args, **kwargs)
+            return result
+        except (GenerationCancelled, asyncio.CancelledError):
+            started = None  # Not a measurement of the backend
+            if route == ROUTE_CLOUD:
+                # The cost reserved by the router bought no image
+                self.router.refund(backend)
+            raise
+        finally:
+            if started is not None:
+                ok = bool(result) and not generator.is_placeholder(result)
+                self.router.record(backend, time.monotonic() - started, ok, route)
+                if route == ROUTE_CLOUD and not ok:
+                    self.router.refund(backend)
+    
+    async def _reattach(self, generator, reattach, seed, output_path):
+        """ Collects the image of a prompt queued before a restart; None when the scene must be generated again. """
+        if generator is None or not reattach.get("prompt_id"):
+            logger.info(f"Cannot reattach to prompt {reattach.get('prompt_id')}: ComfyUI server "
+                        f"{reattach.get('base_url')} is not configured.")
+            return None
+        try:
+            return await generator.reattach(reattach["prompt_id"], output_path, seed=seed,
+                                            output_node_id=reattach.get("output_node_id"))
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            logger.warning(f"Could not reattach to prompt {reattach['prompt_id']}: {e}")
+            return None
+    
+    def model_signature(self, style_name=None):
+        """
+        Model signature (checkpoint, LoRA, ControlNet files) of a style, used to group generations.
+        
+        Args:
+            style_name (str, optional): Name of the style
+            
+        Returns:
+            tuple or None: Sorted model names
+        """
+        style_params = self.style_manager.get_style(style_name or self.config.get("style", "default")) or {}
+        return self._model_signature(style_params)
+    
+    def _model_signature(self, style_params):
+        try:
+            return self.generator.model_signature(style_params)
+        except Exception as e:
+            logger.debug(f"Could not compute model signature: {e}")
+            return None
+    
+    async def generate(self, image_path, text, style_name=None, scene_index=0, seed=None,
+                       priority=Priority.BATCH, project=None, quality=QUALITY_FINAL, deadline=None,
+                       warm_start=None, reattach=None):
+        """
+        Generate an image based on the storyboard scene. Uses the result cache, and
+        identical requests already in flight are waited for instead of run again.
+        
+        A draft and a final render of the same scene share the seed, resolution,
+        prompt and ControlNet reference, hence the initial noise: the composition
+        of the approved draft carries over to the final render, which only adds
+        the detail of the remaining sampler steps.
+        
+        The raw output is what the result cache keeps; when the style or config
+        declares a post-processing pipeline for the tier, the returned path is the
+        delivery file written by the post-processor (output_dir/final).
         
         Args:
             image_path (str): Path to the reference image (original from parser).
             text (str): Text description of the scene.
             style_name (str, optional): Name of the style to apply.
             scene_index (int): Index of the scene for naming output.
+            seed (int, optional): Sampler seed. Defaults to the style or config seed.
+            priority (Priority): Scheduling class of the backend submission.
+            project (str, optional): Project name, for fair sharing between projects.
+            quality (str): "draft" (few steps, same resolution) or "final" (full workflow).
+            deadline (float, optional): Epoch time the episode must be done by; with routing
+                enabled, the scene may burst to the cloud when the local queue would miss it.
+            warm_start (bool, optional): Without an explicit seed, reuse the seed of the closest
+                prior generation of this style (see find_similar). Defaults to similarity.warm_start.
+            reattach (dict, optional): Prompt queued for this scene before a restart ({"prompt_id",
+                "base_url", "output_node_id"}, as journaled through the cancel token). Its image is
+                collected if ComfyUI still knows it; otherwise the scene is generated again. Pass the
+                journaled seed along so that the result is cached under the right key.
             
         Returns:
-            str or None: Path to the generated image, or None on failure.
+            str or None: Path to the generated (post-processed) image, or None on failure.
         """
         # Use specified style or default from config
         style_name = style_name or self.config.get("style", "default")
@@ -94,122 +273,287 @@ class ImageGenerator:
             logger.error(f"Style '{style_name}' not found.")
             return None
         
+        if seed is None and (self.similarity.warm_start if warm_start is None else warm_start):
+            matches = await self.find_similar(image_path, text, style_name, limit=1)
+            if matches and matches[0].get("seed") is not None:
+                seed = matches[0]["seed"]
+                logger.info(f"Warm start for scene {scene_index}: seed {seed} of {matches[0]['result_path']} "
+                            f"(score {matches[0]['score']})")
+        seed = self._resolve_seed(seed, style_params)
+        # The reference is preprocessed with the style's own parameters in both tiers
+        reference_style_params = style_params
+        style_params = self.quality_params(style_params, quality)
+        suffix = "draft" if quality == QUALITY_DRAFT else "generated"
+        final_output_path = self.output_dir / f"scene_{scene_index:04d}_{suffix}.png"
+        
+        # Single scenes not enriched with their episode are enriched on their own
+        if self.prompt_enricher.enabled and text and self.prompt_enricher.lookup(text) is None:
+            await self.prompt_enricher.enrich(text)
+        
+        # Enhance the prompt with style-specific text
+        enhanced_prompt = self._enhance_prompt(text, style_params)
+        
         # --- Cache Check ---
+        # The key also identifies identical requests in flight, so it is computed even without the cache
         cache_key = None
-        final_output_path = self.output_dir / f"scene_{scene_index:04d}_generated.png"
+        cached_result_path = None
+        try:
+            cache_key = self._get_cache_key(image_path, enhanced_prompt, style_params, seed)
+            if self.result_cache.enabled:
+                cached_result_path = await self.result_cache.get_async(cache_key, final_output_path)
+        except Exception as e:
+            logger.warning(f"Error checking image generation cache: {e}")
+            cache_key = None
+        if cached_result_path:
+            logger.info(f"Cache hit for scene {scene_index} ({style_name}). Using: {cached_result_path}")
+            return await self.postprocessor.process_async(cached_result_path, style_params, quality)
+        # --- End Cache Check ---
+        
+        async def store(generator, result_key, generated_image_path):
+            """ Caches and indexes the image of a successful generation; maps a backend failure to _BACKEND_FAILED. """
+            if generated_image_path and generator.is_placeholder(generated_image_path):
+                logger.error(f"Image generation failed for scene {scene_index}.")
+                return _BACKEND_FAILED
+            if generated_image_path:
+                logger.info(f"Generated image for scene {scene_index} saved to: {generated_image_path}")
+                # --- Cache Store ---
+                if result_key and self.result_cache.enabled:
+                    try:
+                        await self.result_cache.put_async(result_key, generated_image_path)
+                        logger.info(f"Cached generated image for key: {result_key[:12]}")
+                    except Exception as e:
+                        logger.warning(f"Error writing image generation result to cache: {e}")
+                # --- End Cache Store ---
+                await self._record_generation(image_path, text, generated_image_path, style=style_name, seed=seed,
+                                              quality=quality, prompt=enhanced_prompt, project=project,
+                                              scene=scene_index)
+                return str(generated_image_path)
+            else:
+                logger.error(f"Image generation failed for scene {scene_index}.")
+                return None
         
-        # Disable cache for debugging? Add a flag?
-        use_cache = False # FORCE CACHE DISABLED FOR DEBUGGING
+        async def generate_once():
+            result_key = cache_key
+            if reattach:
+                generator = self.local_generators.get(str(reattach.get("base_url") or "").rstrip("/"))
+                generated_image_path = await self._reattach(generator, reattach, seed, final_output_path)
+                if generated_image_path:
+                    return await store(generator, result_key, generated_image_path)
+            
+            logger.info(f"Generating {quality} image for scene {scene_index} ({style_name}) - Cache miss or disabled.")
+            
+            # Prepare the reference image for ControlNet
+            processed_image_path = await self._prepare_reference_image(image_path, reference_style_params)
+            if not processed_image_path:
+                 logger.error(f"Failed to prepare reference image for scene {scene_index}: {image_path}")
+                 return None
+            
+            # Generate the image using the specific generator once the scheduler admits it
+            signature = self._model_signature(style_params)
+            generator = self._select_generator(signature, style_params, deadline)
+            admitted = False
+
+            async def timed_generation():
+                nonlocal admitted
+                admitted = True  # From here on, _timed_generation settles the cloud reservation
+                return await self._timed_generation(
+                    generator,
+                    style_params,
+                    processed_image_path,
+                    enhanced_prompt,
+                    style_params,
+                    final_output_path, # Pass the final desired output path
+                    seed=seed
+                )
 
-        if self.cache_manager and use_cache:
             try:
-                # Create a robust cache key
-                ref_img_hash = self._get_file_hash(image_path) if Path(image_path).exists() else None
-                cache_key = self.cache_manager.generate_key(
-                    "generated_image",
-                    ref_img_hash, # Use hash of reference image
-                    text,
-                    style_name,
-                    style_params, # Include style details
-                    self.resolution,
-                    self.config.get("use_cloud", False),
-                    # Potentially add model IDs used if deterministic
+                if generator is self.cloud_generator:
+                    # A cloud render differs from the ComfyUI one: it is cached under its own key
+                    result_key = self._cloud_cache_key(image_path, enhanced_prompt, style_params, seed)
+                    cached_result_path = None
+                    if result_key and self.result_cache.enabled:
+                        cached_result_path = await self.result_cache.get_async(result_key, final_output_path)
+                    if cached_result_path:
+                        self.router.refund(generator.backend_key(style_params))
+                        return cached_result_path
+                generated_image_path = await self.scheduler.run(
+                    timed_generation,
+                    priority=priority,
+                    project=project,
+                    backend=generator.backend_key(style_params),
+                    signature=signature
                 )
-                cached_result_path = self.cache_manager.get(cache_key)
-                if cached_result_path and Path(cached_result_path).exists():
-                    logger.info(f"Cache hit for scene {scene_index} ({style_name}). Using: {cached_result_path}")
-                    # Ensure the target output path exists by copying/linking?
-                    # For simplicity, assume cached path is usable directly or copy it
-                    if str(Path(cached_result_path).resolve()) != str(final_output_path.resolve()):
-                         shutil.copy2(cached_result_path, final_output_path)
-                    return str(final_output_path)
-            except Exception as e:
-                logger.warning(f"Error checking image generation cache: {e}")
-        # --- End Cache Check ---
+            except BaseException:
+                if generator is self.cloud_generator and not admitted:
+                    # Cancelled (or failed) while waiting for admission: the reserved cloud cost is given back
+                    self.router.refund(generator.backend_key(style_params))
+                raise
+            
+            return await store(generator, result_key, generated_image_path)
         
-        logger.info(f"Generating image for scene {scene_index} ({style_name}) - Cache miss or disabled.")
+        if cache_key is None:
+            result_path = await generate_once()
+        else:
+            # Identical concurrent requests (double-clicks, a preview overlapping a batch) share one generation
+            result_path = await self.single_flight.run(cache_key, generate_once)
+            if result_path and result_path is not _BACKEND_FAILED and Path(result_path) != final_output_path:
+                # Shared result written under another scene's name: give this request its own file
+                await asyncio.get_running_loop().run_in_executor(None, shutil.copyfile, result_path, final_output_path)
+                result_path = str(final_output_path)
         
-        # Prepare the reference image for ControlNet
-        processed_image_path = self._prepare_reference_image(image_path)
-        if not processed_image_path:
-             logger.error(f"Failed to prepare reference image for scene {scene_index}: {image_path}")
-             return None
+        if result_path is _BACKEND_FAILED:
+            # Written for this request, also when it only followed the failed generation
+            return self.generator._create_placeholder_image(final_output_path)
+        if not result_path:
+            return result_path
+        return await self.postprocessor.process_async(result_path, style_params, quality)
+    
+    def is_placeholder(self, image_path):
+        """ Returns True if generate() returned a placeholder written after a failed generation. """
+        generators = [self.generator, self.cloud_generator, *self.local_generators.values()]
+        return any(generator.is_placeholder(image_path) for generator in generators if generator is not None)
+    
+    async def find_similar(self, image_path, text, style_name=None, limit=3):
+        """
+        Find prior generations of a near-identical plan (same framing and text), in any episode.
         
-        # Enhance the prompt with style-specific text
-        enhanced_prompt = self._enhance_prompt(text, style_params)
+        Args:
+            image_path (str): Reference panel of the scene
+            text (str): Scene text
+            style_name (str, optional): Only return generations of this style
+            limit (int): Maximum number of matches
+            
+        Returns:
+            list: Matches, best first, each with its result_path, seed, style, quality,
+                prompt and score (empty when the index is disabled or nothing is close enough)
+        """
+        if not self.similarity.enabled:
+            return []
+        try:
+            # The first lookup of a panel reads and hashes the image
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.similarity.query, image_path, text, style_name, limit)
+        except Exception as e:
+            logger.warning(f"Similar plan lookup failed for {image_path}: {e}")
+            return []
+    
+    async def _record_generation(self, image_path, text, result_path, **params):
+        """ Adds a successful generation to the similarity index. """
+        if not self.similarity.enabled:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.similarity.add, image_path, text, result_path, **params))
+        except Exception as e:
+            logger.warning(f"Could not record {result_path} in the similarity index: {e}")
+    
+    def quality_params(self, style_params, quality=QUALITY_FINAL):
+        """
+        Style parameters for a quality tier.
         
-        # Generate the image using the specific generator (now async)
-        generated_image_path = await self.generator.generate_image(
-            processed_image_path,
-            enhanced_prompt,
-            style_params,
-            final_output_path # Pass the final desired output path
-        )
+        Args:
+            style_params (dict): Style parameters
+            quality (str): "draft" or "final"
+            
+        Returns:
+            dict: The style parameters for a final render; for a draft, a copy with a
+                capped step count (resolution, sampler and seed unchanged, see QUALITY_DRAFT)
+        """
+        if quality == QUALITY_FINAL:
+            return style_params
+        if quality != QUALITY_DRAFT:
+            raise ValueError(f"Unknown quality tier: {quality}")
+        return {
+            **style_params,
+            "steps": min(int(self.draft_settings["steps"]), int(style_params.get("steps") or self.draft_settings["steps"])),
+        }
+    
+    def _resolve_seed(self, seed, style_params):
+        """ Returns the explicit seed, else the style seed, else the config seed. """
+        if seed is None:
+            seed = style_params.get("seed", self.config.get("seed", 42))
+        return int(seed)
+    
+    def _get_cache_key(self, image_path, prompt, style_params, seed, generator=None):
+        """
+        Build the result cache key for a scene.
         
-        if generated_image_path:
-            logger.info(f"Generated image for scene {scene_index} saved to: {generated_image_path}")
-            # --- Cache Store ---
-            if self.cache_manager and cache_key:
-                try:
-                    # Cache the path to the *final* generated image
-                    self.cache_manager.set(cache_key, str(generated_image_path))
-                    logger.info(f"Cached generated image path for key: {cache_key}")
-                except Exception as e:
-                    logger.warning(f"Error writing image generation result to cache: {e}")
-            # --- End Cache Store ---
-            return str(generated_image_path)
-        else:
-            logger.error(f"Image generation failed for scene {scene_index}.")
+        Args:
+            image_path (str): Path to the original reference image
+            prompt (str): Enhanced prompt
+            style_params (dict): Style parameters
+            seed (int): Sampler seed
+            generator (BaseGenerator, optional): Generator rendering the scene (defaults to the main one)
+            
+        Returns:
+            str: Cache key
+        """
+        ref_img_hash = self._get_file_hash(image_path) if image_path and Path(image_path).exists() else None
+        request = (generator or self.generator).describe_request(image_path, prompt, style_params, seed)
+        request["preprocess"] = self.preprocessor.describe(style_params)
+        model_names = extract_model_names(request.get("workflow"))
+        if style_params.get("lora_name"):
+            model_names.append(style_params["lora_name"])
+        return self.result_cache.make_key(
+            ref_img_hash,
+            request,
+            self.model_identities.identities(model_names),
+            seed
+        )
+    
+    def _cloud_cache_key(self, image_path, prompt, style_params, seed):
+        """ Cache key of a scene routed to the cloud generator (None if it cannot be computed). """
+        try:
+            return self._get_cache_key(image_path, prompt, style_params, seed, generator=self.cloud_generator)
+        except Exception as e:
+            logger.warning(f"Error computing the cloud cache key: {e}")
             return None
     
     def _get_file_hash(self, file_path):
          """ Calculates SHA256 hash of a file. """
-         hasher = hashlib.sha256()
-         with open(file_path, 'rb') as f:
-             while chunk := f.read(8192):
-                 hasher.update(chunk)
-         return hasher.hexdigest()
+         return cached_file_sha256(file_path)
     
-    def _prepare_reference_image(self, image_path):
+    async def _prepare_reference_image(self, image_path, style_params=None):
         """
-        Prepare the reference image for ControlNet
+        Prepare the reference image for ControlNet (runs in the preprocessing pool)
         
         Args:
             image_path (str): Path to the reference image
+            style_params (dict, optional): Style parameters selecting the preprocessor
             
         Returns:
             str: Path to the processed image
         """
-        try:
-            # Load image
-            img = cv2.imread(image_path)
-            if img is None:
-                raise ValueError(f"Could not load image: {image_path}")
-            
-            # Resize to target resolution
-            img = cv2.resize(img, (self.resolution[0], self.resolution[1]))
-            
-            # Convert to grayscale
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # Apply edge detection (for scribble ControlNet)
-            edges = cv2.Canny(gray, 100, 200)
-            
-            # Create white background
-            background = np.ones_like(img) * 255
-            
-            # Draw edges on white background
-            background[edges != 0] = 0
+        return await self.preprocessor.process_async(image_path, style_params)
+    
+    async def preprocess_batch(self, image_paths, style_name=None):
+        """
+        Preprocess all reference images of an episode in one batch, before submission starts.
+        
+        Args:
+            image_paths (list): Paths to the reference images
+            style_name (str, optional): Name of the style (selects the preprocessor)
             
-            # Save processed image to a subfolder within the generator output dir?
-            processed_path = self.output_dir / f"{Path(image_path).stem}_processed.png"
-            cv2.imwrite(str(processed_path), background)
+        Returns:
+            dict: Mapping of source path to processed path
+        """
+        style_name = style_name or self.config.get("style", "default")
+        style_params = self.style_manager.get_style(style_name) or {}
+        return await self.preprocessor.process_batch(image_paths, style_params)
+    
+    async def enrich_prompts(self, texts):
+        """
+        Enrich all scene texts of an episode in batched LLM calls, before submission starts.
+        
+        Args:
+            texts (list): Scene texts
             
-            return str(processed_path)
-        except Exception as e:
-            logger.error(f"Error processing reference image: {e}")
-            # Return original image if processing fails
-            return image_path
+        Returns:
+            dict: Mapping of scene text to enriched prompt (empty if enrichment is disabled)
+        """
+        if not self.prompt_enricher.enabled:
+            return {}
+        return await self.prompt_enricher.enrich_batch(texts)
     
     def _enhance_prompt(self, text, style_params):
         """
@@ -226,6 +570,9 @@ class ImageGenerator:
         prefix = style_params.get("prompt_prefix", "")
         suffix = style_params.get("prompt_suffix", "")
         
+        # Use the enriched version of the text when it has been computed
+        text = self.prompt_enricher.lookup(text) or text
+        
         # Clean up the text
         text = text.strip()
         
@@ -255,9 +602,11 @@ class BaseGenerator(ABC):
         # Store other managers if passed
         self.model_manager = kwargs.get('model_manager')
         self.security_manager = kwargs.get('security_manager')
+        # Paths of placeholder images written after a failed generation
+        self._placeholder_paths = set()
     
     @abstractmethod
-    async def generate_image(self, reference_image_path, prompt, style_params, output_path):
+    async def generate_image(self, reference_image_path, prompt, style_params, output_path, seed=None):
         """
         Generate an image based on the reference image and prompt
         
@@ -266,18 +615,56 @@ class BaseGenerator(ABC):
             prompt (str): Text prompt for generation
             style_params (dict): Style parameters
             output_path (Path): Path to save the generated image
+            seed (int, optional): Sampler seed
             
         Returns:
             str or None: Path to the generated image or None on failure
         """
         pass
 
+    def backend_key(self, style_params):
+        """ Identifies the backend a request is sent to (scheduler in-flight window). """
+        return type(self).__name__
+
+    def queue_depth(self):
+        """ Generations queued on the backend by any client, when the backend reports it. """
+        return 0
+
+    def model_signature(self, style_params):
+        """ Models a request loads on the backend (see generation/affinity.py). """
+        return model_signature({}, [style_params.get("model"), style_params.get("lora_name")])
+
+    def describe_request(self, reference_image_path, prompt, style_params, seed):
+        """
+        Describe everything that determines the generated image, for cache keying.
+        
+        Args:
+            reference_image_path (str): Path to the reference image
+            prompt (str): Text prompt for generation
+            style_params (dict): Style parameters
+            seed (int): Sampler seed
+            
+        Returns:
+            dict: JSON-serializable request description
+        """
+        return {
+            "generator": type(self).__name__,
+            "prompt": prompt,
+            "style": {k: v for k, v in style_params.items() if not k.startswith("_")},
+            "resolution": list(self.resolution),
+        }
+
+    def is_placeholder(self, image_path):
+        """ Returns True if the path is a placeholder written after a failed generation. """
+        return str(image_path) in self._placeholder_paths
+
     def _create_placeholder_image(self, output_path):
         """ Creates a simple placeholder image if generation fails. """
         try:
             img = Image.new('RGB', (self.resolution[0], self.resolution[1]), color = 'darkgrey')
             # TODO: Add text indicating failure?
             img.save(output_path)
+            self._placeholder_paths.add(str(output_path))
             logger.warning(f"Generation failed, created placeholder image at: {output_path}")
             return str(output_path)
         except Exception as e:
@@ -288,7 +675,8 @@ class BaseGenerator(ABC):
 class LocalGenerator(BaseGenerator):
     """Local image generator using ComfyUI"""
     
-    def __init__(self, config, api_manager: APIManager, model_manager: ModelManager, cache_manager: CacheManager):
+    def __init__(self, config, api_manager: APIManager, model_manager: ModelManager, cache_manager: CacheManager,
+                 base_url=None):
         """
         Initialize the local generator
         
@@ -297,14 +685,23 @@ class LocalGenerator(BaseGenerator):
             api_manager (APIManager): API manager instance
             model_manager (ModelManager): Model manager instance
             cache_manager (CacheManager): Cache manager instance
+            base_url (str, optional): ComfyUI server URL, overrides comfyui_host/comfyui_port
         """
         super().__init__(config, api_manager, cache_manager, model_manager=model_manager)
         logger.debug("Initializing LocalGenerator...") # Add log
         self.model_manager = model_manager
         self.comfyui_host = config.get("comfyui_host", "127.0.0.1")
         self.comfyui_port = config.get("comfyui_port", 8188)
-        self.base_comfyui_url = f"http://{self.comfyui_host}:{self.comfyui_port}"
-        self.comfyui_client_id = str(uuid.uuid4()) 
+        self.base_comfyui_url = base_url or f"http://{self.comfyui_host}:{self.comfyui_port}"
+        # Shared WebSocket subscription following every prompt queued by this process
+        self.status_hub = get_status_hub(self.base_comfyui_url)
+        # Reference images are uploaded once per content hash and backend
+        self.upload_manager = get_upload_manager(self.base_comfyui_url, config.get("cache_dir", "cache"))
+        # Workflows are checked against the server's cached /object_info before being queued
+        validation_config = config.get("workflow_validation", {}) or {}
+        self.validator = None
+        if validation_config.get("enabled", True):
+            self.validator = get_workflow_validator(self.base_comfyui_url, ttl=validation_config.get("ttl", 600))
         
         # Explicitly initialize workflow_dir and ensure it's a Path object
         workflow_dir_path = config.get("workflow_dir", "workflows")
@@ -312,7 +709,7 @@ class LocalGenerator(BaseGenerator):
         logger.debug(f"Workflow directory set to: {self.workflow_dir}")
         os.makedirs(self.workflow_dir, exist_ok=True)
         
-        self.comfyui_output_node_id = None 
+        self._default_template = None # Compiled fallback workflow, built on first use
         self.is_comfyui_available = self._check_comfyui_connection()
         
         if not self.is_comfyui_available:
@@ -324,7 +721,7 @@ class LocalGenerator(BaseGenerator):
         Check if ComfyUI is available
         """
         try:
-            response = requests.get(f"http://{self.comfyui_host}:{self.comfyui_port}/")
+            response = requests.get(f"{self.base_comfyui_url}/")
             if response.status_code == 200:
                 logger.info("ComfyUI is available")
             else:
@@ -335,7 +732,42 @@ class LocalGenerator(BaseGenerator):
             logger.warning("Make sure ComfyUI is running and accessible")
             return False
     
-    async def generate_image(self, reference_image_path, prompt, style_params, output_path):
+    def backend_key(self, style_params):
+        return self.base_comfyui_url
+
+    def queue_depth(self):
+        """ Prompts running or pending on the ComfyUI server, other clients' included (status hub). """
+        return self.status_hub.queue_remaining or 0
+
+    def model_signature(self, style_params):
+        """ Models referenced by the style's workflow, plus the style LoRA. """
+        workflow = self._load_workflow_template(style_params)
+        if workflow:
+            workflow, _ = self._update_workflow_params(workflow, None, "", style_params, seed=0)
+        return model_signature(workflow or {}, [style_params.get("lora_name")])
+
+    def describe_request(self, reference_image_path, prompt, style_params, seed):
+        """
+        Describe a local generation by its fully resolved, normalized workflow.
+        
+        Args:
+            reference_image_path (str): Path to the reference image
+            prompt (str): Text prompt for generation
+            style_params (dict): Style parameters
+            seed (int): Sampler seed
+            
+        Returns:
+            dict: Request description containing the normalized workflow
+        """
+        workflow = self._load_workflow_template(style_params)
+        if workflow:
+            workflow, _ = self._update_workflow_params(workflow, reference_image_path, prompt, style_params, seed=seed)
+        return {
+            "generator": type(self).__name__,
+            "workflow": normalize_workflow(workflow),
+        }
+    
+    async def generate_image(self, reference_image_path, prompt, style_params, output_path, seed=None):
         """
         Generate an image using ComfyUI via API Manager.
         
@@ -344,6 +776,7 @@ class LocalGenerator(BaseGenerator):
             prompt (str): Text prompt for generation
             style_params (dict): Style parameters
             output_path (Path): Path to save the generated image
+            seed (int, optional): Sampler seed
             
         Returns:
             str or None: Path to the generated image or None on failure
@@ -355,56 +788,76 @@ class LocalGenerator(BaseGenerator):
                  logger.error("Failed to load or create a workflow.")
                  return self._create_placeholder_image(output_path)
 
+            # ComfyUI only sees its own input folder: upload the reference (skipped if already there)
+            reference_input_name = None
+            if reference_image_path:
+                reference_input_name = await self.upload_manager.ensure_uploaded_async(reference_image_path)
+
             # Update workflow with parameters (needs ModelManager)
-            workflow, output_node_id = self._update_workflow_params(workflow, reference_image_path, prompt, style_params)
-            self.comfyui_output_node_id = output_node_id # Store for result fetching
+            workflow, output_node_id = self._update_workflow_params(workflow, reference_input_name, prompt, style_params, seed=seed)
+
+            # Reject workflows the server cannot run (unknown nodes, miswired inputs, missing models)
+            if workflow and self.validator:
+                problems = await self.validator.validate_async(workflow)
+                if problems:
+                    logger.error(f"Workflow rejected before submission to {self.base_comfyui_url}: " + "; ".join(problems))
+                    return self._create_placeholder_image(output_path)
 
-            # 4. Submit workflow to ComfyUI via WebSocket/API
+            # 4. Queue the workflow with ComfyUI (unless the job was cancelled meanwhile)
+            check_cancelled()
             logger.debug(f"Submitting workflow for prompt: {prompt[:50]}...")
-            prompt_id = await self._submit_workflow_ws(workflow)
+            prompt_id = await self._submit_workflow(workflow)
 
             if not prompt_id:
                 logger.error("Failed to submit workflow to ComfyUI.")
-                self._create_placeholder_image(output_path)
-                return False
+                return self._create_placeholder_image(output_path)
 
-            logger.info(f"Workflow submitted via WebSocket. Prompt ID: {prompt_id}")
+            logger.info(f"Workflow submitted. Prompt ID: {prompt_id}")
 
-            # 5. Wait for completion signal via WebSocket, then fetch image via HTTP /view
-            image_details = await self._wait_for_completion_ws(prompt_id)
+            # 5. Wait for completion (status hub events), then fetch image via HTTP /view
+            # Cancelling the job removes the prompt from ComfyUI and releases this wait
+            # The job may journal the prompt (with what is needed to collect it) to reattach after a restart
+            track_prompt(prompt_id, self.base_comfyui_url, on_cancel=self.status_hub.mark_interrupted,
+                         seed=seed, output_node_id=output_node_id)
+            try:
+                image_details = await self._wait_for_completion(prompt_id, output_node_id)
+            finally:
+                release_prompt(prompt_id)
+            if not image_details:
+                check_cancelled()
 
             if image_details:
                  logger.info(f"Workflow completed. Fetching image via HTTP /view: {image_details}")
-                 image_data = await self._fetch_image_http(image_details)
+                 saved_path = await self._fetch_image_http(image_details, output_path)
             else:
-                 logger.error(f"Did not receive completion details or image info via WebSocket for {prompt_id}.")
-                 image_data = None
-
-            if image_data:
-                 # Save the received image data to the final output path
-                 with open(output_path, "wb") as f:
-                     f.write(image_data)
-                 logger.info(f"Image successfully generated by ComfyUI and saved to: {output_path}")
-                 return str(output_path)
+                 logger.error(f"Did not receive completion details or image info for {prompt_id}.")
+                 saved_path = None
+
+            if saved_path:
+                 logger.info(f"Image successfully generated by ComfyUI and saved to: {saved_path}")
+                 return saved_path
             else:
                  logger.error(f"Failed to retrieve image result from ComfyUI for prompt ID: {prompt_id}")
                  return self._create_placeholder_image(output_path)
 
+        except GenerationCancelled:
+            raise
         except Exception as e:
             logger.error(f"Error during local image generation with ComfyUI: {e}", exc_info=True)
             return self._create_placeholder_image(output_path)
     
     def _load_workflow_template(self, style_params):
         """
-        Load the appropriate workflow template based on style parameters
+        Load the compiled workflow template for the style parameters
+        
+        Templates are compiled once and recompiled only when the file changes.
         
         Args:
             style_params (dict): Style parameters
             
         Returns:
-            dict or None: Workflow template or None if loading fails
+            CompiledWorkflow or None: Compiled template or None if loading fails
         """
-        logger.debug("Loading workflow template...")
         # Check if self.workflow_dir exists before using it
         if not hasattr(self, 'workflow_dir') or not self.workflow_dir:
              logger.error("_load_workflow_template called but self.workflow_dir is not set!")
@@ -412,23 +865,21 @@ class LocalGenerator(BaseGenerator):
              
         template_name = style_params.get("workflow_template", "default_controlnet.json")
         template_path = self.workflow_dir / template_name
-        logger.debug(f"Attempting to load workflow from: {template_path}")
         
         if not template_path.is_file():
-            logger.warning(f"Workflow template {template_path} not found. Attempting to create default.")
-            try:
-                return self._create_default_workflow()
-            except Exception as e_create:
-                logger.error(f"Failed to create default workflow: {e_create}")
-                return None
+            if self._default_template is None:
+                logger.warning(f"Workflow template {template_path} not found. Attempting to create default.")
+                try:
+                    self._default_template = CompiledWorkflow(self._create_default_workflow(), name="default")
+                except Exception as e_create:
+                    logger.error(f"Failed to create default workflow: {e_create}")
+                    return None
+            return self._default_template
         
         try:
-            with open(template_path, 'r') as f:
-                workflow = json.load(f)
-                logger.debug(f"Successfully loaded workflow template: {template_name}")
-            return workflow
-        except json.JSONDecodeError as e_json:
-            logger.error(f"Error decoding JSON from workflow file {template_path}: {e_json}")
+            return template_registry.get(template_path)
+        except WorkflowTemplateError as e_template:
+            logger.error(f"Invalid workflow template {template_path}: {e_template}")
             return None
         except Exception as e_load:
             logger.error(f"Error loading workflow file {template_path}: {e_load}")
@@ -453,14 +904,14 @@ class LocalGenerator(BaseGenerator):
             "4": {  # Prompt
                 "inputs": {
                     "text": "",  # Will be filled later
-                    "clip": ["3", 0]
+                    "clip": ["3", 1]
                 },
                 "class_type": "CLIPTextEncode"
             },
             "5": {  # Negative Prompt
                 "inputs": {
                     "text": "low quality, blurry, distorted, deformed",
-                    "clip": ["3", 0]
+                    "clip": ["3", 1]
                 },
                 "class_type": "CLIPTextEncode"
             },
@@ -470,26 +921,33 @@ class LocalGenerator(BaseGenerator):
                 },
                 "class_type": "LoadImage"
             },
-            "7": {  # ControlNet
+            "7": {  # ControlNet Loader
                 "inputs": {
+                    "control_net_name": self.config.get("models", {}).get("controlnet", "lllyasviel/control_v11p_sd15_scribble")
+                },
+                "class_type": "ControlNetLoader"
+            },
+            "12": {  # ControlNet Apply: the reference conditions the positive prompt
+                "inputs": {
+                    "conditioning": ["4", 0],
+                    "control_net": ["7", 0],
                     "image": ["6", 0],
-                    "model": self.config.get("models", {}).get("controlnet", "lllyasviel/control_v11p_sd15_scribble"),
                     "strength": 0.8
                 },
-                "class_type": "ControlNetLoader"
+                "class_type": "ControlNetApply"
             },
             "8": {  # Sampler
                 "inputs": {
                     "model": ["3", 0],
-                    "positive": ["4", 0],
+                    "positive": ["12", 0],
                     "negative": ["5", 0],
                     "latent_image": ["9", 0],
-                    "control_net": ["7", 0],
                     "seed": 42,
                     "steps": 20,
                     "cfg": 7.5,
                     "sampler_name": "euler_ancestral",
-                    "scheduler": "normal"
+                    "scheduler": "normal",
+                    "denoise": 1.0
                 },
                 "class_type": "KSampler"
             },
@@ -511,8 +969,7 @@ class LocalGenerator(BaseGenerator):
             "11": {  # Save Image
                 "inputs": {
                     "images": ["10", 0],
-                    "filename_prefix": "generated",
-                    "save_to": "output"
+                    "filename_prefix": "generated"
                 },
                 "class_type": "SaveImage"
             }
@@ -520,261 +977,184 @@ class LocalGenerator(BaseGenerator):
         
         return workflow
     
-    def _update_workflow_params(self, workflow, reference_image_path, prompt, style_params):
+    def _update_workflow_params(self, workflow, reference_image_path, prompt, style_params, seed=None):
         """
-        Update workflow with parameters
+        Instantiate the compiled workflow with the scene parameters
         
         Args:
-            workflow (dict): Workflow template
-            reference_image_path (str): Path to the processed reference image
+            workflow (CompiledWorkflow): Compiled workflow template
+            reference_image_path (str): Reference image as named in ComfyUI's input folder
             prompt (str): Text prompt for generation
             style_params (dict): Style parameters
+            seed (int, optional): Sampler seed
             
         Returns:
-            dict: Updated workflow
+            tuple: (workflow dict, output node id), or (None, None) on error
         """
-        output_node_id = None # Initialize here
-        negative_prompt = style_params.get("negative_prompt", "low quality, blurry") # Get negative prompt
-        
         try:
-        # Find the prompt node and update it
-        for node_id, node in workflow.items():
-            if node.get("class_type") == "CLIPTextEncode" and "positive" in node_id.lower():
-                node["inputs"]["text"] = prompt
-            
-            # Find the image loader node and update it
-            if node.get("class_type") == "LoadImage":
-                    node["inputs"]["image"] = reference_image_path
-            
-            # Update LoRA if specified in style parameters
-            if node.get("class_type") == "LoraLoader" and "lora_name" in style_params:
-                node["inputs"]["lora_name"] = style_params["lora_name"]
-                node["inputs"]["strength"] = style_params.get("lora_strength", 0.8)
-        
-            return workflow, output_node_id
+            return workflow.instantiate(
+                prompt=prompt,
+                negative_prompt=style_params.get("negative_prompt", "low quality, blurry"),
+                image=reference_image_path,
+                lora_name=style_params.get("lora_name") or None,
+                lora_strength=style_params.get("lora_strength", 0.8) if style_params.get("lora_name") else None,
+                seed=seed,
+                steps=style_params.get("steps"),
+                cfg=style_params.get("cfg_scale"),
+                sampler_name=style_params.get("sampler"),
+                width=style_params.get("width", self.resolution[0]),
+                height=style_params.get("height", self.resolution[1])
+            )
         except Exception as e:
             logger.error(f"Error updating workflow parameters: {e}", exc_info=True)
             return None, None
     
-    async def _submit_workflow_ws(self, workflow):
-        """Submits the workflow via WebSocket and returns the prompt_id."""
-        prompt_id = None
-        ws = None # Initialize ws
-        # Correctly construct the WebSocket URL from base host/port
-        url = f"ws://{self.comfyui_host}:{self.comfyui_port}/ws?clientId={self.comfyui_client_id}"
-        logger.debug(f"Attempting WebSocket connection to: {url}")
-
+    async def _submit_workflow(self, workflow, retry_missing_inputs=True):
+        """Queues the workflow with ComfyUI's /prompt endpoint and returns the prompt_id."""
+        url = f"{self.base_comfyui_url}/prompt"
+        # Events are only sent to the client id that queued the prompt: use the status hub's
+        payload = {"prompt": workflow, "client_id": self.status_hub.client_id}
+        error = None
         try:
-            async with aiohttp.ClientSession() as session:
-                # Set a reasonable connection timeout
-                async with session.ws_connect(url, timeout=10.0) as ws:
-                    logger.info("WebSocket connected for submission.")
-                    # Ensure client_id is included in the payload sent
-                    payload = {"prompt": workflow, "client_id": self.comfyui_client_id}
-                    await ws.send_json(payload)
-                    logger.debug("Workflow JSON sent via WebSocket.")
-
-                    # Wait briefly for the initial response containing the prompt_id
-                    # Set a timeout for receiving the prompt_id confirmation
-                    try:
-                        async for msg in ws.timeout(5.0): # Timeout for waiting for prompt_id
-                            if msg.type == aiohttp.WSMsgType.TEXT:
-                                data = json.loads(msg.data)
-                                logger.debug(f"WS RCV (submit): {data}") # Log received data
-                                # Check for 'status' type first, common for initial response
-                                if data.get("type") == "status" and isinstance(data.get("data"), dict) and data["data"].get("sid") == self.comfyui_client_id:
-                                     # This might just be a confirmation of connection, not prompt_id
-                                     logger.debug(f"Received status confirmation for client {self.comfyui_client_id}")
-                                     # Keep listening for the actual prompt execution message
-                                     pass
-                                # Check for 'execution_start' or 'status' containing prompt_id
-                                elif data.get("type") == "execution_start" and isinstance(data.get("data"), dict) and data["data"].get("prompt_id"):
-                                     prompt_id = data["data"]["prompt_id"]
-                                     logger.info(f"Workflow submitted via WebSocket (detected via 'execution_start'). Prompt ID: {prompt_id}")
-                                     break
-                                elif data.get("type") == "executing" and isinstance(data.get("data"), dict) and data["data"].get("prompt_id"):
-                                     # Sometimes the first message is already 'executing'
-                                     prompt_id = data["data"]["prompt_id"]
-                                     logger.info(f"Workflow submitted via WebSocket (detected via 'executing'). Prompt ID: {prompt_id}")
-                                     break
-                                # Add handling for potential error messages from ComfyUI here if needed
-                            elif msg.type == aiohttp.WSMsgType.ERROR:
-                                logger.error(f"WebSocket connection error during submission response: {ws.exception()}")
-                                break
-                            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING):
-                                 logger.warning("WebSocket closed unexpectedly while waiting for submission confirmation.")
-                                 break
-                    except asyncio.TimeoutError:
-                         logger.error("Timeout waiting for prompt_id confirmation after WebSocket submission.")
-
-                    if not prompt_id:
-                         logger.error("Did not receive prompt_id after WebSocket submission.")
-
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30.0)) as session:
+                async with session.post(url, json=payload) as response:
+                    if response.status != 200:
+                        error = await response.text()
+                        logger.error(f"ComfyUI rejected the workflow: {response.status} - {error}")
+                    else:
+                        data = await response.json()
+                        if data.get("node_errors"):
+                            error = json.dumps(data["node_errors"])
+                            logger.error(f"ComfyUI reported node errors: {data['node_errors']}")
         except asyncio.TimeoutError:
-             logger.error(f"Timeout connecting WebSocket for submission to {url}")
-        except aiohttp.ClientConnectorError as e:
-             logger.error(f"Connection error during WebSocket submission: {e}")
-        except Exception as e:
-            logger.error(f"Error submitting workflow via WebSocket: {e}", exc_info=True)
-        finally:
-            # Ensure websocket is closed if it was opened
-            if ws and not ws.closed:
-                await ws.close()
-                logger.debug("WebSocket closed after submission attempt.")
+            logger.error(f"Timeout submitting workflow to {url}")
+            return None
+        except aiohttp.ClientError as e:
+            logger.error(f"Connection error during workflow submission: {e}")
+            return None
 
+        if error is not None:
+            # Input folder cleaned on the ComfyUI side: upload the reference again, same name, same workflow
+            if retry_missing_inputs and await self.upload_manager.recover_missing_async(error):
+                logger.info("Missing ComfyUI input uploaded again, resubmitting the workflow.")
+                return await self._submit_workflow(workflow, retry_missing_inputs=False)
+            return None
+        prompt_id = data.get("prompt_id")
+        if prompt_id:
+            # Live previews are also published under the id of the job being run
+            token = current_cancel_token()
+            self.status_hub.track(prompt_id, **({"job_id": token.job_id} if token and token.job_id else {}))
         return prompt_id
 
-    async def _wait_for_completion_ws(self, prompt_id, timeout=180):
-        """Waits for workflow completion signal via WebSocket and returns image details."""
-        if not self.comfyui_output_node_id:
-             logger.error("Cannot get result: Output Node ID is not set.")
-             return None
+    async def _wait_for_completion(self, prompt_id, output_node_id=None, timeout=180):
+        """
+        Waits for the prompt to finish (via the status hub) and returns the output image details.
 
+        Args:
+            prompt_id (str): ComfyUI prompt id
+            output_node_id (str, optional): Output node of this prompt's workflow. Passed per call:
+                one generator serves concurrent prompts built from different templates.
+            timeout (float): Seconds to wait
+
+        Returns:
+            dict or None: filename, subfolder and type of the output image
+        """
         if not prompt_id:
              logger.error("Cannot wait for completion: Invalid prompt_id provided.")
              return None
-        
-        image_details = None
-        start_time = time.time()
-        ws = None # Initialize ws
-        # Correctly construct the WebSocket URL from base host/port
-        url = f"ws://{self.comfyui_host}:{self.comfyui_port}/ws?clientId={self.comfyui_client_id}"
-        logger.debug(f"Attempting WebSocket connection to monitor prompt {prompt_id}: {url}")
 
-        try:
-            async with aiohttp.ClientSession() as session:
-                 # Set a reasonable connection timeout
-                 async with session.ws_connect(url, timeout=10.0) as ws:
-                    logger.info(f"WebSocket connected to monitor prompt {prompt_id}.")
-
-                    while time.time() - start_time < timeout:
-                        remaining_time = timeout - (time.time() - start_time)
-                        if remaining_time <= 0:
-                             logger.error(f"Overall timeout ({timeout}s) reached waiting for completion signal for prompt {prompt_id}")
-                             break
-
-                        try:
-                             # Use remaining time for receive timeout, minimum 1s
-                             msg = await ws.receive(timeout=max(1.0, remaining_time))
-                        except asyncio.TimeoutError:
-                             # This is expected if no message arrives within the receive timeout
-                             logger.debug(f"WebSocket receive timeout while waiting for prompt {prompt_id}. Continuing to wait.")
-                             continue # Continue loop until overall timeout
-
-                        # Handle different message types
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            try:
-                                data = json.loads(msg.data)
-                                msg_type = data.get("type")
-                                msg_data = data.get("data", {})
-
-                                # --- LOGGING (Improved) ---
-                                log_prefix = f"WS RCV Prmpt {prompt_id}:"
-                                log_content = f"Type={msg_type}"
-                                if isinstance(msg_data, dict):
-                                     current_msg_prompt_id = msg_data.get("prompt_id")
-                                     node_id = msg_data.get("node")
-                                     # Only log details if it matches our prompt_id
-                                     if current_msg_prompt_id == prompt_id:
-                                          if msg_type == "progress":
-                                               log_content += f", Node={node_id}, value={msg_data.get('value')}, max={msg_data.get('max')}"
-                                          elif msg_type == "executing":
-                                               log_content += f", Node={node_id}" # Prompt ID is already known
-                                          elif msg_type == "executed":
-                                               log_content += f", Node={node_id}, outputs={list(msg_data.get('outputs', {}).keys())}"
-                                          elif msg_type == "status":
-                                               q_rem = msg_data.get("status", {}).get("exec_info", {}).get("queue_remaining", "N/A")
-                                               log_content += f", Queue={q_rem}"
-                                          else: # Other types or unexpected format
-                                               log_content += f", DataKeys={list(msg_data.keys())}"
-                                     else:
-                                          # Minimal log for messages belonging to other prompts
-                                          log_content += f" (Ignoring msg for prompt {current_msg_prompt_id})"
-                                elif msg_data is not None:
-                                     log_content += f", Data={str(msg_data)[:100]}" # Log snippet if not dict
-                                else:
-                                    log_content += ", Data=None"
-
-                                logger.debug(f"{log_prefix} {log_content}")
-                                # --- END LOGGING ---
-
-                                # Check if the message is for the prompt we are interested in
-                                if isinstance(msg_data, dict) and msg_data.get("prompt_id") == prompt_id:
-                                    if msg_type == "executed":
-                                        executed_node_id = msg_data.get("node")
-                                        # IMPORTANT: Ensure self.comfyui_output_node_id is correct!
-                                        if executed_node_id == self.comfyui_output_node_id:
-                                            logger.info(f"Execution finished signal received for TARGET output node {self.comfyui_output_node_id} (Prompt ID: {prompt_id}).")
-                                            outputs = msg_data.get("outputs", {})
-                                            if outputs.get("images"):
-                                                # Assuming the first image is the one we want
-                                                image_info = outputs["images"][0]
-                                                filename = image_info.get("filename")
-                                                subfolder = image_info.get("subfolder", "") # ComfyUI uses subfolders
-                                                img_type = image_info.get("type", "temp") # Usually 'temp' or 'output'
-
-                                                if filename:
-                                                    logger.info(f"Image details found in execution signal: filename={filename}, subfolder={subfolder}, type={img_type}")
-                                                    image_details = {
-                                                         "filename": filename,
-                                                         "subfolder": subfolder,
-                                                         "type": img_type
-                                                    }
-                                                    break # SUCCESS: Got the details, exit loop
-                                                else:
-                                                    logger.error("Execution signal for target node received, but 'filename' missing in image output details.")
-                                            else:
-                                                logger.error("Execution signal for target node received, but 'images' field missing or empty in output.")
-                                            
-                                            # Exit loop even if details weren't found, as our node finished (likely error state)
-                                            if not image_details:
-                                                 logger.error(f"Exiting wait loop because target node {self.comfyui_output_node_id} executed but failed to yield image details.")
-                                            break # Exit loop
-
-                                    # Optional: Check for error messages specific to this prompt_id
-                                    # (Needs knowledge of ComfyUI error message format via WS)
-
-                            except json.JSONDecodeError:
-                                logger.warning(f"Received non-JSON text message: {msg.data}")
-                            except Exception as parse_e:
-                                logger.error(f"Error parsing WebSocket message: {parse_e}", exc_info=True)
-
-                        elif msg.type == aiohttp.WSMsgType.ERROR:
-                            logger.error(f"WebSocket connection error while waiting for prompt {prompt_id}: {ws.exception()}")
-                            break # Exit loop on error
-                        elif msg.type == aiohttp.WSMsgType.CLOSED:
-                             logger.warning(f"WebSocket connection closed by server while waiting for prompt {prompt_id}.")
-                             break # Exit loop
-                        elif msg.type == aiohttp.WSMsgType.CLOSING:
-                             logger.warning(f"WebSocket connection closing while waiting for prompt {prompt_id}.")
-                             break # Exit loop
-
-            # Check if we successfully got image_details after the loop
-            if not image_details:
-                # Log error only if we didn't break due to timeout (already logged)
-                if remaining_time > 0:
-                     logger.error(f"Loop finished for prompt {prompt_id} without extracting image details (target node execution signal not found or details missing).")
+        state = await self.status_hub.wait(prompt_id, timeout=timeout)
+        if state is None:
+            logger.error(f"Timeout after {timeout}s waiting for prompt {prompt_id}.")
+            return None
+        if state["status"] != "completed":
+            logger.error(f"Prompt {prompt_id} ended with status '{state['status']}': {state.get('error')}")
+            return None
 
-        except asyncio.TimeoutError:
-            # This catches the connection timeout
-            logger.error(f"Timeout connecting WebSocket to monitor prompt {prompt_id} at {url}")
-        except aiohttp.ClientConnectorError as e:
-            logger.error(f"Connection error during WebSocket monitoring for {prompt_id}: {e}")
-        except Exception as e:
-            # Catch any other unexpected errors during the wait loop
-            logger.error(f"Unexpected error during WebSocket result retrieval for {prompt_id}: {e}", exc_info=True)
-            image_details = None # Ensure details are None on error
-        finally:
-            # Ensure websocket is closed if it was opened
-            if ws and not ws.closed:
-                await ws.close()
-                logger.debug(f"WebSocket closed after monitoring attempt for {prompt_id}.")
+        # Prefer the images of the workflow's output node, then any image produced
+        images = state["outputs"].get(output_node_id) or state["images"]
+        if not images or not images[0].get("filename"):
+            logger.error(f"Prompt {prompt_id} completed without image output.")
+            return None
+        image_info = images[0]
+        return {
+            "filename": image_info["filename"],
+            "subfolder": image_info.get("subfolder", ""),
+            "type": image_info.get("type", "output")
+        }
 
+    async def reattach(self, prompt_id, output_path, seed=None, output_node_id=None, timeout=600, poll_interval=2.0):
+        """
+        Collect the image of a prompt queued on this server before a restart.
+
+        The prompt's events went to the client id of the previous process: it is
+        followed through /queue and /history, the status hub only releasing the wait
+        when the prompt is cancelled.
+
+        Args:
+            prompt_id (str): ComfyUI prompt id
+            output_path (str or Path): Where to save the image
+            seed (int, optional): Seed the prompt was queued with (journaled again with it)
+            output_node_id (str, optional): Output node of the prompt's workflow
+            timeout (float): Seconds to wait for the prompt to finish
+            poll_interval (float): Seconds between two checks of /history
 
-        return image_details # Return details dict or None
+        Returns:
+            str or None: Saved image, None if ComfyUI no longer knows the prompt (it restarted),
+                the prompt failed or did not finish in time
+        """
+        track_prompt(prompt_id, self.base_comfyui_url, on_cancel=self.status_hub.mark_interrupted,
+                     seed=seed, output_node_id=output_node_id)
+        deadline = time.monotonic() + timeout
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10.0)) as session:
+                while True:
+                    # Queue first: a prompt leaves the queue only once its history is written
+                    async with session.get(f"{self.base_comfyui_url}/queue") as response:
+                        response.raise_for_status()
+                        queue = await response.json()
+                    queued = any(len(item) > 1 and item[1] == prompt_id
+                                 for item in queue.get("queue_running", []) + queue.get("queue_pending", []))
+                    async with session.get(f"{self.base_comfyui_url}/history/{prompt_id}") as response:
+                        response.raise_for_status()
+                        history = (await response.json()).get(prompt_id)
+                    if history:
+                        break
+                    if not queued:
+                        logger.info(f"Prompt {prompt_id} is unknown to {self.base_comfyui_url}: it will be queued again.")
+                        return None
+                    if time.monotonic() >= deadline:
+                        logger.error(f"Timeout after {timeout}s waiting for reattached prompt {prompt_id}.")
+                        return None
+                    state = await self.status_hub.wait(prompt_id, timeout=poll_interval)
+                    if state is not None:
+                        if state["status"] == "interrupted":
+                            check_cancelled()
+                            logger.warning(f"Reattached prompt {prompt_id} was interrupted.")
+                            return None
+                        await asyncio.sleep(poll_interval)
+        finally:
+            release_prompt(prompt_id)
 
-    async def _fetch_image_http(self, image_details):
-        """ Fetches the image data from ComfyUI /view endpoint using HTTP GET. """
+        if history.get("status", {}).get("status_str") == "error":
+            logger.error(f"Reattached prompt {prompt_id} failed on {self.base_comfyui_url}.")
+            return None
+        outputs = history.get("outputs", {})
+        # The workflow's output node, else any saved (not preview) image
+        images = (outputs.get(output_node_id) or {}).get("images") or [
+            image for output in outputs.values() for image in output.get("images", [])
+            if image.get("type", "output") == "output"
+        ]
+        if not images or not images[0].get("filename"):
+            logger.error(f"Reattached prompt {prompt_id} completed without image output.")
+            return None
+        logger.info(f"Reattached to prompt {prompt_id}: fetching its image {images[0]['filename']}")
+        image_details = {"filename": images[0]["filename"], "subfolder": images[0].get("subfolder", ""),
+                         "type": images[0].get("type", "output")}
+        return await self._fetch_image_http(image_details, output_path)
+
+    async def _fetch_image_http(self, image_details, output_path):
+        """ Streams the image from ComfyUI /view endpoint to output_path. Returns the path or None. """
         if not image_details or not image_details.get("filename"):
              logger.error("Cannot fetch image: Invalid image_details provided.")
              return None
@@ -784,9 +1164,7 @@ class LocalGenerator(BaseGenerator):
         subfolder = image_details.get("subfolder", "")
         img_type = image_details.get("type", "temp") # Default to 'temp' if not specified
 
-        # Construct base URL correctly
-        base_url = f"http://{self.comfyui_host}:{self.comfyui_port}"
-        url = f"{base_url}/view"
+        url = f"{self.base_comfyui_url}/view"
         # Parameters should be URL-encoded by aiohttp automatically
         params = {"filename": filename, "type": img_type}
         if subfolder: # Only include subfolder if it's not empty
@@ -795,26 +1173,12 @@ class LocalGenerator(BaseGenerator):
         logger.info(f"Fetching image from ComfyUI: {url} with params: {params}")
 
         try:
-             # Consider adding a timeout for the image download request
-             async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120.0)) as session: # 2 min timeout
-                  async with session.get(url, params=params) as response:
-                       if response.status == 200:
-                            image_data = await response.read()
-                            if not image_data:
-                                 logger.error(f"Error fetching image {filename}: Received empty response (0 bytes).")
-                                 return None
-                            logger.info(f"Successfully fetched {len(image_data)} bytes for image {filename}.")
-                            return image_data
-                       else:
-                            # Log the error response body for more details
-                            error_body = await response.text()
-                            logger.error(f"Error fetching image {filename} from ComfyUI /view: {response.status} - {error_body}")
-                            return None
-        except asyncio.TimeoutError:
-             logger.error(f"Timeout during HTTP image fetch for {filename} from {url}")
-             return None
-        except aiohttp.ClientConnectorError as e:
-             logger.error(f"Connection error during HTTP image fetch for {filename}: {e}")
+             # Streamed to a temp file, checked, then renamed into place (2 min timeout)
+             saved_path = await download_to_file(url, output_path, params=params, timeout=120.0)
+             logger.info(f"Successfully fetched image {filename} to {saved_path}.")
+             return saved_path
+        except DownloadError as e:
+             logger.error(f"Error fetching image {filename} from ComfyUI /view: {e}")
              return None
         except Exception as e:
              logger.error(f"Exception during HTTP image fetch for {filename}: {e}", exc_info=True)
@@ -838,7 +1202,21 @@ class CloudGenerator(BaseGenerator):
         self.api_provider_config = config.get("cloud_providers", {}) # Store provider specific configs
         self.default_provider = config.get("default_cloud_provider", "openai") # Default if not specified by style
 
-    async def generate_image(self, reference_image_path, prompt, style_params, output_path):
+    def backend_key(self, style_params):
+        return f"cloud:{style_params.get('cloud_api_provider', self.default_provider).lower()}"
+
+    def has_credentials(self, style_params):
+        """ Returns True if an API key is configured for the style's provider. """
+        provider = style_params.get("cloud_api_provider", self.default_provider).lower()
+        return bool(self.config.get("api_keys_encrypted", {}).get(provider) or self.config.get("api_keys", {}).get(provider))
+
+    def describe_request(self, reference_image_path, prompt, style_params, seed):
+        """ Describe a cloud generation by provider, model and base request fields. """
+        request = super().describe_request(reference_image_path, prompt, style_params, seed)
+        request["provider"] = style_params.get("cloud_api_provider", self.default_provider).lower()
+        return request
+
+    async def generate_image(self, reference_image_path, prompt, style_params, output_path, seed=None):
         """
         Generate an image using a cloud API via API Manager.
         
@@ -847,9 +1225,10 @@ class CloudGenerator(BaseGenerator):
             prompt (str): Text prompt for generation
             style_params (dict): Style parameters
             output_path (Path): Path to save the generated image
+            seed (int, optional): Seed, forwarded to providers that support it
             
         Returns:
-            bool: True if image generation succeeded, False otherwise
+            str or None: Path to the generated image or None on failure
         """
         provider = style_params.get("cloud_api_provider", self.default_provider).lower()
         logger.info(f"Generating image using cloud provider: {provider}")
@@ -865,8 +1244,7 @@ class CloudGenerator(BaseGenerator):
 
         if not decrypted_key:
             logger.error(f"API key for cloud provider '{provider}' not found or couldn't be decrypted.")
-            self._create_placeholder_image(output_path)
-            return False # Cloud generation failed
+            return self._create_placeholder_image(output_path)
 
         # Register API with manager (it might already be registered from startup)
         provider_conf = self.api_provider_config.get(provider, {})
@@ -886,28 +1264,29 @@ class CloudGenerator(BaseGenerator):
             if provider == "openai":
                 image_data = await self._generate_with_openai(reference_image_path, prompt, style_params)
             elif provider == "midjourney":
-                image_data = await self._generate_with_midjourney(reference_image_path, prompt, style_params)
+                image_data = await self._generate_with_midjourney(reference_image_path, prompt, style_params, output_path)
             # Add elif for other providers (DALL-E 3, Stability, etc.)
             else:
                 logger.error(f"Unsupported cloud API provider specified: {provider}")
-                self._create_placeholder_image(output_path)
-                return False # Cloud generation failed
+                return self._create_placeholder_image(output_path)
             
-            if image_data and isinstance(image_data, bytes):
-            # Save the image
-            with open(output_path, "wb") as f:
-                f.write(image_data)
+            if image_data and isinstance(image_data, str):
+                # Already downloaded to output_path
+                logger.info(f"Cloud generated image saved to: {image_data}")
+                return image_data
+            elif image_data and isinstance(image_data, bytes):
+                # Save the image
+                with open(output_path, "wb") as f:
+                    f.write(image_data)
                 logger.info(f"Cloud generated image saved to: {output_path}")
-                return True # Cloud generation success
+                return str(output_path) # Cloud generation success
             else:
                  logger.error(f"Cloud generation with {provider} failed or returned invalid data.")
-                 self._create_placeholder_image(output_path)
-                 return False # Cloud generation failed
+                 return self._create_placeholder_image(output_path)
             
         except Exception as e:
             logger.error(f"Error generating image with cloud API '{provider}': {e}", exc_info=True)
-            self._create_placeholder_image(output_path)
-            return False # Cloud generation failed
+            return self._create_placeholder_image(output_path)
     
     async def _generate_with_openai(self, reference_image_path, prompt, style_params):
         """
@@ -959,36 +1338,62 @@ class CloudGenerator(BaseGenerator):
             else: # Assume DALL-E 2 Image Edit endpoint
                  logger.info("Using OpenAI DALL-E 2 Image Edit API")
                  endpoint_suffix = "/images/edits"
-                 # Requires multipart/form-data
-                 # Need a way for APIManager or here to handle multipart uploads async
-                 # TODO: Implement async multipart upload similar to comfyui upload
-
-                 # Placeholder - This part needs rework for async multipart
-                 logger.warning("DALL-E 2 async multipart upload not fully implemented yet.")
+                 loop = asyncio.get_running_loop()
+                 edit_image_path = await loop.run_in_executor(None, self._prepare_openai_edit_image, reference_image_path)
                  try:
-                     import openai # Use official lib as fallback TEMPORARILY? NO - stick to APIManager
-                     logger.error("Fallback to openai library is deprecated. Need async multipart in APIManager.")
-                     # Fallback simulation (REMOVE THIS LATER)
-                     # openai.api_key = api_key
-                     # with open(reference_image_path, "rb") as image_file:
-                     #     response = openai.Image.create_edit(
-                     #         image=image_file,
-                     #         prompt=prompt,
-                     #         n=1,
-                     #         size=f"{self.resolution[0]}x{self.resolution[1]}",
-                     #         response_format="b64_json"
-                     #     )
-                     # return base64.b64decode(response['data'][0]['b64_json'])
-                     return None # Return None until implemented
-                 except Exception as fallback_e:
-                      logger.error(f"Error during DALL-E 2 fallback attempt: {fallback_e}")
-                      return None
+                     # Streamed multipart upload, with retries and the provider's concurrency limit
+                     response = await self.api_manager.call_api(
+                         "openai", method="POST", endpoint_suffix=endpoint_suffix,
+                         data={
+                             "prompt": prompt,
+                             "n": 1,
+                             "size": f"{OPENAI_EDIT_SIZE}x{OPENAI_EDIT_SIZE}",
+                             "response_format": "b64_json"
+                         },
+                         files={"image": (edit_image_path, "image/png")},
+                         headers=headers,
+                         timeout=120
+                     )
+                 finally:
+                     os.remove(edit_image_path)
+
+                 if response and response.get("data") and response["data"][0].get("b64_json"):
+                     return base64.b64decode(response["data"][0]["b64_json"])
+                 logger.error(f"OpenAI DALL-E 2 edit call failed or returned unexpected data: {str(response)[:200]}")
+                 return None
 
         except Exception as e:
             logger.error(f"Error generating image with OpenAI: {e}", exc_info=True)
             return None
     
-    async def _generate_with_midjourney(self, reference_image_path, prompt, style_params):
+    @staticmethod
+    def _prepare_openai_edit_image(reference_image_path):
+        """
+        Convert a reference image to what the DALL-E 2 edit endpoint accepts: a square RGBA PNG.
+        
+        The edit endpoint repaints the transparent areas, so the white background of
+        the storyboard panel becomes transparent and its lines are kept.
+        
+        Args:
+            reference_image_path (str): Path to the processed reference image
+            
+        Returns:
+            str: Path to a temporary PNG (deleted by the caller)
+        """
+        with Image.open(reference_image_path) as img:
+            img = img.convert("RGBA")
+            img.thumbnail((OPENAI_EDIT_SIZE, OPENAI_EDIT_SIZE))
+            canvas = Image.new("RGBA", (OPENAI_EDIT_SIZE, OPENAI_EDIT_SIZE), (255, 255, 255, 0))
+            canvas.paste(img, ((OPENAI_EDIT_SIZE - img.width) // 2, (OPENAI_EDIT_SIZE - img.height) // 2))
+        luminance = canvas.convert("L")
+        alpha = luminance.point(lambda value: 0 if value > 240 else 255)
+        canvas.putalpha(Image.composite(alpha, Image.new("L", canvas.size, 0), canvas.getchannel("A")))
+        fd, tmp_path = tempfile.mkstemp(prefix="openai-edit-", suffix=".png")
+        with os.fdopen(fd, "wb") as f:
+            canvas.save(f, format="PNG", optimize=True)
+        return tmp_path
+
+    async def _generate_with_midjourney(self, reference_image_path, prompt, style_params, output_path):
         """
         Generate an image using a Midjourney API (if available).
         Note: Midjourney does not have an official public API as of last check.
@@ -998,9 +1403,10 @@ class CloudGenerator(BaseGenerator):
             reference_image_path (str): Path to the processed reference image
             prompt (str): Text prompt for generation
             style_params (dict): Style parameters
+            output_path (Path): Path to save the generated image
             
         Returns:
-            bytes or None: Image data as bytes, or None on failure.
+            str or None: Path to the downloaded image, or None on failure.
         """
         logger.warning("Midjourney API interaction is hypothetical or relies on unofficial APIs.")
         provider = "midjourney"
@@ -1031,11 +1437,8 @@ class CloudGenerator(BaseGenerator):
                  # Assuming API returns a URL to the generated image
                  image_url = response["image_url"]
                  logger.info(f"Midjourney task submitted, image URL: {image_url}")
-                 # Need to download the image from the URL
-                 # Use requests or aiohttp via APIManager?
-                 img_response = requests.get(image_url, timeout=60) # Simple sync download for now
-                 img_response.raise_for_status()
-                 return img_response.content
+                 # Stream the image to disk without blocking the event loop
+                 return await download_to_file(image_url, output_path, timeout=60)
             else:
                  logger.error(f"Midjourney API call failed or returned unexpected data: {response}")
                  return None
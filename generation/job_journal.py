@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generation Job Journal
+
+Append-only JSON Lines log of generation jobs: job creation (with what is
+needed to run it again), per-scene submission (ComfyUI prompt_id and seed),
+per-scene completion and job end. Each record is flushed and fsynced before
+the call returns, so after a crash or restart the journal can be replayed to
+rebuild the state of every job, reattach to prompts ComfyUI is still running
+and resume only the unfinished scenes.
+
+A torn last line (crash in the middle of a write) is ignored on replay.
+Finished jobs are dropped when the journal is compacted at startup.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+FINISHED_JOB_STATUSES = {"completed", "error", "cancelled"}
+
+
+class JobJournal:
+    """Crash-safe, append-only record of generation jobs and their scenes."""
+
+    def __init__(self, path):
+        """
+        Initialize the journal
+
+        Args:
+            path (str or Path): JSON Lines file (created on first write)
+        """
+        self.path = Path(path)
+        os.makedirs(self.path.parent, exist_ok=True)
+        self._lock = threading.RLock()
+        self._tail_checked = False
+
+    # --- Writing ---
+
+    def _append(self, record):
+        record["ts"] = time.time()
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if not self._tail_checked:
+                # A torn last line must not swallow the next record
+                self._tail_checked = True
+                if self.path.exists() and self.path.stat().st_size > 0:
+                    with open(self.path, 'rb') as f:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            line = "\n" + line
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start_job(self, job_id, kind, params):
+        """
+        Record a new job.
+
+        Args:
+            job_id (str): Job identifier
+            kind (str): Job type, used on replay to pick the code that resumes it
+            params (dict): JSON-serializable parameters needed to run the job again
+        """
+        self._append({"type": "job", "job_id": job_id, "kind": kind, "params": params})
+
+    def scene_submitted(self, job_id, scene_key, prompt_id=None, **details):
+        """
+        Record that a scene was submitted to a backend.
+
+        Args:
+            job_id (str): Job identifier
+            scene_key (str): Scene identifier within the job
+            prompt_id (str, optional): ComfyUI prompt id, to reattach to the prompt after a restart
+            **details: Extra values needed to collect the result (seed, style...)
+        """
+        self._append({"type": "submitted", "job_id": job_id, "scene": str(scene_key),
+                      "prompt_id": prompt_id, "details": details})
+
+    def scene_done(self, job_id, scene_key, result):
+        """
+        Record the result of a scene (success or error).
+
+        Args:
+            job_id (str): Job identifier
+            scene_key (str): Scene identifier within the job
+            result (dict): JSON-serializable result
+        """
+        self._append({"type": "done", "job_id": job_id, "scene": str(scene_key), "result": result})
+
+    def end_job(self, job_id, status, message=None):
+        """
+        Record the end of a job.
+
+        Args:
+            job_id (str): Job identifier
+            status (str): Final status (completed, error, cancelled)
+            message (str, optional): Error message
+        """
+        self._append({"type": "end", "job_id": job_id, "status": status, "message": message})
+
+    # --- Reading ---
+
+    def _records(self):
+        if not self.path.exists():
+            return
+        with self._lock:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Only the last line can be torn by a crash; anything else is corruption worth a warning
+                log = logger.debug if number == len(lines) else logger.warning
+                log(f"Skipping unreadable line {number} of job journal {self.path}")
+
+    def replay(self):
+        """
+        Rebuild the state of every job from the journal.
+
+        Returns:
+            dict: job_id -> {"job_id", "kind", "params", "status", "message", "started", "scenes"},
+                where scenes maps a scene key to {"status": "submitted"|"done", "prompt_id",
+                "details", "result"}
+        """
+        jobs = {}
+        for record in self._records():
+            job_id = record.get("job_id")
+            record_type = record.get("type")
+            if record_type == "job":
+                jobs[job_id] = {"job_id": job_id, "kind": record.get("kind"), "params": record.get("params") or {},
+                                "status": "running", "message": None, "started": record.get("ts"), "scenes": {}}
+                continue
+            job = jobs.get(job_id)
+            if job is None:
+                continue
+            if record_type == "submitted":
+                job["scenes"][record["scene"]] = {"status": "submitted", "prompt_id": record.get("prompt_id"),
+                                                  "details": record.get("details") or {}, "result": None}
+            elif record_type == "done":
+                scene = job["scenes"].setdefault(record["scene"], {"prompt_id": None, "details": {}})
+                scene.update(status="done", result=record.get("result"))
+            elif record_type == "end":
+                job["status"] = record.get("status")
+                job["message"] = record.get("message")
+        return jobs
+
+    def job_state(self, job_id):
+        """ Returns the replayed state of one job, None if it is not in the journal. """
+        return self.replay().get(job_id)
+
+    def unfinished_jobs(self, kind=None):
+        """
+        Get the jobs that were interrupted before their end was recorded.
+
+        Args:
+            kind (str, optional): Only return jobs of this type
+
+        Returns:
+            list: Replayed job states, oldest first
+        """
+        return [job for job in self.replay().values()
+                if job["status"] not in FINISHED_JOB_STATUSES and (kind is None or job["kind"] == kind)]
+
+    def compact(self, keep_finished=0):
+        """
+        Rewrite the journal atomically, keeping only unfinished jobs (and the last finished ones).
+
+        Args:
+            keep_finished (int): Number of most recent finished jobs to keep
+        """
+        with self._lock:
+            records = list(self._records())
+            jobs = self.replay()
+            finished = [job_id for job_id, job in jobs.items() if job["status"] in FINISHED_JOB_STATUSES]
+            dropped = set(finished[:max(0, len(finished) - keep_finished)])
+            if not dropped:
+                return
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=".journal-", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    for record in records:
+                        if record.get("job_id") not in dropped:
+                            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                logger.info(f"Job journal compacted: {len(dropped)} finished job(s) dropped")
+            except Exception as e:
+                logger.warning(f"Could not compact job journal {self.path}: {e}")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_job_journal(path):
+    """
+    Get the shared journal stored at a path.
+
+    Args:
+        path (str or Path): JSON Lines file
+
+    Returns:
+        JobJournal: Journal shared by every caller in the process
+    """
+    key = str(Path(path).resolve())
+    with _journals_lock:
+        journal = _journals.get(key)
+        if journal is None:
+            journal = JobJournal(path)
+            _journals[key] = journal
+        return journal
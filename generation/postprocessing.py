@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generated Image Post-Processing Module
+
+Turns generated images into delivery files: resizing to the delivery
+resolution, colour normalization, watermarking (e.g. drafts) and conversion
+to the delivery format. Pipelines are declared per quality tier in the
+'postprocessing' config section and may be overridden per style:
+
+    "postprocess": {
+        "final": {"steps": [{"step": "resize", "width": 1920, "height": 1080, "mode": "fill"},
+                            {"step": "normalize", "method": "auto_levels"}],
+                  "format": "jpg", "quality": 92},
+        "draft": {"steps": [{"step": "watermark", "text": "DRAFT"}]}
+    }
+
+Each image is decoded once, every step works on the NumPy array in memory,
+and the delivery file is written once (atomically). The work runs in a
+process pool, so CPU-heavy steps never hold the GIL of the process running
+the generation event loop.
+
+Available steps:
+- resize: width, height, mode (fit, fill, stretch)
+- normalize: method (auto_levels, gray_world, clahe), clip (percent, auto_levels)
+- watermark: text, opacity, position (center, bottom_right), scale
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = {"png": ".png", "jpg": ".jpg", "jpeg": ".jpg", "webp": ".webp"}
+
+
+def _resize(img, width, height, mode="fit"):
+    """ Resize to the delivery resolution: fit inside it, fill it (center crop) or stretch to it. """
+    h, w = img.shape[:2]
+    if mode == "stretch":
+        size = (int(width), int(height))
+    else:
+        scale = (max if mode == "fill" else min)(width / w, height / h)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    interpolation = cv2.INTER_AREA if size[0] < w else cv2.INTER_LANCZOS4
+    img = cv2.resize(img, size, interpolation=interpolation)
+    if mode == "fill":
+        top, left = (img.shape[0] - int(height)) // 2, (img.shape[1] - int(width)) // 2
+        img = img[top:top + int(height), left:left + int(width)]
+    return img
+
+
+def _normalize(img, method="auto_levels", clip=0.5):
+    """ Colour normalization, so scenes rendered with different seeds match in tone. """
+    if method == "auto_levels":
+        # Per-channel stretch between the clip and 100-clip percentiles
+        low = np.percentile(img, clip, axis=(0, 1))
+        high = np.percentile(img, 100 - clip, axis=(0, 1))
+        scale = 255.0 / np.maximum(high - low, 1.0)
+        return np.clip((img.astype(np.float32) - low) * scale, 0, 255).astype(np.uint8)
+    if method == "gray_world":
+        means = img.reshape(-1, 3).mean(axis=0)
+        gains = means.mean() / np.maximum(means, 1.0)
+        return np.clip(img.astype(np.float32) * gains, 0, 255).astype(np.uint8)
+    if method == "clahe":
+        lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+        lab[:, :, 0] = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(lab[:, :, 0])
+        return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+    raise ValueError(f"Unknown normalization method '{method}'")
+
+
+def _watermark(img, text="DRAFT", opacity=0.35, position="center", scale=0.12):
+    """ Blend a text watermark into the image. """
+    h, w = img.shape[:2]
+    font = cv2.FONT_HERSHEY_DUPLEX
+    (text_w, text_h), _ = cv2.getTextSize(text, font, 1.0, 2)
+    font_scale = max(0.5, scale * w / max(text_w, 1))
+    thickness = max(1, int(font_scale * 2))
+    (text_w, text_h), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+    if position == "bottom_right":
+        origin = (w - text_w - w // 40, h - baseline - h // 40)
+    else:
+        origin = ((w - text_w) // 2, (h + text_h) // 2)
+    overlay = img.copy()
+    cv2.putText(overlay, text, origin, font, font_scale, (255, 255, 255), thickness + 2, cv2.LINE_AA)
+    cv2.putText(overlay, text, origin, font, font_scale, (40, 40, 40), thickness, cv2.LINE_AA)
+    return cv2.addWeighted(overlay, opacity, img, 1 - opacity, 0)
+
+
+STEPS = {
+    "resize": _resize,
+    "normalize": _normalize,
+    "watermark": _watermark,
+}
+
+
+def _encode_params(extension, quality):
+    if extension == ".jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    if extension == ".webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    return [cv2.IMWRITE_PNG_COMPRESSION, 3]
+
+
+def run_pipeline(source_path, pipeline, output_path):
+    """
+    Apply a pipeline to an image and write the result (runs in a worker process).
+
+    Args:
+        source_path (str): Generated image
+        pipeline (dict): Validated pipeline ({"steps", "format", "quality"})
+        output_path (str): Delivery file to write
+
+    Returns:
+        str: output_path
+    """
+    img = cv2.imread(str(source_path), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not load image: {source_path}")
+    for step in pipeline["steps"]:
+        params = {key: value for key, value in step.items() if key != "step"}
+        img = STEPS[step["step"]](img, **params)
+    extension = OUTPUT_FORMATS[pipeline["format"]]
+    ok, encoded = cv2.imencode(extension, img, _encode_params(extension, pipeline["quality"]))
+    if not ok:
+        raise IOError(f"Could not encode {source_path} as {pipeline['format']}")
+    # Written under a temporary name so readers never see a partial file
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp_path, output_path)
+    return str(output_path)
+
+
+# Process pool shared by every post-processor instance (generators are created per request)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned workers: forking a process that runs event loops and server threads is unsafe
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def _reset_executor(broken):
+    """ Drop a pool whose worker died (a new one is created on next use). """
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False)
+
+
+class PostProcessor:
+    """Applies the per-style, per-quality post-processing pipeline to generated images in a process pool."""
+
+    def __init__(self, config, output_dir):
+        """
+        Initialize the post-processor
+
+        Args:
+            config (dict): Configuration dictionary. Reads the optional
+                'postprocessing' section (workers, pipelines: {quality: pipeline}).
+            output_dir (str or Path): Directory of the generated images; delivery
+                files are written to its 'final' subdirectory
+        """
+        postprocessing_config = config.get("postprocessing", {}) or {}
+        self.pipelines = postprocessing_config.get("pipelines", {}) or {}
+        self.workers = int(postprocessing_config.get("workers", max(1, min(4, (os.cpu_count() or 2) // 2))))
+        self.output_dir = Path(output_dir) / "final"
+
+    @staticmethod
+    def validate(pipeline):
+        """
+        Check a pipeline definition and fill in its defaults.
+
+        Args:
+            pipeline (dict or list): {"steps": [...], "format", "quality"}, or a bare list of steps
+
+        Returns:
+            dict: Normalized pipeline
+
+        Raises:
+            ValueError: If a step or format is unknown
+        """
+        if isinstance(pipeline, list):
+            pipeline = {"steps": pipeline}
+        steps = list(pipeline.get("steps") or [])
+        for step in steps:
+            if not isinstance(step, dict) or step.get("step") not in STEPS:
+                raise ValueError(f"Unknown post-processing step {step!r}. Available: {sorted(STEPS)}")
+        output_format = str(pipeline.get("format", "png")).lower()
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}'. Available: {sorted(OUTPUT_FORMATS)}")
+        return {"steps": steps, "format": output_format, "quality": int(pipeline.get("quality", 92))}
+
+    def pipeline_for(self, style_params, quality):
+        """
+        Get the pipeline of a style and quality tier (the style's own, else the configured one).
+
+        Returns:
+            dict or None: Normalized pipeline, None when nothing is to be done
+        """
+        style_pipelines = (style_params or {}).get("postprocess") or {}
+        pipeline = style_pipelines.get(quality, self.pipelines.get(quality))
+        if not pipeline:
+            return None
+        pipeline = self.validate(pipeline)
+        if not pipeline["steps"] and pipeline["format"] == "png":
+            return None
+        return pipeline
+
+    def output_path(self, image_path, pipeline):
+        return self.output_dir / f"{Path(image_path).stem}{OUTPUT_FORMATS[pipeline['format']]}"
+
+    async def process_async(self, image_path, style_params=None, quality="final"):
+        """
+        Post-process a generated image in the process pool without blocking the event loop.
+
+        Args:
+            image_path (str): Generated image
+            style_params (dict, optional): Style parameters (may declare 'postprocess')
+            quality (str): Quality tier ("draft" or "final")
+
+        Returns:
+            str: Delivery file, or image_path when there is no pipeline or processing fails
+        """
+        try:
+            pipeline = self.pipeline_for(style_params, quality)
+        except ValueError as e:
+            logger.error(f"Invalid post-processing pipeline ({quality}): {e}")
+            return image_path
+        if pipeline is None:
+            return image_path
+        output_path = self.output_path(image_path, pipeline)
+        os.makedirs(output_path.parent, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        executor = _get_executor(self.workers)
+        try:
+            result = await loop.run_in_executor(executor, run_pipeline, str(image_path), pipeline, str(output_path))
+            logger.info(f"Post-processed {Path(image_path).name} -> {output_path}")
+            return result
+        except BrokenProcessPool as e:
+            _reset_executor(executor)
+            logger.error(f"Post-processing worker died on {image_path}: {e}")
+            return image_path
+        except Exception as e:
+            logger.error(f"Error post-processing {image_path}: {e}")
+            return image_path
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reference Image Preprocessing Module
+
+This module turns storyboard panels into ControlNet conditioning images.
+Preprocessing runs in a worker pool so it never blocks the asyncio loop that
+drives generation, and results are cached on disk by source image hash plus
+preprocessing parameters, so an unchanged panel is only processed once.
+The on-disk cache is bounded in size: least recently used files (by access
+time, refreshed on every hit) are removed when it exceeds its budget.
+
+Available preprocessors:
+- canny: thin Canny edges
+- scribble: thick, simplified strokes
+- lineart: pencil-sketch style lines (dodge blend of the inverted image)
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from generation.result_cache import cached_file_sha256
+
+logger = logging.getLogger(__name__)
+
+
+def _canny(gray, low_threshold=100, high_threshold=200):
+    """ Thin edge map (uint8, 255 = line). """
+    return cv2.Canny(gray, low_threshold, high_threshold)
+
+
+def _scribble(gray, blur=5, low_threshold=50, high_threshold=150, thickness=3):
+    """ Thick, simplified strokes (uint8, 255 = line). """
+    blur = blur | 1  # kernel size must be odd
+    smoothed = cv2.GaussianBlur(gray, (blur, blur), 0)
+    edges = cv2.Canny(smoothed, low_threshold, high_threshold)
+    kernel = np.ones((thickness, thickness), np.uint8)
+    return cv2.dilate(edges, kernel, iterations=1)
+
+
+def _lineart(gray, blur=21, threshold=240):
+    """ Pencil-sketch lines from a colour dodge of the inverted image (uint8, 255 = line). """
+    blur = blur | 1
+    inverted_blur = cv2.GaussianBlur(255 - gray, (blur, blur), 0)
+    sketch = cv2.divide(gray, 255 - inverted_blur, scale=256)
+    return np.where(sketch < threshold, 255, 0).astype(np.uint8)
+
+
+PREPROCESSORS = {
+    "canny": _canny,
+    "scribble": _scribble,
+    "lineart": _lineart,
+}
+
+# Worker pool shared by every preprocessor instance (generators are created per request)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # OpenCV releases the GIL in its heavy operations, threads are enough
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+        return _executor
+
+
+# Size of each preprocessing cache directory, scanned on first use: directory -> bytes
+_cache_sizes = {}
+_cache_sizes_lock = threading.Lock()
+
+
+def _directory_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def _prune_cache(directory, max_bytes, added_bytes):
+    """
+    Account for a new file in a cache directory and remove the least recently used
+    files once the directory exceeds max_bytes (down to 90% of it).
+    """
+    key = str(directory)
+    with _cache_sizes_lock:
+        if key not in _cache_sizes:
+            _cache_sizes[key] = _directory_size(directory)
+        else:
+            _cache_sizes[key] += added_bytes
+        if _cache_sizes[key] <= max_bytes:
+            return
+        files = sorted((entry.stat().st_atime, entry.path, entry.stat().st_size)
+                       for entry in os.scandir(directory) if entry.is_file() and not entry.name.startswith("."))
+        total = sum(size for _, _, size in files)
+        removed = 0
+        for _, path, size in files:
+            if total <= max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        _cache_sizes[key] = total
+    logger.info(f"Preprocessing cache {directory}: removed {removed} least recently used file(s), "
+                f"{total / 1e6:.1f} MB left")
+
+
+class ReferencePreprocessor:
+    """Preprocesses reference images for ControlNet in a worker pool, with an on-disk cache."""
+
+    def __init__(self, config, output_dir):
+        """
+        Initialize the preprocessor
+
+        Args:
+            config (dict): Configuration dictionary. Reads the optional
+                'preprocessing' section (method, params, workers, background, max_cache_mb).
+            output_dir (str or Path): Directory where processed images are cached
+        """
+        preprocessing_config = config.get("preprocessing", {}) or {}
+        self.resolution = config.get("resolution", [1024, 768])
+        self.default_method = preprocessing_config.get("method", "canny")
+        self.default_params = preprocessing_config.get("params", {})
+        # Lines are drawn black on a white background unless configured otherwise
+        self.background = preprocessing_config.get("background", "white")
+        self.cache_dir = Path(output_dir) / "preprocessed"
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_cache_bytes = int(preprocessing_config.get("max_cache_mb", 512)) * 1024 * 1024
+
+        workers = preprocessing_config.get("workers", min(8, (os.cpu_count() or 2)))
+        self._executor = _get_executor(workers)
+
+    def describe(self, style_params=None):
+        """
+        Describe the preprocessing applied for a style (used in cache keys).
+
+        Args:
+            style_params (dict, optional): Style parameters
+
+        Returns:
+            dict: Method, parameters, resolution and background
+        """
+        style_params = style_params or {}
+        method = style_params.get("preprocessor", self.default_method)
+        params = dict(self.default_params.get(method, {}))
+        params.update(style_params.get("preprocessor_params", {}))
+        return {
+            "method": method,
+            "params": params,
+            "resolution": list(self.resolution),
+            "background": self.background,
+        }
+
+    def _cache_path(self, source_hash, description):
+        serialized = json.dumps(description, sort_keys=True)
+        key = hashlib.sha256(f"{source_hash}:{serialized}".encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{key}.png"
+
+    def process(self, image_path, style_params=None):
+        """
+        Preprocess a reference image (blocking; runs in the worker pool when called via process_async).
+
+        Args:
+            image_path (str): Path to the reference image
+            style_params (dict, optional): Style parameters selecting the preprocessor
+
+        Returns:
+            str: Path to the processed image (the original path if processing fails)
+        """
+        try:
+            description = self.describe(style_params)
+            preprocessor = PREPROCESSORS.get(description["method"])
+            if preprocessor is None:
+                raise ValueError(f"Unknown preprocessor '{description['method']}'. "
+                                 f"Available: {sorted(PREPROCESSORS)}")
+
+            processed_path = self._cache_path(cached_file_sha256(image_path), description)
+            try:
+                # Access time only: the mtime identifies the file content for upload hashing
+                os.utime(processed_path, ns=(time.time_ns(), processed_path.stat().st_mtime_ns))
+                return str(processed_path)
+            except FileNotFoundError:
+                pass
+
+            img = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                raise ValueError(f"Could not load image: {image_path}")
+
+            gray = cv2.resize(img, (self.resolution[0], self.resolution[1]), interpolation=cv2.INTER_AREA)
+            lines = preprocessor(gray, **description["params"])
+            if self.background == "white":
+                lines = 255 - lines
+            processed = cv2.cvtColor(lines, cv2.COLOR_GRAY2BGR)
+
+            # Write under a temporary name so concurrent readers never see a partial file
+            tmp_path = processed_path.with_name(f".{processed_path.stem}.{threading.get_ident()}.tmp.png")
+            if not cv2.imwrite(str(tmp_path), processed):
+                raise IOError(f"Could not write processed image: {tmp_path}")
+            os.replace(tmp_path, processed_path)
+            _prune_cache(self.cache_dir, self.max_cache_bytes, processed_path.stat().st_size)
+            return str(processed_path)
+        except Exception as e:
+            logger.error(f"Error processing reference image {image_path}: {e}")
+            # Return original image if processing fails
+            return str(image_path)
+
+    async def process_async(self, image_path, style_params=None):
+        """ Preprocess a reference image in the worker pool without blocking the event loop. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.process, image_path, style_params)
+
+    async def process_batch(self, image_paths, style_params=None):
+        """
+        Preprocess a batch of reference images concurrently.
+
+        Args:
+            image_paths (list): Paths to the reference images
+            style_params (dict, optional): Style parameters selecting the preprocessor
+
+        Returns:
+            dict: Mapping of source path to processed path
+        """
+        unique_paths = list(dict.fromkeys(str(p) for p in image_paths if p))
+        results = await asyncio.gather(*(self.process_async(p, style_params) for p in unique_paths))
+        logger.info(f"Preprocessed {len(unique_paths)} reference images ({self.describe(style_params)['method']}).")
+        return dict(zip(unique_paths, results))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Live Sampling Previews
+
+While sampling, ComfyUI (started with a --preview-method) sends the latent
+preview of the current step as binary WebSocket frames. The status hub
+decodes them here and keeps the latest preview of each prompt, and of the job
+that queued it, in a fixed-size in-memory ring buffer, so artists can watch a
+generation and cancel it after a few steps.
+
+Frames are not copied: a preview is a memoryview over the received message.
+
+Binary frame layout (big-endian):
+    PREVIEW_IMAGE (1):               event u32 | image type u32 (1 JPEG, 2 PNG) | image
+    PREVIEW_IMAGE_WITH_METADATA (4): event u32 | metadata length u32 | metadata JSON | image
+"""
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_IMAGE = 1
+PREVIEW_IMAGE_WITH_METADATA = 4
+IMAGE_TYPES = {1: "image/jpeg", 2: "image/png"}
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+class Preview:
+    """One decoded preview frame."""
+
+    __slots__ = ("seq", "prompt_id", "node", "step", "max_steps", "mime_type", "data", "created")
+
+    def __init__(self, mime_type, data, prompt_id=None, node=None):
+        self.seq = 0  # Set by the ring buffer
+        self.prompt_id = prompt_id
+        self.node = node
+        self.step = None
+        self.max_steps = None
+        self.mime_type = mime_type
+        self.data = data  # memoryview over the WebSocket message
+        self.created = time.time()
+
+    def to_bytes(self):
+        return self.data.tobytes()
+
+    def info(self):
+        """ JSON-serializable description (without the image). """
+        return {"seq": self.seq, "prompt_id": self.prompt_id, "node": self.node, "step": self.step,
+                "max_steps": self.max_steps, "mime_type": self.mime_type, "size": self.data.nbytes,
+                "created": self.created}
+
+
+def decode_preview_frame(message):
+    """
+    Decode a binary ComfyUI WebSocket message into a preview.
+
+    Args:
+        message (bytes): Binary WebSocket message
+
+    Returns:
+        Preview or None: The preview (prompt_id only set by metadata frames), None for
+            other binary events and malformed frames
+    """
+    view = memoryview(message)
+    if view.nbytes < 8:
+        return None
+    event = int.from_bytes(view[0:4], "big")
+    if event == PREVIEW_IMAGE:
+        mime_type = IMAGE_TYPES.get(int.from_bytes(view[4:8], "big"))
+        if mime_type is None or view.nbytes == 8:
+            return None
+        return Preview(mime_type, view[8:])
+    if event == PREVIEW_IMAGE_WITH_METADATA:
+        end = 8 + int.from_bytes(view[4:8], "big")
+        if end >= view.nbytes:
+            return None
+        try:
+            metadata = json.loads(bytes(view[8:end]))
+        except ValueError:
+            return None
+        image_type = str(metadata.get("image_type", "")).upper().replace("IMAGE/", "")
+        mime_type = MIME_TYPES.get(image_type, "image/jpeg")
+        return Preview(mime_type, view[end:], prompt_id=metadata.get("prompt_id"), node=metadata.get("node_id"))
+    return None
+
+
+class PreviewBuffer:
+    """Fixed-size ring of preview frames with the latest frame of each key (prompt id, job id)."""
+
+    def __init__(self, capacity=64):
+        """
+        Initialize the buffer
+
+        Args:
+            capacity (int): Frames kept in memory; older frames are overwritten
+        """
+        self.capacity = max(1, int(capacity))
+        self._lock = threading.Lock()
+        self._slots = [None] * self.capacity  # (preview, keys)
+        self._latest = {}  # key -> seq of its latest preview
+        self._seq = 0
+
+    def put(self, preview, keys):
+        """
+        Store a preview as the latest one of each key.
+
+        Args:
+            preview (Preview): Decoded frame
+            keys (iterable): Keys it belongs to (None values are ignored)
+        """
+        keys = tuple(key for key in keys if key is not None)
+        if not keys:
+            return
+        with self._lock:
+            self._seq += 1
+            preview.seq = self._seq
+            index = self._seq % self.capacity
+            overwritten = self._slots[index]
+            if overwritten is not None:
+                old, old_keys = overwritten
+                for key in old_keys:
+                    if self._latest.get(key) == old.seq:
+                        del self._latest[key]
+            self._slots[index] = (preview, keys)
+            for key in keys:
+                self._latest[key] = self._seq
+
+    def latest(self, key, after=0):
+        """
+        Get the latest preview of a key.
+
+        Args:
+            key (str): Prompt id or job id
+            after (int): Only return a preview newer than this sequence number
+
+        Returns:
+            Preview or None
+        """
+        with self._lock:
+            seq = self._latest.get(key)
+            if seq is None or seq <= after:
+                return None
+            preview, _ = self._slots[seq % self.capacity]
+            return preview
+
+    def discard(self, key):
+        """ Forget the latest preview of a key (its frame stays until overwritten). """
+        with self._lock:
+            self._latest.pop(key, None)
+
+    def stream(self, key, interval=0.5, is_finished=None, idle_timeout=600):
+        """
+        Yield the previews of a key, at most one per interval, skipping intermediate frames.
+
+        Args:
+            key (str): Prompt id or job id
+            interval (float): Minimum delay between two previews, in seconds
+            is_finished (callable, optional): Returns True once no more previews will come
+            idle_timeout (float): Stop after this long without a new preview
+
+        Yields:
+            Preview
+        """
+        last_seq = 0
+        last_frame = time.monotonic()
+        while True:
+            preview = self.latest(key, after=last_seq)
+            now = time.monotonic()
+            if preview is not None:
+                last_seq = preview.seq
+                last_frame = now
+                yield preview
+            elif (is_finished is not None and is_finished()) or now - last_frame > idle_timeout:
+                return
+            time.sleep(interval)
+
+
+def mjpeg_chunks(previews, boundary="frame"):
+    """
+    Encode previews as a multipart/x-mixed-replace body (displayable by an <img> tag).
+
+    Args:
+        previews (iterable): Previews to send
+        boundary (str): Multipart boundary
+
+    Yields:
+        bytes: Response chunks
+    """
+    for preview in previews:
+        yield (f"--{boundary}\r\nContent-Type: {preview.mime_type}\r\n"
+               f"Content-Length: {preview.data.nbytes}\r\nX-Preview-Step: {preview.step or ''}\r\n\r\n").encode()
+        yield preview.to_bytes()
+        yield b"\r\n"
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_preview_buffer(capacity=64):
+    """
+    Get the process-wide preview buffer (filled by every status hub).
+
+    Args:
+        capacity (int): Number of frames, used when the buffer is created
+
+    Returns:
+        PreviewBuffer: Shared buffer
+    """
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = PreviewBuffer(capacity)
+        return _buffer
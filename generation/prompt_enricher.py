@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batched Prompt Enrichment
+
+Scene texts are rewritten into image prompts by a text model (Qwen through
+Ollama, or Gemini). Instead of one blocking request per scene, the texts of
+an episode are numbered and sent together, a few batches at a time, and the
+model answers with a JSON list of prompts. Results are cached by (model,
+template, input text), in memory and on disk, so re-running an episode or
+regenerating a single scene costs no LLM call.
+
+A scene the model skipped in its batch answer is retried on its own; if that
+fails too, the original text is used unchanged.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+
+import aiohttp
+
+from utils.external_models import GEMINI_GENERATE_URL, OLLAMA_URL, QWEN_MODEL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE = (
+    "You write prompts for an image generation model from storyboard scene descriptions. "
+    "For each numbered scene below, write one concise visual prompt in English "
+    "(subjects, action, framing, lighting), without style instructions.\n"
+    "Answer only with JSON of the form {{\"prompts\": [{{\"id\": <scene number>, \"prompt\": \"...\"}}]}}.\n\n"
+    "{scenes}"
+)
+
+
+class PromptEnricher:
+    """Rewrites scene texts into image prompts with a text model, in cached batches."""
+
+    CACHE_FILENAME = "prompt_enrichment.json"
+
+    def __init__(self, config):
+        """
+        Initialize the enricher
+
+        Args:
+            config (dict): Configuration dictionary. Reads the optional
+                'prompt_enrichment' section (enabled, model, template, batch_size,
+                max_concurrency, tokens_per_scene, timeout) and the Gemini key
+                from 'external_models'.
+        """
+        enrich_config = config.get("prompt_enrichment", {}) or {}
+        self.enabled = enrich_config.get("enabled", False)
+        self.model = enrich_config.get("model", "qwen")
+        self.template = enrich_config.get("template", DEFAULT_TEMPLATE)
+        self.batch_size = max(1, int(enrich_config.get("batch_size", 10)))
+        self.max_concurrency = max(1, int(enrich_config.get("max_concurrency", 2)))
+        self.tokens_per_scene = int(enrich_config.get("tokens_per_scene", 120))
+        self.timeout = float(enrich_config.get("timeout", 120))
+        self.ollama_url = enrich_config.get("ollama_url", OLLAMA_URL).rstrip("/")
+        self.gemini_api_key = (config.get("external_models", {}) or {}).get("gemini_api_key", "")
+
+        self.cache_path = Path(config.get("cache_dir", "cache")) / self.CACHE_FILENAME
+        self._lock = threading.Lock()
+        self._cache = {}  # key -> enriched prompt
+        self.llm_calls = 0
+        if self.enabled:
+            self._load_cache()
+
+    @property
+    def model_name(self):
+        """ Name of the text model, part of the cache key. """
+        return QWEN_MODEL if self.model == "qwen" else GEMINI_GENERATE_URL.rsplit("/", 1)[-1]
+
+    def cache_key(self, text):
+        """ Cache key of an input text: (model, template, text). """
+        payload = json.dumps([self.model_name, self.template, text.strip()])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # --- Persistence ---
+
+    def _load_cache(self):
+        if not self.cache_path.exists():
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                self._cache = json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not read prompt enrichment cache {self.cache_path}: {e}. Starting empty.")
+            self._cache = {}
+
+    def _save_cache(self):
+        """ Writes the cache atomically. """
+        with self._lock:
+            snapshot = dict(self._cache)
+        os.makedirs(self.cache_path.parent, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_path.parent, prefix=".prompts-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.warning(f"Could not write prompt enrichment cache: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    # --- Public API ---
+
+    def lookup(self, text):
+        """
+        Get the cached enrichment of a text.
+
+        Args:
+            text (str): Scene text
+
+        Returns:
+            str or None: Enriched prompt, None if not enriched yet (or enrichment disabled)
+        """
+        if not self.enabled or not text or not text.strip():
+            return None
+        with self._lock:
+            return self._cache.get(self.cache_key(text))
+
+    async def enrich_batch(self, texts):
+        """
+        Enrich several scene texts with as few LLM calls as possible.
+
+        Args:
+            texts (list): Scene texts (duplicates and cached texts cost nothing)
+
+        Returns:
+            dict: Mapping of input text to enriched prompt (the text itself when enrichment failed)
+        """
+        results = {}
+        pending = []
+        for text in dict.fromkeys(t for t in texts if t and t.strip()):
+            cached = self.lookup(text)
+            if cached is not None:
+                results[text] = cached
+            elif self.enabled:
+                pending.append(text)
+            else:
+                results[text] = text
+        if not pending:
+            return results
+
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        logger.info(f"Enriching {len(pending)} scene texts in {len(batches)} batch(es) with {self.model_name}")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            async def run(batch):
+                async with semaphore:
+                    return await self._enrich_one_batch(session, batch)
+            for batch_results in await asyncio.gather(*(run(batch) for batch in batches)):
+                results.update(batch_results)
+
+        self._save_cache()
+        return results
+
+    async def enrich(self, text):
+        """ Enrich a single text (cached). Returns the text itself when enrichment fails or is disabled. """
+        return (await self.enrich_batch([text])).get(text, text)
+
+    def get_stats(self):
+        return {"enabled": self.enabled, "model": self.model_name, "cached": len(self._cache),
+                "llm_calls": self.llm_calls}
+
+    # --- Batches ---
+
+    async def _enrich_one_batch(self, session, batch):
+        prompts = await self._ask(session, batch)
+        results = {}
+        for number, text in enumerate(batch, start=1):
+            prompt = prompts.get(number)
+            if prompt is None and len(batch) > 1:
+                # The model skipped this scene: retry it alone
+                prompt = (await self._ask(session, [text])).get(1)
+            if prompt:
+                with self._lock:
+                    self._cache[self.cache_key(text)] = prompt
+                results[text] = prompt
+            else:
+                results[text] = text
+        return results
+
+    async def _ask(self, session, batch):
+        """ Sends one batch, returns {scene number: prompt} (empty on failure). """
+        scenes = "\n".join(f"{number}. {' '.join(text.split())}" for number, text in enumerate(batch, start=1))
+        prompt = self.template.format(scenes=scenes)
+        max_tokens = self.tokens_per_scene * len(batch) + 64
+        self.llm_calls += 1
+        try:
+            if self.model == "gemini":
+                answer = await self._call_gemini(session, prompt, max_tokens)
+            else:
+                answer = await self._call_ollama(session, prompt, max_tokens)
+        except Exception as e:
+            logger.warning(f"Prompt enrichment call failed for {len(batch)} scene(s): {e}")
+            return {}
+        return self.parse_answer(answer, len(batch))
+
+    async def _call_ollama(self, session, prompt, max_tokens):
+        data = {"model": QWEN_MODEL, "prompt": prompt, "stream": False, "format": "json",
+                "options": {"num_predict": max_tokens}}
+        async with session.post(f"{self.ollama_url}/api/generate", json=data) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Ollama HTTP {response.status}: {(await response.text())[:200]}")
+            return (await response.json()).get("response", "")
+
+    async def _call_gemini(self, session, prompt, max_tokens):
+        if not self.gemini_api_key:
+            raise RuntimeError("Gemini API key not configured")
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {self.gemini_api_key}"}
+        data = {"contents": [{"parts": [{"text": prompt}]}],
+                "generationConfig": {"maxOutputTokens": max_tokens, "responseMimeType": "application/json"}}
+        async with session.post(GEMINI_GENERATE_URL, headers=headers, json=data) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Gemini HTTP {response.status}: {(await response.text())[:200]}")
+            result = await response.json()
+        return "".join(part.get("text", "") for candidate in result.get("candidates", [])
+                       for part in candidate.get("content", {}).get("parts", []))
+
+    @staticmethod
+    def parse_answer(answer, count):
+        """
+        Parse a model answer into prompts.
+
+        Accepts {"prompts": [{"id", "prompt"}]}, a bare list of such objects or
+        of strings, and JSON wrapped in a Markdown code fence.
+
+        Args:
+            answer (str): Raw model output
+            count (int): Number of scenes in the batch
+
+        Returns:
+            dict: Mapping of scene number (1-based) to prompt
+        """
+        text = (answer or "").strip()
+        fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+        if fenced:
+            text = fenced.group(1).strip()
+        try:
+            data = json.loads(text)
+        except ValueError:
+            match = re.search(r"[\[{].*[\]}]", text, re.DOTALL)
+            if not match:
+                return {}
+            try:
+                data = json.loads(match.group(0))
+            except ValueError:
+                return {}
+
+        if isinstance(data, dict):
+            data = data.get("prompts", data.get("scenes", []))
+        if not isinstance(data, list):
+            return {}
+        prompts = {}
+        for position, item in enumerate(data, start=1):
+            if isinstance(item, str):
+                number, prompt = position, item
+            elif isinstance(item, dict):
+                number, prompt = item.get("id", position), item.get("prompt")
+            else:
+                continue
+            try:
+                number = int(number)
+            except (TypeError, ValueError):
+                continue
+            if 1 <= number <= count and isinstance(prompt, str) and prompt.strip():
+                prompts[number] = prompt.strip()
+        return prompts
+
+
+_enricher = None
+_enricher_lock = threading.Lock()
+
+
+def get_prompt_enricher(config):
+    """
+    Get the process-wide prompt enricher (created from the first config seen).
+
+    Args:
+        config (dict): Configuration dictionary
+
+    Returns:
+        PromptEnricher: Shared enricher
+    """
+    global _enricher
+    with _enricher_lock:
+        if _enricher is None:
+            _enricher = PromptEnricher(config)
+        return _enricher
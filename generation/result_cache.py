@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generation Result Cache
+
+Content-addressed store for generated images. A cache entry is keyed by
+everything that determines the output of a generation (reference image hash,
+fully resolved workflow, model/LoRA identities and seed) and points to an
+image blob stored under its own SHA256. Identical outputs are stored once.
+
+The store is bounded in size: least recently used entries are evicted when
+the total size of the blobs exceeds the configured budget. Access times of
+cache hits are written to the index lazily (at most every few seconds, and
+at exit), so replaying an episode does not rewrite the index for every scene.
+"""
+
+import asyncio
+import atexit
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Workflow inputs that change between runs without changing the generated pixels
+VOLATILE_INPUTS = {"filename_prefix", "save_to", "client_id", "upload"}
+
+# Workflow inputs that name a model file on the ComfyUI side
+MODEL_INPUTS = {"ckpt_name", "lora_name", "control_net_name", "vae_name", "unet_name", "clip_name"}
+
+MODEL_EXTENSIONS = {".safetensors", ".ckpt", ".pt", ".pth", ".bin"}
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    """ Calculates the SHA256 hex digest of a file, reading it in chunks. """
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+_hash_memo = {}  # (path, size, mtime_ns) -> sha256
+_hash_memo_lock = threading.Lock()
+
+
+def cached_file_sha256(file_path):
+    """ Same as file_sha256, memoized on (path, size, mtime) so unchanged files are hashed once per process. """
+    stat = os.stat(file_path)
+    memo_key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+    with _hash_memo_lock:
+        digest = _hash_memo.get(memo_key)
+    if digest is None:
+        digest = file_sha256(file_path)
+        with _hash_memo_lock:
+            _hash_memo[memo_key] = digest
+    return digest
+
+
+def normalize_workflow(workflow):
+    """
+    Return a copy of a ComfyUI workflow with volatile fields removed.
+
+    Output naming inputs are dropped and the LoadImage input is replaced by a
+    marker, since the reference image is identified by its content hash.
+
+    Args:
+        workflow (dict): Fully resolved workflow (API format)
+
+    Returns:
+        dict: Normalized workflow
+    """
+    normalized = copy.deepcopy(workflow) if workflow else {}
+    for node in normalized.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs", {})
+        for name in VOLATILE_INPUTS:
+            inputs.pop(name, None)
+        if node.get("class_type") == "LoadImage" and "image" in inputs:
+            inputs["image"] = "<reference>"
+        # Node titles/metadata are UI-only
+        node.pop("_meta", None)
+    return normalized
+
+
+def extract_model_names(workflow):
+    """
+    List the model files referenced by a workflow.
+
+    Args:
+        workflow (dict): Workflow (API format)
+
+    Returns:
+        list: Sorted list of model names
+    """
+    names = set()
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict):
+            continue
+        for input_name, value in node.get("inputs", {}).items():
+            if input_name in MODEL_INPUTS and isinstance(value, str) and value:
+                names.add(value)
+    return sorted(names)
+
+
+class ModelIdentityResolver:
+    """Resolves model names to a stable identity (name, size, mtime) when the file is available locally."""
+
+    def __init__(self, models_root):
+        """
+        Initialize the resolver
+
+        Args:
+            models_root (str or Path): Root directory of the local model files
+        """
+        self.models_root = Path(models_root)
+        self._files = None  # basename -> Path, built lazily
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        files = {}
+        if self.models_root.exists():
+            for path in self.models_root.rglob("*"):
+                if path.suffix.lower() in MODEL_EXTENSIONS and path.is_file():
+                    files.setdefault(path.name, path)
+                    files.setdefault(path.stem, path)
+        return files
+
+    def identity(self, model_name):
+        """
+        Get the identity of a model
+
+        Args:
+            model_name (str): Model name as referenced in the workflow
+
+        Returns:
+            str: Identity string (name, plus size and mtime if the file is known)
+        """
+        with self._lock:
+            if self._files is None:
+                self._files = self._scan()
+            path = self._files.get(Path(model_name).name)
+        if path is None:
+            return model_name
+        try:
+            stat = path.stat()
+        except OSError:
+            return model_name
+        return f"{model_name}:{stat.st_size}:{int(stat.st_mtime)}"
+
+    def identities(self, model_names):
+        """ Returns the identities of several models. """
+        return [self.identity(name) for name in model_names]
+
+
+class ResultCache:
+    """Size-bounded, content-addressed cache of generated images."""
+
+    INDEX_FILENAME = "index.json"
+
+    def __init__(self, config):
+        """
+        Initialize the result cache
+
+        Args:
+            config (dict): Configuration dictionary. Reads the optional
+                'result_cache' section (enabled, dir, max_size_mb, index_flush_interval).
+        """
+        cache_config = config.get("result_cache", {}) or {}
+        self.enabled = config.get("cache_enabled", True) and cache_config.get("enabled", True)
+        default_dir = Path(config.get("cache_dir", "cache")) / "results"
+        self.root = Path(cache_config.get("dir", default_dir))
+        self.objects_dir = self.root / "objects"
+        self.index_path = self.root / self.INDEX_FILENAME
+        self.max_bytes = int(cache_config.get("max_size_mb", 4096)) * 1024 * 1024
+        # Seconds between two index writes caused by access times only
+        self.index_flush_interval = float(cache_config.get("index_flush_interval", 30))
+
+        self._lock = threading.Lock()
+        # key -> {"digest": str, "suffix": str, "size": int, "last_access": float}
+        self._entries = OrderedDict()
+        self._blob_refs = {}  # blob file name (digest + suffix) -> number of keys pointing to it
+        self._total_bytes = 0
+        self._dirty = False  # Access times changed since the last index write
+        self._saved_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            os.makedirs(self.objects_dir, exist_ok=True)
+            self._load_index()
+            logger.info(f"Result cache enabled. Directory: {self.root}, "
+                        f"size: {self._total_bytes / 1e6:.1f}/{self.max_bytes / 1e6:.0f} MB, entries: {len(self._entries)}")
+
+    @staticmethod
+    def make_key(reference_hash, request, model_identities, seed):
+        """
+        Build a cache key for a generation request.
+
+        Args:
+            reference_hash (str): SHA256 of the reference image (None if no reference)
+            request (dict): Fully resolved, normalized request (workflow or cloud payload)
+            model_identities (list): Identities of the checkpoints/LoRAs used
+            seed (int): Sampler seed
+
+        Returns:
+            str: Hex digest key
+        """
+        key_data = {
+            "reference": reference_hash,
+            "request": request,
+            "models": sorted(model_identities or []),
+            "seed": seed,
+        }
+        serialized = json.dumps(key_data, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _blob_path(self, digest, suffix):
+        return self.objects_dir / digest[:2] / f"{digest}{suffix}"
+
+    def _load_index(self):
+        """ Loads the index from disk, dropping entries whose blob disappeared. """
+        if not self.index_path.exists():
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                raw_entries = json.load(f)
+        except Exception as e:
+            logger.warning(f"Could not read result cache index {self.index_path}: {e}. Starting empty.")
+            return
+
+        for key, entry in sorted(raw_entries.items(), key=lambda item: item[1].get("last_access", 0)):
+            if not self._blob_path(entry["digest"], entry.get("suffix", "")).exists():
+                continue
+            self._add_entry(key, entry)
+
+    def _save_index(self):
+        """ Writes the index atomically. Caller holds the lock. """
+        self._dirty = False
+        self._saved_at = time.time()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".index-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.warning(f"Could not write result cache index: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def flush(self):
+        """ Writes pending access times to the index. """
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    @staticmethod
+    def _blob_id(entry):
+        return f"{entry['digest']}{entry.get('suffix', '')}"
+
+    def _add_entry(self, key, entry):
+        """ Registers an entry and accounts for its blob. Caller holds the lock. """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        blob_id = self._blob_id(entry)
+        refs = self._blob_refs.get(blob_id, 0)
+        if refs == 0:
+            self._total_bytes += entry["size"]
+        self._blob_refs[blob_id] = refs + 1
+
+    def _release_blob(self, entry):
+        """ Drops a reference to the blob of an entry, deleting it if nothing else uses it. Caller holds the lock. """
+        blob_id = self._blob_id(entry)
+        refs = self._blob_refs.get(blob_id, 1) - 1
+        if refs > 0:
+            self._blob_refs[blob_id] = refs
+            return
+        self._blob_refs.pop(blob_id, None)
+        self._total_bytes -= entry["size"]
+        try:
+            os.remove(self._blob_path(entry["digest"], entry.get("suffix", "")))
+        except OSError:
+            pass
+
+    def _remove_entry(self, key):
+        """ Removes an entry, deleting its blob if nothing else references it. Caller holds the lock. """
+        self._release_blob(self._entries.pop(key))
+
+    def _touch(self, key, entry):
+        """ Marks an entry as recently used; the index is written lazily. Caller holds the lock. """
+        entry["last_access"] = time.time()
+        self._entries.move_to_end(key)
+        self._dirty = True
+        if time.time() - self._saved_at >= self.index_flush_interval:
+            self._save_index()
+
+    def _evict(self):
+        """ Evicts least recently used entries until the size budget is met. Caller holds the lock. """
+        evicted = 0
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest_key = next(iter(self._entries))
+            self._remove_entry(oldest_key)
+            evicted += 1
+        if evicted:
+            logger.info(f"Result cache evicted {evicted} entries (size now {self._total_bytes / 1e6:.1f} MB)")
+
+    @staticmethod
+    def _write_blob(image_path, blob_path):
+        """ Copies an image to its blob path under a unique temporary name, then renames it atomically. """
+        os.makedirs(blob_path.parent, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=blob_path.parent, prefix=f".{blob_path.stem[:12]}-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as dst, open(image_path, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, blob_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key, output_path):
+        """
+        Copy a cached result to the output path.
+
+        Args:
+            key (str): Cache key
+            output_path (str or Path): Destination of the generated image
+
+        Returns:
+            str or None: Output path on cache hit, None on miss
+        """
+        if not self.enabled or not key:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            blob_path = self._blob_path(entry["digest"], entry.get("suffix", ""))
+            if not blob_path.exists():
+                logger.warning(f"Result cache blob missing for key {key[:12]}, dropping entry.")
+                self._remove_entry(key)
+                self.misses += 1
+                return None
+            self._touch(key, entry)
+
+        output_path = Path(output_path)
+        try:
+            if blob_path.resolve() != output_path.resolve():
+                os.makedirs(output_path.parent, exist_ok=True)
+                shutil.copyfile(blob_path, output_path)
+        except FileNotFoundError:
+            # Evicted or replaced by a concurrent put() since the lookup: a miss
+            logger.info(f"Result cache blob for key {key[:12]} evicted during the lookup.")
+            with self._lock:
+                current = self._entries.get(key)
+                if current is not None and self._blob_id(current) == self._blob_id(entry) and not blob_path.exists():
+                    self._remove_entry(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return str(output_path)
+
+    async def get_async(self, key, output_path):
+        """ get() run in a worker thread, so the index lock and the file copy never block the event loop. """
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key, output_path)
+
+    def put(self, key, image_path):
+        """
+        Store a generated image under the given key.
+
+        Args:
+            key (str): Cache key
+            image_path (str or Path): Generated image to store
+
+        Returns:
+            str or None: Content digest of the stored blob, None if not stored
+        """
+        if not self.enabled or not key:
+            return None
+
+        image_path = Path(image_path)
+        try:
+            digest = file_sha256(image_path)
+            size = image_path.stat().st_size
+        except OSError as e:
+            logger.warning(f"Cannot cache generated image {image_path}: {e}")
+            return None
+
+        suffix = image_path.suffix.lower()
+        blob_path = self._blob_path(digest, suffix)
+        try:
+            if not blob_path.exists():
+                self._write_blob(image_path, blob_path)
+        except OSError as e:
+            logger.warning(f"Cannot cache generated image {image_path}: {e}")
+            return None
+
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and self._blob_id(current) == f"{digest}{suffix}":
+                # Same content stored again under the same key: only its recency changes
+                self._touch(key, current)
+                return digest
+            if not blob_path.exists():
+                # Deleted by a concurrent eviction since the copy: written again while nothing can evict it
+                try:
+                    self._write_blob(image_path, blob_path)
+                except OSError as e:
+                    logger.warning(f"Cannot cache generated image {image_path}: {e}")
+                    return None
+            # The new entry is registered before the old one is released, so a blob they share survives
+            self._add_entry(key, {"digest": digest, "suffix": suffix, "size": size, "last_access": time.time()})
+            if current is not None:
+                self._release_blob(current)
+            self._evict()
+            self._save_index()
+        logger.debug(f"Stored generated image {image_path.name} as {digest[:12]} for key {key[:12]}")
+        return digest
+
+    async def put_async(self, key, image_path):
+        """ put() run in a worker thread (hashing, copy and index write stay off the event loop). """
+        return await asyncio.get_running_loop().run_in_executor(None, self.put, key, image_path)
+
+    def clear(self):
+        """ Removes every entry and blob from the cache. """
+        with self._lock:
+            for key in list(self._entries):
+                self._remove_entry(key)
+            self._save_index()
+        logger.info(f"Result cache cleared ({self.root}).")
+
+    def get_stats(self):
+        """ Returns size and hit statistics. """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "blobs": len(self._blob_refs),
+                "size_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_result_cache(config):
+    """
+    Get the shared result cache of the configured directory.
+
+    Generators are created per request: sharing the instance keeps one in-memory
+    index (and one writer) per cache directory.
+
+    Args:
+        config (dict): Configuration dictionary
+
+    Returns:
+        ResultCache: Cache shared by every caller in the process
+    """
+    cache_config = config.get("result_cache", {}) or {}
+    enabled = config.get("cache_enabled", True) and cache_config.get("enabled", True)
+    root = Path(cache_config.get("dir", Path(config.get("cache_dir", "cache")) / "results"))
+    key = (str(root.resolve()), bool(enabled))
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = ResultCache(config)
+            _caches[key] = cache
+            if cache.enabled:
+                # Access times not yet written are saved at exit
+                atexit.register(cache.flush)
+        return cache
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive Local/Cloud Routing
+
+When routing is enabled, ImageGenerator holds both its ComfyUI backend(s)
+and a cloud generator, and asks the router where each scene should go. The
+router keeps a rolling window of generation times per backend and compares
+expected finish times:
+
+    expected finish = rolling median generation time x (work ahead / parallelism + 1)
+
+where the work ahead on a ComfyUI server is the larger of this process's own
+queue (scheduler) and the server's queue (status hub), since ComfyUI also
+runs other clients' prompts. A scene goes to the cloud only if the cloud is
+expected to finish first and the cloud budget of the current period allows
+it. Scenes of an episode with a deadline may also draw on a burst budget
+when the local queue cannot finish them in time.
+
+Cloud spending is persisted, so a restart does not reset the budget. A
+backend that keeps failing is avoided for a cool-down period.
+"""
+
+import json
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+ROUTE_LOCAL = "local"
+ROUTE_CLOUD = "cloud"
+
+
+class BackendStats:
+    """Rolling generation times and failure streak of one backend."""
+
+    def __init__(self, default_latency, window=20):
+        self.default_latency = float(default_latency)
+        self.samples = deque(maxlen=max(1, int(window)))
+        self.consecutive_failures = 0
+        self.last_failure = None
+        self.generations = 0
+        self.failures = 0
+
+    def record(self, seconds, ok):
+        self.generations += 1
+        if ok:
+            self.samples.append(seconds)
+            self.consecutive_failures = 0
+        else:
+            # Failures are often fast: their duration would make a broken backend look attractive
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_failure = time.time()
+
+    def latency(self):
+        """ Median of the recent successful generation times (the default until there is one). """
+        return statistics.median(self.samples) if self.samples else self.default_latency
+
+    def is_down(self, threshold, cooldown):
+        return (self.consecutive_failures >= threshold and self.last_failure is not None
+                and time.time() - self.last_failure < cooldown)
+
+    def to_dict(self):
+        return {"latency": round(self.latency(), 2), "samples": len(self.samples),
+                "generations": self.generations, "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures}
+
+
+class GenerationRouter:
+    """Chooses between a local and a cloud backend by expected finish time, within a cloud budget."""
+
+    STATE_FILENAME = "routing_budget.json"
+
+    def __init__(self, config):
+        """
+        Initialize the router
+
+        Args:
+            config (dict): Configuration dictionary. Reads the optional 'routing'
+                section (enabled, cloud_budget, burst_budget, budget_period_hours,
+                cloud_cost_per_image, latency_window, default_latency,
+                failure_threshold, failure_cooldown) and cache_dir.
+        """
+        routing_config = config.get("routing", {}) or {}
+        self.enabled = bool(routing_config.get("enabled", False))
+        self.cloud_budget = float(routing_config.get("cloud_budget", 0.0))
+        self.burst_budget = float(routing_config.get("burst_budget", 0.0))
+        self.budget_period = float(routing_config.get("budget_period_hours", 24)) * 3600
+        costs = routing_config.get("cloud_cost_per_image", {}) or {}
+        self.cloud_costs = costs if isinstance(costs, dict) else {"default": float(costs)}
+        self.latency_window = int(routing_config.get("latency_window", 20))
+        self.default_latency = {ROUTE_LOCAL: 30.0, ROUTE_CLOUD: 20.0,
+                                **(routing_config.get("default_latency", {}) or {})}
+        self.failure_threshold = int(routing_config.get("failure_threshold", 3))
+        self.failure_cooldown = float(routing_config.get("failure_cooldown", 120))
+
+        self.state_path = Path(config.get("cache_dir", "cache")) / self.STATE_FILENAME
+        self._lock = threading.Lock()
+        self._stats = {}  # backend -> BackendStats
+        self._period_start, self._spent = self._load_state()
+        self.routed = {ROUTE_LOCAL: 0, ROUTE_CLOUD: 0, "burst": 0}
+
+    # --- Budget ---
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            return float(state["period_start"]), float(state["spent"])
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not read routing budget state {self.state_path}: {e}")
+        return time.time(), 0.0
+
+    def _save_state(self):
+        """ Writes the spending of the period atomically. Caller holds the lock. """
+        try:
+            os.makedirs(self.state_path.parent, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.state_path.parent, prefix=".routing-", suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"period_start": self._period_start, "spent": self._spent}, f)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logger.warning(f"Could not write routing budget state: {e}")
+
+    def _roll_period(self):
+        """ Starts a new budget period when the current one is over. Caller holds the lock. """
+        if time.time() - self._period_start >= self.budget_period:
+            self._period_start, self._spent = time.time(), 0.0
+
+    def cloud_cost(self, cloud_backend):
+        """ Cost of one generation on a cloud backend ("cloud:<provider>"). """
+        provider = cloud_backend.split(":", 1)[-1]
+        return float(self.cloud_costs.get(provider, self.cloud_costs.get("default", 0.04)))
+
+    def _reserve(self, cost, limit):
+        """ Spends cost if the period total stays within limit. Caller holds the lock. """
+        self._roll_period()
+        if self._spent + cost > limit + 1e-9:
+            return False
+        self._spent += cost
+        self._save_state()
+        return True
+
+    def refund(self, cloud_backend):
+        """ Gives back the cost of a cloud generation that produced no image. """
+        with self._lock:
+            self._spent = max(0.0, self._spent - self.cloud_cost(cloud_backend))
+            self._save_state()
+
+    def remaining_budget(self, burst=False):
+        with self._lock:
+            self._roll_period()
+            return (self.cloud_budget + (self.burst_budget if burst else 0.0)) - self._spent
+
+    # --- Measurements ---
+
+    def _backend_stats(self, backend, route):
+        stats = self._stats.get(backend)
+        if stats is None:
+            stats = BackendStats(self.default_latency[route], self.latency_window)
+            self._stats[backend] = stats
+        return stats
+
+    def record(self, backend, seconds, ok, route=ROUTE_LOCAL):
+        """
+        Record a finished generation.
+
+        Args:
+            backend (str): Backend key
+            seconds (float): Generation time, without the time spent waiting for admission
+            ok (bool): Whether an image was produced
+            route (str): "local" or "cloud" (selects the default latency of a new backend)
+        """
+        with self._lock:
+            self._backend_stats(backend, route).record(seconds, ok)
+
+    def expected_finish(self, backend, route, queue_depth, parallelism=1):
+        """
+        Expected seconds until a generation submitted now would be finished.
+
+        Args:
+            backend (str): Backend key
+            route (str): "local" or "cloud"
+            queue_depth (int): Generations running or waiting ahead on the backend
+            parallelism (int): Generations the backend runs at once
+
+        Returns:
+            float: Seconds (infinite for a backend that keeps failing)
+        """
+        with self._lock:
+            stats = self._backend_stats(backend, route)
+            if stats.is_down(self.failure_threshold, self.failure_cooldown):
+                return float("inf")
+            latency = stats.latency()
+        return latency * (int(queue_depth) // max(1, int(parallelism)) + 1)
+
+    # --- Decision ---
+
+    def choose(self, local_backend, local_depth, cloud_backend, cloud_depth, cloud_parallelism=1, deadline=None):
+        """
+        Choose the backend of one scene, reserving its cloud cost when the cloud is chosen.
+
+        Args:
+            local_backend (str): Local backend key (ComfyUI URL)
+            local_depth (int): Generations ahead on the local backend
+            cloud_backend (str): Cloud backend key ("cloud:<provider>")
+            cloud_depth (int): Generations ahead on the cloud backend
+            cloud_parallelism (int): Concurrent generations allowed on the cloud backend
+            deadline (float, optional): Epoch time the scene's episode must be done by
+
+        Returns:
+            tuple: (route, reason) with route "local" or "cloud"
+        """
+        local_eta = self.expected_finish(local_backend, ROUTE_LOCAL, local_depth)
+        cloud_eta = self.expected_finish(cloud_backend, ROUTE_CLOUD, cloud_depth, cloud_parallelism)
+        route, reason = ROUTE_LOCAL, f"local expected in {local_eta:.0f}s, cloud in {cloud_eta:.0f}s"
+        if cloud_eta < local_eta:
+            cost = self.cloud_cost(cloud_backend)
+            late = deadline is not None and time.time() + local_eta > deadline
+            with self._lock:
+                if self._reserve(cost, self.cloud_budget):
+                    route = ROUTE_CLOUD
+                elif late and self._reserve(cost, self.cloud_budget + self.burst_budget):
+                    route, reason = ROUTE_CLOUD, f"burst: local queue would miss the deadline ({reason})"
+                    self.routed["burst"] += 1
+                else:
+                    reason = f"cloud budget spent ({reason})"
+                self.routed[route] += 1
+        else:
+            with self._lock:
+                self.routed[route] += 1
+        return route, reason
+
+    def get_stats(self):
+        with self._lock:
+            self._roll_period()
+            return {"enabled": self.enabled, "spent": round(self._spent, 4), "cloud_budget": self.cloud_budget,
+                    "burst_budget": self.burst_budget, "routed": dict(self.routed),
+                    "backends": {backend: stats.to_dict() for backend, stats in self._stats.items()}}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_generation_router(config):
+    """
+    Get the process-wide router (generators are created per request, measurements and budget are shared).
+
+    Args:
+        config (dict): Configuration dictionary, used on first call only
+
+    Returns:
+        GenerationRouter: Shared router
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = GenerationRouter(config)
+        return _router
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generation Scheduler
+
+Sits in front of the backend submission path (ComfyUI or a cloud provider)
+and decides which generation is sent next:
+
+- Priority classes: interactive (previews) before batch (episode jobs)
+  before background work.
+- Within a class, projects are served round-robin, so one large job
+  cannot starve the others.
+- Each backend only has a bounded number of generations in flight. With
+  the default window of 1, ComfyUI's own FIFO queue stays empty and an
+  interactive preview starts as soon as the current sampler run ends.
+- Within a class, a generation using the models already loaded on the
+  backend (same checkpoint/LoRA signature) may go ahead of others, within
+  a fairness window (see generation/affinity.py).
+- With several backends, each model signature is pinned to one backend so
+  that each backend keeps the same models loaded.
+
+Flask runs each async view in its own event loop, so the scheduler state
+is guarded by a thread lock and every waiter is woken in its own loop.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+
+from generation.affinity import pick_affine
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Scheduling classes, lowest value served first."""
+    INTERACTIVE = 0
+    BATCH = 1
+    BACKGROUND = 2
+
+
+class _Ticket:
+    __slots__ = ("loop", "future", "priority", "project", "signature", "bypassed", "enqueued_at")
+
+    def __init__(self, loop, priority, project, signature=None):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.priority = priority
+        self.project = project
+        self.signature = signature
+        self.bypassed = 0
+        self.enqueued_at = time.monotonic()
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class _BackendQueue:
+    """Waiting tickets and in-flight count of one backend."""
+
+    def __init__(self, window, affinity_window=0):
+        self.window = max(1, int(window))
+        self.affinity_window = max(0, int(affinity_window))
+        self.in_flight = 0
+        self.last_signature = None  # Models most recently sent to the backend
+        # One OrderedDict per priority: project -> deque of tickets, in round-robin order
+        self.waiting = [OrderedDict() for _ in Priority]
+
+    def has_waiting(self):
+        return any(self.waiting)
+
+    def push(self, ticket):
+        projects = self.waiting[ticket.priority]
+        projects.setdefault(ticket.project, deque()).append(ticket)
+
+    def _fair_order(self, projects, limit):
+        """ Tickets of one class in round-robin serving order, up to limit. """
+        ordered = []
+        depth = 0
+        while len(ordered) < limit:
+            round_tickets = [tickets[depth] for tickets in projects.values() if len(tickets) > depth]
+            if not round_tickets:
+                break
+            ordered.extend(round_tickets)
+            depth += 1
+        return ordered[:limit]
+
+    def pop_next(self):
+        for projects in self.waiting:
+            if not projects:
+                continue
+            candidates = self._fair_order(projects, max(1, self.affinity_window))
+            index = pick_affine(candidates, self.last_signature, self.affinity_window)
+            for skipped in candidates[:index]:
+                skipped.bypassed += 1
+            ticket = candidates[index]
+            tickets = projects[ticket.project]
+            tickets.remove(ticket)
+            # Serve the next project first next time
+            del projects[ticket.project]
+            if tickets:
+                projects[ticket.project] = tickets
+            if ticket.signature is not None:
+                self.last_signature = ticket.signature
+            return ticket
+        return None
+
+    def load(self):
+        return self.in_flight + sum(len(t) for projects in self.waiting for t in projects.values())
+
+    def remove(self, ticket):
+        projects = self.waiting[ticket.priority]
+        tickets = projects.get(ticket.project)
+        if not tickets or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del projects[ticket.project]
+        return True
+
+    def counts(self):
+        return {priority.name.lower(): sum(len(t) for t in self.waiting[priority].values()) for priority in Priority}
+
+
+class GenerationScheduler:
+    """Priority- and project-fair admission of generations to backends with a bounded in-flight window."""
+
+    def __init__(self, config):
+        """
+        Initialize the scheduler
+
+        Args:
+            config (dict): Configuration dictionary. Reads the optional
+                'scheduler' section (max_in_flight, backends: {backend: window},
+                affinity_window, pin_spill).
+        """
+        scheduler_config = config.get("scheduler", {}) or {}
+        self.default_window = int(scheduler_config.get("max_in_flight", 1))
+        self.backend_windows = dict(scheduler_config.get("backends", {}) or {})
+        self.affinity_window = int(scheduler_config.get("affinity_window", 8))
+        # A pinned backend is bypassed when its load exceeds the least loaded one by more than this
+        self.pin_spill = int(scheduler_config.get("pin_spill", 4))
+        self._lock = threading.Lock()
+        self._backends = {}
+        self._pins = {}  # model signature -> backend
+
+    def _queue(self, backend):
+        """ Returns the queue of a backend, creating it on first use. Caller holds the lock. """
+        backend_queue = self._backends.get(backend)
+        if backend_queue is None:
+            backend_queue = _BackendQueue(self.backend_windows.get(backend, self.default_window), self.affinity_window)
+            self._backends[backend] = backend_queue
+        return backend_queue
+
+    async def acquire(self, priority=Priority.BATCH, project=None, backend="default", signature=None):
+        """
+        Wait for an in-flight slot on a backend. Must be paired with release().
+
+        Args:
+            priority (Priority): Scheduling class
+            project (str, optional): Project the generation belongs to (fair sharing key)
+            backend (str): Backend identifier (e.g. ComfyUI base URL)
+            signature (tuple, optional): Model signature of the generation (see generation/affinity.py)
+        """
+        priority = Priority(priority)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            backend_queue = self._queue(backend)
+            if backend_queue.in_flight < backend_queue.window and not backend_queue.has_waiting():
+                backend_queue.in_flight += 1
+                if signature is not None:
+                    backend_queue.last_signature = signature
+                return
+            ticket = _Ticket(loop, priority, project, signature)
+            backend_queue.push(ticket)
+            queued = backend_queue.counts()
+
+        logger.debug(f"Generation for project {project} queued on {backend} as {priority.name.lower()} ({queued})")
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            with self._lock:
+                still_waiting = backend_queue.remove(ticket)
+            if not still_waiting:
+                # The slot was granted while we were being cancelled: hand it on
+                self.release(backend)
+            raise
+
+        waited = time.monotonic() - ticket.enqueued_at
+        if waited > 1:
+            logger.info(f"{priority.name.capitalize()} generation for project {project} waited {waited:.1f}s for {backend}")
+
+    def release(self, backend="default"):
+        """ Frees an in-flight slot and admits the next waiting generation. """
+        with self._lock:
+            backend_queue = self._queue(backend)
+            backend_queue.in_flight = max(0, backend_queue.in_flight - 1)
+            self._dispatch(backend_queue)
+
+    def _dispatch(self, backend_queue):
+        """ Grants free slots to waiting tickets. Caller holds the lock. """
+        while backend_queue.in_flight < backend_queue.window:
+            ticket = backend_queue.pop_next()
+            if ticket is None:
+                return
+            try:
+                ticket.loop.call_soon_threadsafe(_grant, ticket.future)
+            except RuntimeError:
+                # The waiter's event loop is gone (request ended): skip it
+                continue
+            backend_queue.in_flight += 1
+
+    async def run(self, job, priority=Priority.BATCH, project=None, backend="default", signature=None):
+        """
+        Run a generation once the scheduler admits it.
+
+        Args:
+            job (callable): Coroutine function performing the submission and waiting for its result
+            priority (Priority): Scheduling class
+            project (str, optional): Project the generation belongs to
+            backend (str): Backend identifier
+            signature (tuple, optional): Model signature of the generation
+
+        Returns:
+            The result of job()
+        """
+        await self.acquire(priority, project, backend, signature)
+        try:
+            return await job()
+        finally:
+            self.release(backend)
+
+    def pin_backend(self, signature, backends):
+        """
+        Choose the backend for a model signature among equivalent backends.
+
+        A signature stays on the backend it was first sent to, so that backend
+        keeps its models loaded. New signatures go to the least loaded backend,
+        and a pinned backend is skipped (without unpinning) when its load exceeds
+        the least loaded one by more than pin_spill.
+
+        Args:
+            signature (tuple): Model signature
+            backends (list): Candidate backend identifiers
+
+        Returns:
+            str: Chosen backend
+        """
+        backends = list(backends)
+        if len(backends) == 1 or signature is None:
+            return backends[0]
+        with self._lock:
+            loads = {backend: self._queue(backend).load() for backend in backends}
+            pinned_counts = {backend: 0 for backend in backends}
+            for pinned in self._pins.values():
+                if pinned in pinned_counts:
+                    pinned_counts[pinned] += 1
+            least_loaded = min(backends, key=lambda backend: (loads[backend], pinned_counts[backend]))
+            pinned = self._pins.get(signature)
+            if pinned not in loads:
+                self._pins[signature] = least_loaded
+                logger.info(f"Models {', '.join(signature)} pinned to {least_loaded}")
+                return least_loaded
+            if loads[pinned] - loads[least_loaded] > self.pin_spill:
+                return least_loaded
+            return pinned
+
+    def load(self, backend):
+        """ Generations in flight or waiting on a backend. """
+        with self._lock:
+            return self._queue(backend).load()
+
+    def window(self, backend):
+        """ Generations a backend may have in flight at once. """
+        with self._lock:
+            return self._queue(backend).window
+
+    def get_stats(self):
+        """ Returns in-flight and waiting counts per backend. """
+        with self._lock:
+            return {
+                backend: {"window": q.window, "in_flight": q.in_flight, "waiting": q.counts(),
+                          "models": list(q.last_signature or [])}
+                for backend, q in self._backends.items()
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(config):
+    """
+    Get the process-wide scheduler (generators are created per request, the scheduler is shared).
+
+    Args:
+        config (dict): Configuration dictionary, used on first call only
+
+    Returns:
+        GenerationScheduler: Shared scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = GenerationScheduler(config)
+        return _scheduler
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Similar Plan Lookup Across Episodes
+
+Many plans of a series are near-identical: recurring locations, the same
+framing, the same text. Every successful generation is recorded in an index
+combining two signatures of the scene:
+
+- a perceptual hash (dHash, 64 bits) of the reference panel, compared by
+  Hamming distance,
+- a TF-IDF vector of the scene text (sublinear term frequency, accents and
+  common words removed), compared by cosine similarity.
+
+Before a generation, the closest prior results (with their seed, style,
+quality tier and prompt) can be offered for reuse, or their seed used as a
+warm start. Hashes are kept in a NumPy array (XOR + popcount over every plan
+at once) and texts in an inverted index, so a lookup over tens of thousands
+of plans stays well under a millisecond.
+
+The index is persisted as an append-only JSON Lines file, rewritten without
+the superseded entries when it is loaded. Text vectors are weighted with the
+IDF known when they were added, and re-weighted on load.
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+# Words that say nothing about the content of a plan (storyboard texts are mostly French)
+STOP_WORDS = frozenset("""
+    le la les un une des du de d l au aux et ou a en dans sur sous par pour avec sans ce cet cette ces
+    il elle ils elles on se sa son ses leur leurs qui que qu ne pas est sont the an and or of to in on
+    at with by for is are it its his her their this that plan scene
+""".split())
+
+
+def _popcount(values):
+    """ Number of set bits of each uint64 of an array (np.bitwise_count only exists from NumPy 2.0). """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # Parallel bit count: 2-, 4- then 8-bit partial sums, added up by the multiplication (wraps modulo 2**64)
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (values * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def dhash(image_path, size=8):
+    """
+    Perceptual difference hash of an image: one bit per horizontal gradient sign
+    of its grayscale thumbnail. Robust to scaling, compression and small edits.
+
+    Args:
+        image_path (str or Path): Image file
+        size (int): Hash side (size * size bits)
+
+    Returns:
+        int: Hash
+    """
+    img = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError(f"Could not load image: {image_path}")
+    small = cv2.resize(img, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+_dhash_memo = {}  # (path, size, mtime_ns) -> hash
+_dhash_memo_lock = threading.Lock()
+
+
+def cached_dhash(image_path):
+    """ Same as dhash, memoized on (path, size, mtime) so unchanged panels are hashed once per process. """
+    stat = os.stat(image_path)
+    memo_key = (str(image_path), stat.st_size, stat.st_mtime_ns)
+    with _dhash_memo_lock:
+        value = _dhash_memo.get(memo_key)
+    if value is None:
+        value = dhash(image_path)
+        with _dhash_memo_lock:
+            _dhash_memo[memo_key] = value
+    return value
+
+
+def tokenize(text):
+    """ Lowercase words of a text, without accents, digits-only tokens or stop words. """
+    text = unicodedata.normalize("NFKD", str(text or "").lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return [word for word in re.findall(r"[a-z0-9]+", text)
+            if len(word) > 1 and not word.isdigit() and word not in STOP_WORDS]
+
+
+class _Postings:
+    """Growable arrays of the entries containing one term and their weights."""
+    __slots__ = ("ids", "weights", "size")
+
+    def __init__(self):
+        self.ids = np.empty(8, dtype=np.int32)
+        self.weights = np.empty(8, dtype=np.float32)
+        self.size = 0
+
+    def append(self, entry_id, weight):
+        if self.size == len(self.ids):
+            self.ids = np.resize(self.ids, self.size * 2)
+            self.weights = np.resize(self.weights, self.size * 2)
+        self.ids[self.size] = entry_id
+        self.weights[self.size] = weight
+        self.size += 1
+
+
+class SimilarityIndex:
+    """Index of past generations by reference-panel hash and scene-text TF-IDF."""
+
+    FILENAME = "similarity_index.jsonl"
+
+    def __init__(self, config):
+        """
+        Initialize the index and load the recorded generations
+
+        Args:
+            config (dict): Configuration dictionary. Reads the optional 'similarity'
+                section (enabled, image_weight, min_score, max_entries, warm_start)
+                and cache_dir.
+        """
+        similarity_config = config.get("similarity", {}) or {}
+        self.enabled = bool(similarity_config.get("enabled", True))
+        # Share of the panel hash in the combined score (the rest goes to the text)
+        self.image_weight = float(similarity_config.get("image_weight", 0.6))
+        self.min_score = float(similarity_config.get("min_score", 0.8))
+        self.max_entries = int(similarity_config.get("max_entries", 50000))
+        self.warm_start = bool(similarity_config.get("warm_start", False))
+
+        self.path = Path(config.get("cache_dir", "cache")) / self.FILENAME
+        self._lock = threading.RLock()
+        self.lookups = 0
+        self._reset()
+        if self.enabled:
+            self._load()
+
+    def _reset(self):
+        self._entries = []  # Entry metadata, None once superseded
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._styles = np.zeros(1024, dtype=np.int32)
+        self._style_codes = {}  # style name -> code in _styles
+        self._postings = {}  # term -> _Postings
+        self._by_path = {}  # result path -> entry id
+        self._live = 0
+
+    # --- Building ---
+
+    def _idf(self, term):
+        df = self._postings[term].size if term in self._postings else 0
+        return math.log((1 + len(self._entries)) / (1 + df)) + 1
+
+    def _add(self, entry, idf=None):
+        """ Adds an entry in memory, weighting its terms with idf (defaults to the current one). Caller holds the lock. """
+        entry_id = len(self._entries)
+        previous = self._by_path.get(entry["result_path"])
+        if previous is not None:
+            # The result file was overwritten: the older entry no longer describes it
+            self._entries[previous] = None
+            self._alive[previous] = False
+            self._live -= 1
+        if entry_id == len(self._hashes):
+            self._hashes = np.resize(self._hashes, entry_id * 2)
+            self._alive = np.resize(self._alive, entry_id * 2)
+            self._styles = np.resize(self._styles, entry_id * 2)
+        self._entries.append(entry)
+        self._hashes[entry_id] = np.uint64(int(entry["hash"], 16))
+        self._alive[entry_id] = True
+        self._styles[entry_id] = self._style_codes.setdefault(entry.get("style"), len(self._style_codes))
+        self._by_path[entry["result_path"]] = entry_id
+        self._live += 1
+
+        counts = Counter(tokenize(entry.get("text")))
+        idf = idf or self._idf
+        weights = {term: (1 + math.log(count)) * idf(term) for term, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+        for term, weight in weights.items():
+            self._postings.setdefault(term, _Postings()).append(entry_id, weight / norm)
+
+    def _load(self):
+        entries = []
+        lines = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue  # Torn last line after a crash
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Could not read similarity index {self.path}: {e}")
+            return
+        latest = {}  # result path -> last entry, in recording order
+        for entry in entries:
+            latest.pop(entry.get("result_path"), None)
+            latest[entry.get("result_path")] = entry
+        live = list(latest.values())[-self.max_entries:]
+        with self._lock:
+            self._rebuild(live)
+        if lines > len(live):
+            self._rewrite(live)
+        logger.info(f"Similarity index loaded: {len(live)} plan(s)")
+
+    def _rebuild(self, entries):
+        """ Rebuilds the index from entries, weighting every vector with the IDF of the whole set. Caller holds the lock. """
+        document_frequency = Counter(term for entry in entries for term in set(tokenize(entry.get("text"))))
+        total = len(entries)
+        self._reset()
+        for entry in entries:
+            self._add(entry, lambda term: math.log((1 + total) / (1 + document_frequency[term])) + 1)
+
+    def _rewrite(self, entries):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=".similarity-", suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Could not compact similarity index {self.path}: {e}")
+
+    def add(self, reference_path, text, result_path, **params):
+        """
+        Record a generation.
+
+        Args:
+            reference_path (str): Reference panel the generation was conditioned on
+            text (str): Scene text
+            result_path (str): Generated image
+            **params: JSON-serializable generation parameters (style, seed, quality, prompt, project, scene...)
+        """
+        if not self.enabled:
+            return
+        entry = {"hash": f"{cached_dhash(reference_path):016x}", "text": text or "",
+                 "result_path": str(result_path), "ts": time.time(), **params}
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._add(json.loads(line))
+            if len(self._entries) > self.max_entries * 1.25:
+                live = [entry for entry in self._entries if entry is not None][-self.max_entries:]
+                self._rebuild(live)
+                self._rewrite(live)
+                return
+            try:
+                os.makedirs(self.path.parent, exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except Exception as e:
+                logger.warning(f"Could not write similarity index {self.path}: {e}")
+
+    # --- Lookup ---
+
+    def query(self, reference_path, text, style=None, limit=3, min_score=None):
+        """
+        Find the prior generations closest to a scene.
+
+        Args:
+            reference_path (str): Reference panel of the scene
+            text (str): Scene text
+            style (str, optional): Only consider generations of this style
+            limit (int): Maximum number of matches
+            min_score (float, optional): Minimum combined score (defaults to the configured one)
+
+        Returns:
+            list: Matches, best first: the recorded entry (seed, style, quality, prompt,
+                result_path...) with score, image_similarity, text_similarity and distance
+        """
+        if not self.enabled:
+            return []
+        image_hash = np.uint64(cached_dhash(reference_path))
+        min_score = self.min_score if min_score is None else min_score
+        counts = Counter(tokenize(text))
+        with self._lock:
+            self.lookups += 1
+            count = len(self._entries)
+            if not self._live:
+                return []
+            distances = _popcount(self._hashes[:count] ^ image_hash)
+            image_similarity = 1.0 - distances / HASH_BITS
+            text_similarity = np.zeros(count, dtype=np.float32)
+            if counts:
+                weights = {term: (1 + math.log(n)) * self._idf(term) for term, n in counts.items()}
+                norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+                postings = [(self._postings[term], weight / norm) for term, weight in weights.items()
+                            if term in self._postings]
+                if postings:
+                    ids = np.concatenate([p.ids[:p.size] for p, _ in postings])
+                    products = np.concatenate([p.weights[:p.size] * weight for p, weight in postings])
+                    text_similarity = np.bincount(ids, products, minlength=count)
+                scores = self.image_weight * image_similarity + (1 - self.image_weight) * text_similarity
+            else:
+                scores = image_similarity
+            candidates = self._alive[:count] & (scores >= min_score)
+            if style is not None:
+                candidates &= self._styles[:count] == self._style_codes.get(style, -1)
+            candidate_ids = np.flatnonzero(candidates)
+            ranked = candidate_ids[np.argsort(-scores[candidate_ids], kind="stable")]
+
+            matches = []
+            for entry_id in ranked:
+                entry = self._entries[entry_id]
+                if not os.path.exists(entry["result_path"]):
+                    continue
+                matches.append({**entry, "score": round(float(scores[entry_id]), 4),
+                                "image_similarity": round(float(image_similarity[entry_id]), 4),
+                                "text_similarity": round(float(text_similarity[entry_id]), 4),
+                                "distance": int(distances[entry_id])})
+                if len(matches) >= limit:
+                    break
+            return matches
+
+    def get_stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "plans": self._live, "terms": len(self._postings),
+                    "lookups": self.lookups}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_similarity_index(config):
+    """
+    Get the process-wide similarity index (generators are created per request, the index is shared).
+
+    Args:
+        config (dict): Configuration dictionary, used on first call only
+
+    Returns:
+        SimilarityIndex: Shared index
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SimilarityIndex(config)
+        return _index
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Single-Flight Generation
+
+Identical generation requests that arrive while one is already running (a
+double-click, a preview overlapping a batch run) wait for that generation
+instead of sending the same work to the GPU again. Requests are identified by
+the result cache key, so "identical" means the same reference image, resolved
+workflow, models and seed.
+
+Works across event loops: Flask runs every async view in its own loop, so
+followers wait on a future of their own loop, resolved thread-safely when the
+leader finishes. If the leader is cancelled, its followers are not: one of
+them runs the generation instead.
+"""
+
+import asyncio
+import logging
+import threading
+
+from generation.cancellation import GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+_RETRY = object()  # Resolves the followers of a cancelled leader
+
+
+def _settle(future, result, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class _Flight:
+    __slots__ = ("waiters",)
+
+    def __init__(self):
+        self.waiters = []  # (event loop, future)
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers with the same key share its outcome."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> _Flight
+        self.leaders = 0
+        self.shared = 0
+
+    async def run(self, key, factory):
+        """
+        Run factory() unless a call with the same key is in flight, in which case wait for its outcome.
+
+        Args:
+            key (str): Request key
+            factory (callable): Returns the coroutine to run when this caller leads
+
+        Returns:
+            The result of the (possibly shared) call. Exceptions are shared too,
+            except cancellation of the leader.
+        """
+        while True:
+            loop = asyncio.get_running_loop()
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = _Flight()
+                    self.leaders += 1
+                    waiter = None
+                else:
+                    waiter = loop.create_future()
+                    flight.waiters.append((loop, waiter))
+                    self.shared += 1
+
+            if waiter is None:
+                return await self._lead(key, flight, factory)
+
+            logger.info(f"Identical generation already in flight ({key[:12]}), waiting for it")
+            try:
+                result = await waiter
+            except asyncio.CancelledError:
+                with self._lock:
+                    if (loop, waiter) in flight.waiters:
+                        flight.waiters.remove((loop, waiter))
+                raise
+            if result is not _RETRY:
+                return result
+
+    async def _lead(self, key, flight, factory):
+        result, error = None, None
+        try:
+            result = await factory()
+            return result
+        except (asyncio.CancelledError, GenerationCancelled):
+            # The followers did not ask for cancellation: wake them up so that one of them takes over
+            result = _RETRY
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+                waiters = list(flight.waiters)
+            for loop, future in waiters:
+                try:
+                    loop.call_soon_threadsafe(_settle, future, result, error)
+                except RuntimeError:
+                    pass  # The follower's loop is closed
+
+    def in_flight(self):
+        """ Number of distinct calls currently running. """
+        with self._lock:
+            return len(self._flights)
+
+    def get_stats(self):
+        return {"in_flight": self.in_flight(), "leaders": self.leaders, "shared": self.shared}
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """
+    Get the process-wide single-flight layer of image generation.
+
+    Returns:
+        SingleFlight: Shared by every ImageGenerator of the process
+    """
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
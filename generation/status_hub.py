@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ComfyUI Generation Status Hub
+
+A single WebSocket subscription to ComfyUI, run in a background thread, keeps
+an in-memory status for every tracked prompt (queued, running with the
+executing node and sampler step, completed with its images, error). Web
+handlers read that status or subscribe to its updates instead of querying
+ComfyUI's /history on every browser poll.
+
+ComfyUI only sends execution events to the client id that queued a prompt,
+so prompts must be submitted with the hub's client_id to be followed live.
+The binary latent previews sent during sampling are kept in the shared
+preview buffer (see generation.previews), under the prompt id and the job id
+given to track().
+"""
+
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import aiohttp
+
+from generation.previews import decode_preview_frame, get_preview_buffer
+
+logger = logging.getLogger(__name__)
+
+FINAL_STATUSES = {"completed", "error", "interrupted"}
+
+
+def _resolve(future, snapshot):
+    if not future.done():
+        future.set_result(snapshot)
+
+
+class ComfyUIStatusHub:
+    """Tracks ComfyUI prompt progress from the WebSocket event stream and fans it out to subscribers."""
+
+    def __init__(self, base_url, client_id=None, max_finished=1000):
+        """
+        Initialize the hub (call start() to connect)
+
+        Args:
+            base_url (str): ComfyUI base URL (e.g. http://127.0.0.1:8188)
+            client_id (str, optional): Client id used for the WebSocket and for queued prompts
+            max_finished (int): Number of finished prompts kept in memory
+        """
+        self.base_url = base_url.rstrip("/")
+        self.client_id = client_id or f"madsea-hub-{uuid.uuid4()}"
+        self.max_finished = max_finished
+        self.connected = False
+        self.queue_remaining = None
+
+        self._lock = threading.Lock()
+        self._states = OrderedDict()  # prompt_id -> status dict
+        self._subscribers = {}  # subscriber queue -> prompt_id filter (None = all prompts)
+        self._waiters = {}  # prompt_id -> [(event loop, future)] resolved when the prompt finishes
+        self._pending_reconcile = set()
+        self._running_prompt = None  # Prompt the next preview frame without metadata belongs to
+        self.previews = get_preview_buffer()
+        self._loop = None
+        self._thread = None
+        self._stopping = False
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """ Starts the background subscription thread (idempotent). """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="comfyui-status-hub", daemon=True)
+            self._thread.start()
+        logger.info(f"ComfyUI status hub started for {self.base_url} (client id {self.client_id})")
+
+    def stop(self):
+        """ Stops the subscription thread. """
+        self._stopping = True
+        if self._loop:
+            self._loop.call_soon_threadsafe(lambda: None)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._listen_forever())
+        finally:
+            self._loop.close()
+
+    async def _listen_forever(self):
+        backoff = 1.0
+        failures = 0
+        ws_url = self.base_url.replace("http://", "ws://").replace("https://", "wss://")
+        ws_url = f"{ws_url}/ws?clientId={self.client_id}"
+        async with aiohttp.ClientSession() as session:
+            while not self._stopping:
+                try:
+                    async with session.ws_connect(ws_url, heartbeat=30) as ws:
+                        self.connected = True
+                        backoff = 1.0
+                        failures = 0
+                        logger.info(f"Status hub connected to {ws_url}")
+                        # Events may have been missed while disconnected
+                        await self._reconcile(session, self._unfinished_prompts())
+                        while not self._stopping:
+                            try:
+                                msg = await ws.receive(timeout=1.0)
+                            except asyncio.TimeoutError:
+                                msg = None
+                            if msg is not None:
+                                if msg.type == aiohttp.WSMsgType.TEXT:
+                                    try:
+                                        self._handle_event(json.loads(msg.data))
+                                    except Exception as e:
+                                        logger.debug(f"Ignoring malformed ComfyUI event: {e}")
+                                elif msg.type == aiohttp.WSMsgType.BINARY:
+                                    self._handle_preview(msg.data)
+                                elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING,
+                                                  aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                    break
+                            if self._pending_reconcile:
+                                await self._reconcile(session, self._take_pending_reconcile())
+                except Exception as e:
+                    failures += 1
+                    # Only the first failure in a row is worth a warning (ComfyUI may simply not be running)
+                    log = logger.warning if failures == 1 else logger.debug
+                    log(f"Status hub connection to {ws_url} failed: {e}. Retrying in {backoff:.0f}s")
+                finally:
+                    self.connected = False
+                if not self._stopping:
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30.0)
+
+    # --- Event handling ---
+
+    def _handle_event(self, event):
+        event_type = event.get("type")
+        data = event.get("data") or {}
+        if event_type == "status":
+            self.queue_remaining = data.get("status", {}).get("exec_info", {}).get("queue_remaining")
+            return
+
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+
+        if event_type in ("execution_start", "executing", "progress"):
+            self._running_prompt = prompt_id
+        if event_type == "execution_start":
+            self._update(prompt_id, status="running")
+        elif event_type == "executing":
+            if data.get("node") is None:
+                # Older ComfyUI versions signal the end of a prompt with node=None
+                self._update(prompt_id, status="completed", node=None)
+            else:
+                self._update(prompt_id, status="running", node=data["node"], step=None, max_steps=None)
+        elif event_type == "progress":
+            self._update(prompt_id, status="running", node=data.get("node"),
+                         step=data.get("value"), max_steps=data.get("max"))
+        elif event_type == "executed":
+            images = (data.get("output") or {}).get("images") or []
+            if images:
+                self._update(prompt_id, append_images=images, output_node=data.get("node"))
+        elif event_type == "execution_success":
+            self._update(prompt_id, status="completed", node=None)
+        elif event_type == "execution_error":
+            self._update(prompt_id, status="error",
+                         error=data.get("exception_message") or f"Error in node {data.get('node_id')}")
+        elif event_type == "execution_interrupted":
+            self._update(prompt_id, status="interrupted")
+
+    def _handle_preview(self, message):
+        preview = decode_preview_frame(message)
+        if preview is None:
+            return
+        # Frames without metadata belong to the prompt ComfyUI is running
+        prompt_id = preview.prompt_id or self._running_prompt
+        with self._lock:
+            state = self._states.get(prompt_id)
+            if state is None or state["status"] in FINAL_STATUSES:
+                return
+            preview.prompt_id = prompt_id
+            preview.node = preview.node or state["node"]
+            preview.step = state["step"]
+            preview.max_steps = state["max_steps"]
+            job_id = state["meta"].get("job_id")
+        self.previews.put(preview, (prompt_id, job_id))
+
+    def _update(self, prompt_id, append_images=None, output_node=None, **changes):
+        with self._lock:
+            state = self._states.get(prompt_id)
+            if state is None:
+                state = self._new_state(prompt_id)
+                self._states[prompt_id] = state
+            if state["status"] in FINAL_STATUSES and changes.get("status") not in (None, "error", "interrupted"):
+                # Late events for a finished prompt do not reopen it
+                changes.pop("status", None)
+            state.update(changes)
+            if append_images:
+                state["images"] = state["images"] + [image for image in append_images if image not in state["images"]]
+                if output_node is not None:
+                    state["outputs"] = {**state["outputs"], output_node: append_images}
+            state["updated"] = time.time()
+            snapshot = self._snapshot(state)
+            subscribers = [q for q, prompt_filter in self._subscribers.items()
+                           if prompt_filter is None or prompt_filter == prompt_id]
+            waiters = self._waiters.pop(prompt_id, []) if state["status"] in FINAL_STATUSES else []
+            self._trim()
+        for subscriber in subscribers:
+            subscriber.put(snapshot)
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, future, snapshot)
+            except RuntimeError:
+                pass  # The waiter's loop is closed
+
+    @staticmethod
+    def _new_state(prompt_id):
+        return {"prompt_id": prompt_id, "status": "queued", "node": None, "step": None, "max_steps": None,
+                "images": [], "outputs": {}, "error": None, "meta": {}, "updated": time.time()}
+
+    @staticmethod
+    def _snapshot(state):
+        snapshot = dict(state)
+        snapshot["images"] = list(state["images"])
+        snapshot["outputs"] = dict(state["outputs"])
+        snapshot["meta"] = dict(state["meta"])
+        if state["status"] == "completed":
+            snapshot["progress"] = 100
+        elif state["step"] is not None and state["max_steps"]:
+            snapshot["progress"] = int(100 * state["step"] / state["max_steps"])
+        else:
+            snapshot["progress"] = 0
+        return snapshot
+
+    def _trim(self):
+        """ Forgets the oldest finished prompts beyond max_finished. Caller holds the lock. """
+        finished = [pid for pid, state in self._states.items()
+                    if state["status"] in FINAL_STATUSES and pid not in self._waiters]
+        for prompt_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._states[prompt_id]
+
+    # --- Reconciliation with /history (only after (re)connecting or for prompts queued elsewhere) ---
+
+    def _unfinished_prompts(self):
+        with self._lock:
+            return [pid for pid, state in self._states.items() if state["status"] not in FINAL_STATUSES]
+
+    def _take_pending_reconcile(self):
+        with self._lock:
+            pending, self._pending_reconcile = self._pending_reconcile, set()
+        return pending
+
+    async def _reconcile(self, session, prompt_ids):
+        for prompt_id in prompt_ids:
+            try:
+                async with session.get(f"{self.base_url}/history/{prompt_id}",
+                                       timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    history = (await response.json()).get(prompt_id)
+            except Exception as e:
+                logger.debug(f"Could not reconcile prompt {prompt_id}: {e}")
+                continue
+            if not history:
+                continue
+            images = [image for output in history.get("outputs", {}).values() for image in output.get("images", [])]
+            status_str = history.get("status", {}).get("status_str")
+            if status_str == "error":
+                self._update(prompt_id, status="error", error="Execution failed", append_images=images)
+            elif history.get("status", {}).get("completed") or images:
+                self._update(prompt_id, status="completed", node=None, append_images=images)
+
+    # --- Public API ---
+
+    def track(self, prompt_id, **meta):
+        """
+        Start tracking a prompt queued with this hub's client_id.
+
+        Args:
+            prompt_id (str): ComfyUI prompt id
+            **meta: Extra information returned with the status (job id, scene id...)
+        """
+        with self._lock:
+            state = self._states.get(prompt_id)
+            if state is None:
+                state = self._new_state(prompt_id)
+                self._states[prompt_id] = state
+            state["meta"].update(meta)
+
+    def get_status(self, prompt_id):
+        """
+        Get the current status of a prompt from memory.
+
+        Args:
+            prompt_id (str): ComfyUI prompt id
+
+        Returns:
+            dict or None: Status snapshot, None if the prompt is unknown. An unknown
+                prompt is tracked and checked once against /history in the background.
+        """
+        with self._lock:
+            state = self._states.get(prompt_id)
+            if state is None:
+                self._states[prompt_id] = self._new_state(prompt_id)
+                self._pending_reconcile.add(prompt_id)
+                return None
+            return self._snapshot(state)
+
+    async def wait(self, prompt_id, timeout=None):
+        """
+        Wait until a prompt is completed, failed or interrupted.
+
+        Can be awaited from any event loop (the hub runs in its own thread).
+
+        Args:
+            prompt_id (str): ComfyUI prompt id
+            timeout (float, optional): Maximum wait in seconds
+
+        Returns:
+            dict or None: Final status snapshot, None on timeout
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            state = self._states.get(prompt_id)
+            if state is None:
+                self._states[prompt_id] = self._new_state(prompt_id)
+            elif state["status"] in FINAL_STATUSES:
+                return self._snapshot(state)
+            self._waiters.setdefault(prompt_id, []).append((loop, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(prompt_id)
+                if waiters and (loop, future) in waiters:
+                    waiters.remove((loop, future))
+                    if not waiters:
+                        del self._waiters[prompt_id]
+
+    def mark_interrupted(self, prompt_id):
+        """
+        Mark a prompt as interrupted (used when it was removed from ComfyUI's queue,
+        which sends no event for it). Releases its waiters.
+
+        Args:
+            prompt_id (str): ComfyUI prompt id
+        """
+        self._update(prompt_id, status="interrupted")
+
+    def subscribe(self, prompt_id=None):
+        """
+        Subscribe to status updates.
+
+        Args:
+            prompt_id (str, optional): Only receive updates for this prompt
+
+        Returns:
+            queue.Queue: Receives status snapshots; pass it to unsubscribe() when done
+        """
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers[subscriber] = prompt_id
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+def get_status_hub(base_url):
+    """
+    Get the shared, started status hub of a ComfyUI backend.
+
+    Args:
+        base_url (str): ComfyUI base URL
+
+    Returns:
+        ComfyUIStatusHub: Hub shared by every caller in the process
+    """
+    key = base_url.rstrip("/")
+    with _hubs_lock:
+        hub = _hubs.get(key)
+        if hub is None:
+            hub = ComfyUIStatusHub(key)
+            _hubs[key] = hub
+    hub.start()
+    return hub
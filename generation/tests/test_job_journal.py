@@ -0,0 +1,95 @@
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from ..cancellation import CancelToken
+from ..job_journal import JobJournal
+
+
+class TestJobJournal(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.path = self.test_dir / "jobs.jsonl"
+        self.journal = JobJournal(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_replay(self):
+        """Scenes are rebuilt as submitted, then done, and jobs end with their status"""
+        self.journal.start_job("a", "pipeline", {"project_name": "ep01"})
+        self.journal.scene_submitted("a", 0, "prompt-0", seed=7)
+        self.journal.scene_submitted("a", 1, "prompt-1", seed=8)
+        self.journal.scene_done("a", 0, {"status": "complete"})
+        self.journal.start_job("b", "pipeline", {})
+        self.journal.end_job("b", "cancelled")
+
+        jobs = JobJournal(self.path).replay()
+        self.assertEqual(jobs["a"]["params"], {"project_name": "ep01"})
+        self.assertEqual(jobs["a"]["status"], "running")
+        self.assertEqual(jobs["a"]["scenes"]["0"]["status"], "done")
+        self.assertEqual(jobs["a"]["scenes"]["0"]["result"], {"status": "complete"})
+        self.assertEqual(jobs["a"]["scenes"]["1"]["status"], "submitted")
+        self.assertEqual(jobs["a"]["scenes"]["1"]["prompt_id"], "prompt-1")
+        self.assertEqual(jobs["a"]["scenes"]["1"]["details"], {"seed": 8})
+        self.assertEqual(jobs["b"]["status"], "cancelled")
+        self.assertEqual([job["job_id"] for job in self.journal.unfinished_jobs(kind="pipeline")], ["a"])
+
+    def test_replay_ignores_torn_last_line(self):
+        """A write cut by a crash is skipped, and the next record starts on its own line"""
+        self.journal.start_job("a", "pipeline", {})
+        self.journal.scene_submitted("a", 0, "prompt-0")
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('{"type": "done", "job_id": "a", "sce')
+
+        journal = JobJournal(self.path)
+        self.assertEqual(journal.job_state("a")["scenes"]["0"]["status"], "submitted")
+
+        journal.scene_done("a", 0, {"status": "complete"})
+        self.assertEqual(journal.job_state("a")["scenes"]["0"]["status"], "done")
+        lines = self.path.read_text(encoding='utf-8').splitlines()
+        self.assertEqual(json.loads(lines[-1])["type"], "done")
+
+    def test_compact(self):
+        """Compaction drops finished jobs (but the most recent kept ones) and keeps unfinished ones intact"""
+        for job_id in ("old", "recent"):
+            self.journal.start_job(job_id, "pipeline", {})
+            self.journal.scene_done(job_id, 0, {"status": "complete"})
+            self.journal.end_job(job_id, "completed")
+        self.journal.start_job("running", "pipeline", {})
+        self.journal.scene_submitted("running", 3, "prompt-3", seed=1)
+        before = self.journal.job_state("running")
+
+        self.journal.compact(keep_finished=1)
+
+        jobs = JobJournal(self.path).replay()
+        self.assertEqual(sorted(jobs), ["recent", "running"])
+        self.assertEqual(jobs["running"]["scenes"], before["scenes"])
+        self.assertEqual(list(self.test_dir.glob(".journal-*")), [])
+
+        self.journal.compact()
+        self.assertEqual(sorted(JobJournal(self.path).replay()), ["running"])
+
+    def test_compact_without_finished_jobs(self):
+        self.journal.start_job("a", "pipeline", {})
+        content = self.path.read_bytes()
+        self.journal.compact()
+        self.assertEqual(self.path.read_bytes(), content)
+
+    def test_submissions_journaled_through_cancel_token(self):
+        """Prompts tracked by a job's token reach the journal with what is needed to reattach"""
+        self.journal.start_job("a", "pipeline", {})
+        token = CancelToken("a")
+        token.on_track = lambda prompt_id, base_url, scene_key, details: self.journal.scene_submitted(
+            "a", scene_key, prompt_id, base_url=base_url, **details)
+        token.track("prompt-2", "http://127.0.0.1:8188", 2, details={"seed": 5, "output_node_id": "9"})
+
+        scene = self.journal.job_state("a")["scenes"]["2"]
+        self.assertEqual(scene["prompt_id"], "prompt-2")
+        self.assertEqual(scene["details"], {"base_url": "http://127.0.0.1:8188", "seed": 5, "output_node_id": "9"})
+
+
+if __name__ == '__main__':
+    unittest.main()
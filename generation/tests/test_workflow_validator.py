@@ -0,0 +1,144 @@
+import unittest
+from types import SimpleNamespace
+
+from ..generator import LocalGenerator
+from ..workflow_templates import CompiledWorkflow
+from ..workflow_validator import validate_workflow
+
+CHECKPOINT = "runwayml/stable-diffusion-v1-5"
+CONTROLNET = "lllyasviel/control_v11p_sd15_scribble"
+
+# Subset of a ComfyUI /object_info response, with the inputs and outputs of the core nodes
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {"input": {"required": {"ckpt_name": [[CHECKPOINT]]}},
+                               "output": ["MODEL", "CLIP", "VAE"]},
+    "CLIPTextEncode": {"input": {"required": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}},
+                       "output": ["CONDITIONING"]},
+    "LoadImage": {"input": {"required": {"image": [["reference.png"], {"image_upload": True}]}},
+                  "output": ["IMAGE", "MASK"]},
+    "ControlNetLoader": {"input": {"required": {"control_net_name": [[CONTROLNET]]}},
+                         "output": ["CONTROL_NET"]},
+    "ControlNetApply": {"input": {"required": {"conditioning": ["CONDITIONING"], "control_net": ["CONTROL_NET"],
+                                               "image": ["IMAGE"],
+                                               "strength": ["FLOAT", {"min": 0.0, "max": 10.0}]}},
+                        "output": ["CONDITIONING"]},
+    "KSampler": {"input": {"required": {"model": ["MODEL"],
+                                        "seed": ["INT", {"min": 0, "max": 0xffffffffffffffff}],
+                                        "steps": ["INT", {"min": 1, "max": 10000}],
+                                        "cfg": ["FLOAT", {"min": 0.0, "max": 100.0}],
+                                        "sampler_name": [["euler", "euler_ancestral", "dpmpp_2m"]],
+                                        "scheduler": [["normal", "karras"]],
+                                        "positive": ["CONDITIONING"], "negative": ["CONDITIONING"],
+                                        "latent_image": ["LATENT"],
+                                        "denoise": ["FLOAT", {"min": 0.0, "max": 1.0}]}},
+                 "output": ["LATENT"]},
+    "EmptyLatentImage": {"input": {"required": {"width": ["INT", {"min": 16, "max": 16384}],
+                                                "height": ["INT", {"min": 16, "max": 16384}],
+                                                "batch_size": ["INT", {"min": 1, "max": 4096}]}},
+                         "output": ["LATENT"]},
+    "VAEDecode": {"input": {"required": {"samples": ["LATENT"], "vae": ["VAE"]}}, "output": ["IMAGE"]},
+    "SaveImage": {"input": {"required": {"images": ["IMAGE"], "filename_prefix": ["STRING"]}}, "output": []},
+    "PreviewAny": {"input": {"required": {"source": ["*"]}, "optional": {"label": ["COMBO", {"options": ["a", "b"]}]}},
+                   "output": []},
+}
+
+
+def default_workflow():
+    generator = SimpleNamespace(config={"models": {"stable_diffusion": CHECKPOINT, "controlnet": CONTROLNET}},
+                                resolution=(1024, 768))
+    return LocalGenerator._create_default_workflow(generator)
+
+
+class TestDefaultWorkflow(unittest.TestCase):
+    def test_default_workflow_is_valid(self):
+        """The fallback graph only needs its reference image to run"""
+        workflow = default_workflow()
+        workflow["6"]["inputs"]["image"] = "reference.png"
+        self.assertEqual(validate_workflow(workflow, OBJECT_INFO), [])
+
+    def test_compiled_default_workflow_is_valid(self):
+        """The compiled template fills prompt, reference and sampler settings without breaking the graph"""
+        compiled = CompiledWorkflow(default_workflow(), name="default")
+        workflow, output_node_id = compiled.instantiate(prompt="a cat on a roof", negative_prompt="blurry",
+                                                        image="reference.png", seed=3, steps=12,
+                                                        width=1024, height=768)
+        self.assertEqual(validate_workflow(workflow, OBJECT_INFO), [])
+        self.assertEqual(output_node_id, "11")
+        self.assertEqual(workflow["4"]["inputs"]["text"], "a cat on a roof")
+        self.assertEqual(workflow["8"]["inputs"]["positive"], ["12", 0])
+
+
+class TestValidateWorkflow(unittest.TestCase):
+    def setUp(self):
+        self.workflow = default_workflow()
+        self.workflow["6"]["inputs"]["image"] = "reference.png"
+
+    def assertProblem(self, fragment):
+        problems = validate_workflow(self.workflow, OBJECT_INFO)
+        self.assertEqual(len(problems), 1, problems)
+        self.assertIn(fragment, problems[0])
+
+    def test_unknown_class(self):
+        self.workflow["11"]["class_type"] = "SaveImageWebsocket"
+        self.assertProblem("unknown node class 'SaveImageWebsocket'")
+
+    def test_missing_required_input(self):
+        del self.workflow["8"]["inputs"]["denoise"]
+        self.assertProblem("required input 'denoise' is missing")
+
+    def test_extra_literal_is_ignored(self):
+        self.workflow["11"]["inputs"]["save_to"] = "output"
+        self.assertEqual(validate_workflow(self.workflow, OBJECT_INFO), [])
+
+    def test_link_into_missing_input(self):
+        self.workflow["8"]["inputs"]["control_net"] = ["7", 0]
+        self.assertProblem("has no input 'control_net' (linked from node 7)")
+
+    def test_link_to_missing_node(self):
+        self.workflow["10"]["inputs"]["vae"] = ["99", 0]
+        self.assertProblem("links to missing node 99")
+
+    def test_link_to_missing_output(self):
+        self.workflow["10"]["inputs"]["vae"] = ["3", 3]
+        self.assertProblem("uses output 3 of node 3 (CheckpointLoaderSimple), which has 3")
+
+    def test_type_mismatch(self):
+        self.workflow["4"]["inputs"]["clip"] = ["3", 0]
+        self.assertProblem("expects CLIP but node 3 (CheckpointLoaderSimple) output 0 is MODEL")
+
+    def test_wildcard_type(self):
+        self.workflow["13"] = {"class_type": "PreviewAny", "inputs": {"source": ["10", 0]}}
+        self.assertEqual(validate_workflow(self.workflow, OBJECT_INFO), [])
+
+    def test_missing_model_choice(self):
+        self.workflow["3"]["inputs"]["ckpt_name"] = "sdxl.safetensors"
+        self.assertProblem("'sdxl.safetensors' is not available on the server")
+
+    def test_combo_options(self):
+        self.workflow["13"] = {"class_type": "PreviewAny", "inputs": {"source": ["10", 0], "label": "c"}}
+        self.assertProblem("'c' is not available on the server (choices: a, b)")
+
+    def test_upload_choice_accepts_any_file(self):
+        self.workflow["6"]["inputs"]["image"] = "uploaded_later.png"
+        self.assertEqual(validate_workflow(self.workflow, OBJECT_INFO), [])
+        self.workflow["6"]["inputs"]["image"] = ""
+        self.assertProblem("no file given")
+
+    def test_number_bounds(self):
+        self.workflow["8"]["inputs"]["steps"] = 0
+        self.assertProblem("0 is below the minimum 1")
+        self.workflow["8"]["inputs"]["steps"] = 20
+        self.workflow["8"]["inputs"]["denoise"] = 1.5
+        self.assertProblem("1.5 is above the maximum 1.0")
+
+    def test_number_type(self):
+        self.workflow["8"]["inputs"]["cfg"] = "high"
+        self.assertProblem("expected FLOAT, got 'high'")
+
+    def test_bool_is_not_a_number(self):
+        self.workflow["9"]["inputs"]["batch_size"] = True
+        self.assertProblem("expected INT, got True")
+
+
+if __name__ == '__main__':
+    unittest.main()
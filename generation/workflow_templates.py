@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compiled ComfyUI Workflow Templates
+
+Workflow templates are parsed and validated once, then compiled into an
+object holding the ids of the nodes each generation parameter lives in
+(prompt, negative prompt, image, LoRA, seed, sampler, latent size, output).
+Each scene gets a cheap structural copy of the template where only those
+nodes are patched, instead of re-reading the JSON file and scanning every
+node.
+
+Compiled templates are cached per file and recompiled when the file changes
+on disk (size or modification time).
+"""
+
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SAMPLER_CLASSES = ("KSampler", "KSamplerAdvanced")
+TEXT_ENCODE_CLASSES = ("CLIPTextEncode",)
+IMAGE_LOADER_CLASSES = ("LoadImage",)
+LORA_CLASSES = ("LoraLoader",)
+LATENT_CLASSES = ("EmptyLatentImage",)
+OUTPUT_CLASSES = ("SaveImage", "PreviewImage")
+
+
+class WorkflowTemplateError(ValueError):
+    """Raised when a workflow template is malformed."""
+
+
+def _link_source(value):
+    """ Returns the node id a link input points to, or None if the input is a literal. """
+    if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+        return value[0]
+    return None
+
+
+class CompiledWorkflow:
+    """A validated workflow template with precomputed parameter slots."""
+
+    def __init__(self, workflow, name="<inline>"):
+        """
+        Validate and compile a workflow
+
+        Args:
+            workflow (dict): Workflow in ComfyUI API format
+            name (str): Template name, for error messages
+
+        Raises:
+            WorkflowTemplateError: If the workflow is malformed
+        """
+        self.name = name
+        self.nodes = workflow
+        self._validate()
+
+        self.sampler_node = self._first(SAMPLER_CLASSES)
+        self.latent_node = self._first(LATENT_CLASSES)
+        self.output_node = self._first(OUTPUT_CLASSES)
+        self.image_nodes = self._all(IMAGE_LOADER_CLASSES)
+        self.lora_nodes = self._all(LORA_CLASSES)
+        self.prompt_node, self.negative_node = self._find_prompt_nodes()
+
+        sampler_inputs = self.nodes[self.sampler_node]["inputs"] if self.sampler_node else {}
+        self.seed_input = "noise_seed" if "noise_seed" in sampler_inputs else "seed"
+        self.lora_strength_inputs = {
+            node_id: "strength_model" if "strength_model" in self.nodes[node_id]["inputs"] else "strength"
+            for node_id in self.lora_nodes
+        }
+
+    def _validate(self):
+        if not isinstance(self.nodes, dict) or not self.nodes:
+            raise WorkflowTemplateError(f"Workflow '{self.name}' must be a non-empty object of nodes (API format).")
+        for node_id, node in self.nodes.items():
+            if not isinstance(node, dict) or "class_type" not in node or not isinstance(node.get("inputs"), dict):
+                raise WorkflowTemplateError(f"Workflow '{self.name}': node {node_id} needs 'class_type' and 'inputs'.")
+            for input_name, value in node["inputs"].items():
+                source = _link_source(value)
+                if source is not None and source not in self.nodes:
+                    raise WorkflowTemplateError(
+                        f"Workflow '{self.name}': node {node_id} input '{input_name}' links to missing node {source}.")
+        if not self._first(OUTPUT_CLASSES):
+            raise WorkflowTemplateError(f"Workflow '{self.name}' has no output node ({', '.join(OUTPUT_CLASSES)}).")
+
+    def _all(self, class_types):
+        return [node_id for node_id, node in self.nodes.items() if node["class_type"] in class_types]
+
+    def _first(self, class_types):
+        node_ids = self._all(class_types)
+        return node_ids[0] if node_ids else None
+
+    def _trace_text_encoder(self, node_id, seen=None):
+        """ Follows conditioning links (e.g. through ControlNetApply) back to a text encoder. """
+        seen = seen or set()
+        while node_id is not None and node_id not in seen:
+            seen.add(node_id)
+            node = self.nodes[node_id]
+            if node["class_type"] in TEXT_ENCODE_CLASSES:
+                return node_id
+            inputs = node["inputs"]
+            node_id = _link_source(inputs.get("conditioning", inputs.get("positive")))
+        return None
+
+    def _find_prompt_nodes(self):
+        """ Locates the positive and negative text encoders. """
+        positive = negative = None
+        if self.sampler_node:
+            sampler_inputs = self.nodes[self.sampler_node]["inputs"]
+            positive = self._trace_text_encoder(_link_source(sampler_inputs.get("positive")))
+            negative = self._trace_text_encoder(_link_source(sampler_inputs.get("negative")))
+
+        if positive is None or negative is None:
+            # Fall back on node ids/titles, then on declaration order
+            encoders = self._all(TEXT_ENCODE_CLASSES)
+            for node_id in encoders:
+                title = f"{node_id} {self.nodes[node_id].get('_meta', {}).get('title', '')}".lower()
+                if negative is None and "negative" in title:
+                    negative = node_id
+                elif positive is None and "positive" in title:
+                    positive = node_id
+            remaining = [node_id for node_id in encoders if node_id not in (positive, negative)]
+            if positive is None and remaining:
+                positive = remaining.pop(0)
+            if negative is None and remaining:
+                negative = remaining.pop(0)
+        return positive, negative
+
+    def instantiate(self, prompt=None, negative_prompt=None, image=None, lora_name=None, lora_strength=None,
+                    seed=None, steps=None, cfg=None, sampler_name=None, width=None, height=None,
+                    filename_prefix=None):
+        """
+        Create a workflow for one scene. Unset parameters keep their template value.
+
+        Only the node and input dicts are copied; link lists and literals are shared
+        with the template and must not be mutated in place.
+
+        Returns:
+            tuple: (workflow dict, output node id)
+        """
+        workflow = {node_id: {**node, "inputs": dict(node["inputs"])} for node_id, node in self.nodes.items()}
+
+        def patch(node_id, input_name, value):
+            if node_id is not None and value is not None:
+                workflow[node_id]["inputs"][input_name] = value
+
+        patch(self.prompt_node, "text", prompt)
+        patch(self.negative_node, "text", negative_prompt)
+        for node_id in self.image_nodes:
+            patch(node_id, "image", image)
+        for node_id in self.lora_nodes:
+            patch(node_id, "lora_name", lora_name)
+            patch(node_id, self.lora_strength_inputs[node_id], lora_strength)
+        patch(self.sampler_node, self.seed_input, seed)
+        patch(self.sampler_node, "steps", steps)
+        patch(self.sampler_node, "cfg", cfg)
+        patch(self.sampler_node, "sampler_name", sampler_name)
+        patch(self.latent_node, "width", width)
+        patch(self.latent_node, "height", height)
+        patch(self.output_node, "filename_prefix", filename_prefix)
+        return workflow, self.output_node
+
+
+class WorkflowTemplateRegistry:
+    """Cache of compiled workflow templates, invalidated when the template file changes."""
+
+    def __init__(self):
+        self._compiled = {}  # resolved path -> (size, mtime_ns, CompiledWorkflow)
+        self._lock = threading.Lock()
+
+    def get(self, template_path):
+        """
+        Get the compiled template for a file, compiling it on first use or after a change.
+
+        Args:
+            template_path (str or Path): Path to the workflow JSON file
+
+        Returns:
+            CompiledWorkflow: The compiled template
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+            WorkflowTemplateError: If the file is not a valid workflow
+        """
+        path = Path(template_path).resolve()
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._compiled.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        try:
+            with open(path, 'r') as f:
+                workflow = json.load(f)
+        except json.JSONDecodeError as e:
+            raise WorkflowTemplateError(f"Invalid JSON in workflow template {path}: {e}") from e
+        compiled = CompiledWorkflow(workflow, name=path.name)
+        with self._lock:
+            self._compiled[path] = (stat.st_size, stat.st_mtime_ns, compiled)
+        logger.info(f"Compiled workflow template {path.name} ({len(workflow)} nodes)")
+        return compiled
+
+    def invalidate(self, template_path=None):
+        """ Drops one compiled template, or all of them. """
+        with self._lock:
+            if template_path is None:
+                self._compiled.clear()
+            else:
+                self._compiled.pop(Path(template_path).resolve(), None)
+
+
+# Shared by every generator instance
+template_registry = WorkflowTemplateRegistry()
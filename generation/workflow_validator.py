@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Workflow Validation Against /object_info
+
+ComfyUI describes every node class it knows (inputs, their types and allowed
+values, outputs) at /object_info. The schema is fetched once per backend and
+cached, and every workflow is checked against it before it is queued:
+
+- node classes exist (custom node packs installed),
+- required inputs are set, and links only go into inputs the node has,
+- links connect outputs to inputs of the same type,
+- numbers are numbers within their bounds, and choices (checkpoints, LoRAs,
+  ControlNets, samplers...) are among the values the server offers, so a
+  missing model file is reported before anything reaches the GPU.
+
+A workflow that fails is rejected in milliseconds instead of failing on the
+server after waiting in its queue. When the schema cannot be fetched, the
+workflow is not checked (the server will report errors itself).
+"""
+
+import logging
+import threading
+import time
+
+import aiohttp
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Choice lists of these inputs change as images are uploaded: the upload manager owns them
+UPLOAD_OPTION_KEYS = ("image_upload", "video_upload", "audio_upload")
+
+
+class WorkflowValidationError(ValueError):
+    """Raised when a workflow does not match the schema of the ComfyUI server."""
+
+    def __init__(self, problems, backend=None):
+        self.problems = list(problems)
+        self.backend = backend
+        summary = "; ".join(self.problems[:5])
+        more = f" (+{len(self.problems) - 5} more)" if len(self.problems) > 5 else ""
+        super().__init__(f"Invalid workflow for {backend or 'ComfyUI'}: {summary}{more}")
+
+
+def _link_source(value):
+    if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int):
+        return value
+    return None
+
+
+def _types_match(output_type, input_type):
+    if not isinstance(output_type, str) or not isinstance(input_type, str):
+        return True  # Combo inputs fed by a primitive node, or unusual schemas
+    if "*" in (output_type, input_type):
+        return True
+    return bool(set(output_type.split(",")) & set(input_type.split(",")))
+
+
+def validate_workflow(workflow, object_info):
+    """
+    Check a workflow (API format) against an /object_info schema.
+
+    Args:
+        workflow (dict): node id -> {"class_type", "inputs"}
+        object_info (dict): /object_info response
+
+    Returns:
+        list: Problems found (empty when the workflow is valid)
+    """
+    problems = []
+    for node_id, node in workflow.items():
+        class_type = node.get("class_type")
+        schema = object_info.get(class_type)
+        if schema is None:
+            problems.append(f"node {node_id}: unknown node class '{class_type}' (missing custom node?)")
+            continue
+        declared = schema.get("input") or {}
+        required = declared.get("required") or {}
+        specs = {**(declared.get("optional") or {}), **required}
+        inputs = node.get("inputs") or {}
+
+        for input_name in required:
+            if input_name not in inputs:
+                problems.append(f"node {node_id} ({class_type}): required input '{input_name}' is missing")
+
+        for input_name, value in inputs.items():
+            spec = specs.get(input_name)
+            link = _link_source(value)
+            if spec is None:
+                # Extra literals are ignored by ComfyUI; a link into a missing input means miswiring
+                if link is not None:
+                    problems.append(f"node {node_id} ({class_type}) has no input '{input_name}' "
+                                    f"(linked from node {link[0]})")
+                continue
+            input_type = spec[0] if isinstance(spec, (list, tuple)) and spec else spec
+            options = spec[1] if isinstance(spec, (list, tuple)) and len(spec) > 1 and isinstance(spec[1], dict) else {}
+            if link is not None:
+                problem = _check_link(node_id, class_type, input_name, input_type, link, workflow, object_info)
+            else:
+                problem = _check_literal(input_type, options, value)
+                if problem:
+                    problem = f"node {node_id} ({class_type}) input '{input_name}': {problem}"
+            if problem:
+                problems.append(problem)
+    return problems
+
+
+def _check_link(node_id, class_type, input_name, input_type, link, workflow, object_info):
+    source_id, output_index = link
+    source = workflow.get(source_id)
+    if source is None:
+        return f"node {node_id} ({class_type}) input '{input_name}' links to missing node {source_id}"
+    outputs = (object_info.get(source.get("class_type")) or {}).get("output")
+    if outputs is None:
+        return None  # Unknown source class is reported on its own
+    if output_index >= len(outputs):
+        return (f"node {node_id} ({class_type}) input '{input_name}' uses output {output_index} of node "
+                f"{source_id} ({source['class_type']}), which has {len(outputs)}")
+    if not _types_match(outputs[output_index], input_type):
+        return (f"node {node_id} ({class_type}) input '{input_name}' expects {input_type} but node "
+                f"{source_id} ({source['class_type']}) output {output_index} is {outputs[output_index]}")
+    return None
+
+
+def _check_literal(input_type, options, value):
+    choices = input_type if isinstance(input_type, list) else None
+    if input_type == "COMBO":
+        choices = options.get("options")
+    if choices is not None:
+        if any(options.get(key) for key in UPLOAD_OPTION_KEYS):
+            return None if value not in (None, "") else "no file given"
+        if value not in choices:
+            preview = ", ".join(str(choice) for choice in choices[:5]) + (", ..." if len(choices) > 5 else "")
+            return f"'{value}' is not available on the server (choices: {preview or 'none'})"
+        return None
+    if input_type in ("INT", "FLOAT"):
+        if isinstance(value, bool):
+            return f"expected {input_type}, got {value!r}"
+        try:
+            number = int(value) if input_type == "INT" else float(value)
+        except (TypeError, ValueError):
+            return f"expected {input_type}, got {value!r}"
+        if options.get("min") is not None and number < options["min"]:
+            return f"{number} is below the minimum {options['min']}"
+        if options.get("max") is not None and number > options["max"]:
+            return f"{number} is above the maximum {options['max']}"
+    return None
+
+
+class WorkflowValidator:
+    """Validates workflows against the cached /object_info schema of one ComfyUI backend."""
+
+    def __init__(self, base_url, ttl=600, refresh_interval=30):
+        """
+        Initialize the validator
+
+        Args:
+            base_url (str): ComfyUI base URL
+            ttl (float): Seconds before the cached schema is fetched again
+            refresh_interval (float): Minimum seconds between two refreshes forced by a
+                failed validation (models may have been added since the schema was fetched)
+        """
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._object_info = None
+        self._fetched_at = 0.0
+        self._failed_at = None  # Last failed fetch: the server is not asked again before refresh_interval
+        self.validated = 0
+        self.rejected = 0
+
+    # --- Schema cache ---
+
+    def _cached(self, max_age):
+        with self._lock:
+            if self._object_info is not None and time.time() - self._fetched_at < max_age:
+                return self._object_info
+        return None
+
+    def _backing_off(self):
+        return self._failed_at is not None and time.time() - self._failed_at < self.refresh_interval
+
+    def _fetch_failed(self, error):
+        self._failed_at = time.time()
+        logger.warning(f"Could not fetch the ComfyUI schema of {self.base_url}: {error}")
+        return self._cached(float("inf"))
+
+    def _store(self, object_info):
+        with self._lock:
+            self._object_info = object_info
+            self._fetched_at = time.time()
+            self._failed_at = None
+        logger.info(f"ComfyUI schema cached for {self.base_url}: {len(object_info)} node classes")
+        return object_info
+
+    def get_object_info(self, max_age=None, timeout=10):
+        """
+        Get the /object_info schema, from the cache while it is fresh.
+
+        Args:
+            max_age (float, optional): Maximum age of the cached schema (defaults to ttl)
+            timeout (float): HTTP timeout in seconds
+
+        Returns:
+            dict or None: Schema, None if the server could not be reached
+        """
+        cached = self._cached(self.ttl if max_age is None else max_age)
+        if cached is not None:
+            return cached
+        if self._backing_off():
+            return self._cached(float("inf"))
+        try:
+            response = requests.get(f"{self.base_url}/object_info", timeout=timeout)
+            response.raise_for_status()
+            return self._store(response.json())
+        except Exception as e:
+            return self._fetch_failed(e)
+
+    async def get_object_info_async(self, max_age=None, timeout=10):
+        """ Async variant of get_object_info(). """
+        cached = self._cached(self.ttl if max_age is None else max_age)
+        if cached is not None:
+            return cached
+        if self._backing_off():
+            return self._cached(float("inf"))
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+                async with session.get(f"{self.base_url}/object_info") as response:
+                    response.raise_for_status()
+                    return self._store(await response.json())
+        except Exception as e:
+            return self._fetch_failed(e)
+
+    def invalidate(self):
+        """ Forget the cached schema (e.g. after installing nodes or models). """
+        with self._lock:
+            self._object_info = None
+
+    # --- Validation ---
+
+    def _result(self, problems):
+        self.validated += 1
+        if problems:
+            self.rejected += 1
+        return problems
+
+    def validate(self, workflow):
+        """
+        Check a workflow against the server schema.
+
+        Args:
+            workflow (dict): Workflow in API format
+
+        Returns:
+            list: Problems found (empty when valid or when the schema is unavailable)
+        """
+        object_info = self.get_object_info()
+        if object_info is None:
+            return []
+        problems = validate_workflow(workflow, object_info)
+        if problems:
+            # The schema may predate a model or node installed since: check once more with a fresh one
+            fresh = self.get_object_info(max_age=self.refresh_interval)
+            if fresh is not object_info:
+                problems = validate_workflow(workflow, fresh)
+        return self._result(problems)
+
+    async def validate_async(self, workflow):
+        """ Async variant of validate(). """
+        object_info = await self.get_object_info_async()
+        if object_info is None:
+            return []
+        problems = validate_workflow(workflow, object_info)
+        if problems:
+            fresh = await self.get_object_info_async(max_age=self.refresh_interval)
+            if fresh is not object_info:
+                problems = validate_workflow(workflow, fresh)
+        return self._result(problems)
+
+    def check(self, workflow):
+        """ Raises WorkflowValidationError if the workflow does not match the server schema. """
+        problems = self.validate(workflow)
+        if problems:
+            raise WorkflowValidationError(problems, self.base_url)
+
+    async def check_async(self, workflow):
+        """ Async variant of check(). """
+        problems = await self.validate_async(workflow)
+        if problems:
+            raise WorkflowValidationError(problems, self.base_url)
+
+    def get_stats(self):
+        return {"backend": self.base_url, "schema_cached": self._object_info is not None,
+                "validated": self.validated, "rejected": self.rejected}
+
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+
+def get_workflow_validator(base_url, ttl=600):
+    """
+    Get the shared validator of a ComfyUI backend.
+
+    Args:
+        base_url (str): ComfyUI base URL
+        ttl (float): Schema cache lifetime in seconds, used when the validator is created
+
+    Returns:
+        WorkflowValidator: Validator shared by every caller in the process
+    """
+    key = base_url.rstrip("/")
+    with _validators_lock:
+        validator = _validators.get(key)
+        if validator is None:
+            validator = WorkflowValidator(key, ttl=ttl)
+            _validators[key] = validator
+        return validator
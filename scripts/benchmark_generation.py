@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark du pipeline de génération contre le simulateur ComfyUI.
+
+Lance scripts/comfyui_simulator.py dans le processus, génère des planches de
+storyboard synthétiques, puis mesure trois chemins de génération :
+
+- generator : ImageGenerator / LocalGenerator (prétraitement, upload, soumission, attente, téléchargement)
+- service   : backend ComfyUIService.batch_generate
+- bridge    : backend comfyui_bridge (upload + déclenchement, attente via /history)
+
+Pour chaque chemin : scènes par seconde, surcoût par scène (temps total moins
+le temps d'exécution simulé) et temps moyen par étape.
+
+Usage :
+    python scripts/benchmark_generation.py --scenes 20 --step-latency 0.01 --max-steps 4
+"""
+
+import argparse
+import asyncio
+import functools
+import importlib.util
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import requests
+from PIL import Image, ImageDraw
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from comfyui_simulator import ComfyUISimulator, build_arg_parser as simulator_arg_parser
+
+SCENARIOS = ("generator", "service", "bridge", "variants")
+
+
+class StageTimer:
+    """Mesure le temps passé dans des méthodes, par étape."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _record(self, stage, elapsed):
+        with self._lock:
+            self.totals[stage] += elapsed
+            self.counts[stage] += 1
+
+    def wrap(self, obj, attr, stage):
+        """ Remplace obj.attr par une version chronométrée (fonction ou coroutine). """
+        original = getattr(obj, attr)
+        if asyncio.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self._record(stage, time.perf_counter() - start)
+        else:
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self._record(stage, time.perf_counter() - start)
+        setattr(obj, attr, timed)
+
+    def summary(self):
+        return {stage: {"calls": self.counts[stage], "mean_ms": 1000 * self.totals[stage] / self.counts[stage]}
+                for stage in self.totals}
+
+
+class SimulatorThread:
+    """Fait tourner le simulateur dans son propre thread et event loop."""
+
+    def __init__(self, simulator, port):
+        self.simulator = simulator
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="comfyui-simulator", daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.simulator.start("127.0.0.1", self.port))
+        self._started.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+        self._started.wait(10)
+        return f"http://127.0.0.1:{self.port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.simulator.stop(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_panels(directory, count, tag, size=(1024, 768)):
+    """ Crée des planches de storyboard synthétiques (traits noirs sur fond blanc). """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        image = Image.new("RGB", size, "white")
+        draw = ImageDraw.Draw(image)
+        offset = (hash(tag) % 97) + i * 13
+        for k in range(8):
+            x = (offset * (k + 3)) % size[0]
+            y = (offset * (k + 7)) % size[1]
+            draw.line([x, y, size[0] - y % size[0], size[1] - x % size[1]], fill="black", width=3)
+            draw.ellipse([x, y, x + 80, y + 60], outline="black", width=2)
+        path = Path(directory) / f"{tag}_panel_{i:03d}.png"
+        image.save(path)
+        paths.append(str(path))
+    return paths
+
+
+def run_generator(base_url, panels, work_dir, timer):
+    from generation.generator import ImageGenerator
+    from styles.manager import StyleManager
+    from utils.api_manager import APIManager
+    from utils.cache_manager import CacheManager
+    from utils.model_manager import ModelManager
+    from utils.security import SecurityManager
+
+    host, port = base_url.rsplit("//", 1)[1].split(":")
+    config = {
+        "comfyui_host": host,
+        "comfyui_port": int(port),
+        "workflow_dir": str(ROOT_DIR / "Workflow"),
+        "styles_dir": str(ROOT_DIR / "styles"),
+        "temp_dir": str(work_dir / "generator"),
+        "cache_dir": str(work_dir / "cache"),
+        "local_models_path": str(work_dir / "models"),
+        "encryption_key_path": str(work_dir / ".encryption_key"),
+        "result_cache": {"enabled": False},  # Chaque scène doit réellement passer par ComfyUI
+        # Le schéma /object_info du simulateur est minimal (ni sorties ni modèles): pas de validation
+        "workflow_validation": {"enabled": False},
+    }
+    model_manager = ModelManager(config)
+    cache_manager = CacheManager(config)
+    generator = ImageGenerator(config, StyleManager(config, model_manager, cache_manager), model_manager,
+                               APIManager(config), cache_manager, SecurityManager(config))
+    local = generator.generator
+    timer.wrap(generator.preprocessor, "process_async", "preprocess")
+    timer.wrap(local.upload_manager, "ensure_uploaded_async", "upload")
+    timer.wrap(local, "_submit_workflow", "submit")
+    timer.wrap(local, "_wait_for_completion", "wait")
+    timer.wrap(local, "_fetch_image_http", "download")
+
+    async def run():
+        results = []
+        for i, panel in enumerate(panels):
+            path = await generator.generate(panel, f"scene {i}", "default", scene_index=i, project="benchmark")
+            results.append(bool(path) and not local.is_placeholder(path))
+        return results
+
+    return asyncio.run(run())
+
+
+def load_service(base_url, work_dir, timer):
+    spec = importlib.util.spec_from_file_location("comfyui_service", ROOT_DIR / "backend" / "services" / "ComfyUI" / "service.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    service = module.ComfyUIService(comfyui_url=base_url)
+    service.validator = None  # Voir run_generator: le simulateur accepte n'importe quel workflow
+    service.workflows_dir = str(work_dir / "service_workflows")
+    os.makedirs(service.workflows_dir, exist_ok=True)
+    with open(ROOT_DIR / "Workflow" / "default_controlnet.json", "r") as f:
+        workflow = json.load(f)
+    with open(Path(service.workflows_dir) / service.available_styles["laboratoire"], "w") as f:
+        json.dump(workflow, f)
+
+    timer.wrap(service, "upload_image", "upload")
+    timer.wrap(service, "queue_prompt", "submit")
+    timer.wrap(service, "_wait_for_output", "wait")
+    timer.wrap(service, "_download_image", "download")
+    return service
+
+
+def run_service(base_url, panels, work_dir, timer):
+    service = load_service(base_url, work_dir, timer)
+    scenes = [{"id": i, "image_path": panel, "prompt": f"scene {i}"} for i, panel in enumerate(panels)]
+    results = service.batch_generate(scenes, "laboratoire", str(work_dir / "service_output"))
+    return [result["status"] == "success" for result in results]
+
+
+def run_variants(base_url, panels, work_dir, timer):
+    # Une seule planche, balayée sur deux poids ControlNet x n graines (mode variantes)
+    service = load_service(base_url, work_dir, timer)
+    group = service.generate_variants(panels[0], str(work_dir / "variants_output"), "laboratoire", prompt="variants",
+                                      count=max(1, len(panels) // 2), seed=1000, strengths=[0.6, 0.9])
+    return [variant["status"] == "success" for variant in group["variants"]]
+
+
+def run_bridge(base_url, panels, work_dir, timer):
+    spec = importlib.util.spec_from_file_location("comfyui_bridge", ROOT_DIR / "backend" / "comfyui_bridge.py")
+    bridge = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bridge)
+    bridge.COMFYUI_BASE_URL = base_url
+    bridge.COMFYUI_API_URL = f"{base_url}/prompt"
+    bridge.COMFYUI_UPLOAD_STATE_DIR = str(work_dir / "cache")
+
+    with open(ROOT_DIR / "Workflow" / "default_controlnet.json", "r") as f:
+        template = json.load(f)
+
+    def wait_for_history(prompt_id, timeout=300):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            entry = requests.get(f"{base_url}/history/{prompt_id}", timeout=10).json().get(prompt_id)
+            if entry:
+                return entry["status"]["completed"]
+            time.sleep(0.01)
+        return False
+
+    upload = timer_wrapped(timer, "upload", bridge.upload_image_to_comfyui)
+    trigger = timer_wrapped(timer, "submit", bridge.trigger_comfyui_workflow)
+    wait = timer_wrapped(timer, "wait", wait_for_history)
+
+    results = []
+    for i, panel in enumerate(panels):
+        try:
+            name = upload(panel)["name"]
+            workflow = {node_id: {**node, "inputs": dict(node["inputs"])} for node_id, node in template.items()}
+            for node in workflow.values():
+                if node["class_type"] == "LoadImage":
+                    node["inputs"]["image"] = name
+                elif node["class_type"] == "SaveImage":
+                    node["inputs"]["filename_prefix"] = f"bridge_{i:03d}"
+            prompt_id = trigger({"prompt": workflow})["prompt_id"]
+            results.append(wait(prompt_id))
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Bridge scene {i} failed: {e}")
+            results.append(False)
+    return results
+
+
+def timer_wrapped(timer, stage, func):
+    holder = type("Holder", (), {})()
+    holder.func = func
+    timer.wrap(holder, "func", stage)
+    return holder.func
+
+
+RUNNERS = {"generator": run_generator, "service": run_service, "bridge": run_bridge, "variants": run_variants}
+
+
+def run_benchmark(args):
+    work_dir = Path(tempfile.mkdtemp(prefix="madsea-bench-"))
+    simulator = ComfyUISimulator(data_dir=work_dir / "comfyui", step_latency=args.step_latency,
+                                 node_latency=args.node_latency, default_steps=args.default_steps,
+                                 max_steps=args.max_steps, fail_rate=args.fail_rate,
+                                 http_error_rate=args.http_error_rate, seed=args.seed,
+                                 load_latency=args.load_latency)
+    server = SimulatorThread(simulator, args.port or free_port())
+    base_url = server.start()
+
+    report = {"settings": {k: v for k, v in vars(args).items() if k != "json"}, "scenarios": {}}
+    try:
+        for name in args.scenarios:
+            panels = make_panels(work_dir / "panels" / name, args.scenes, name)
+            timer = StageTimer()
+            exec_before = simulator.stats["execution_seconds"]
+            cached_before = simulator.stats["nodes_cached"]
+            start = time.perf_counter()
+            results = RUNNERS[name](base_url, panels, work_dir, timer)
+            wall = time.perf_counter() - start
+            simulated = simulator.stats["execution_seconds"] - exec_before
+            succeeded = sum(1 for ok in results if ok)
+            report["scenarios"][name] = {
+                "scenes": len(results),
+                "succeeded": succeeded,
+                "wall_seconds": wall,
+                "scenes_per_second": len(results) / wall if wall else 0.0,
+                "simulated_execution_seconds": simulated,
+                "overhead_ms_per_scene": 1000 * max(0.0, wall - simulated) / max(1, len(results)),
+                "cached_nodes": simulator.stats["nodes_cached"] - cached_before,
+                "stages": timer.summary(),
+            }
+    finally:
+        server.stop()
+    report["simulator"] = dict(simulator.stats)
+    return report
+
+
+def print_report(report):
+    print(f"{'Scenario':<10} {'Scenes':>6} {'OK':>4} {'Wall (s)':>9} {'Scenes/s':>9} {'Sim exec (s)':>12} {'Overhead/scene (ms)':>20}")
+    for name, result in report["scenarios"].items():
+        print(f"{name:<10} {result['scenes']:>6} {result['succeeded']:>4} {result['wall_seconds']:>9.2f} "
+              f"{result['scenes_per_second']:>9.2f} {result['simulated_execution_seconds']:>12.2f} "
+              f"{result['overhead_ms_per_scene']:>20.1f}")
+    for name, result in report["scenarios"].items():
+        stages = ", ".join(f"{stage} {data['mean_ms']:.1f} ms (x{data['calls']})" for stage, data in result["stages"].items())
+        print(f"  {name}: {stages}, {result['cached_nodes']} cached nodes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du pipeline de génération (simulateur ComfyUI)",
+                                     parents=[simulator_arg_parser()], conflict_handler="resolve")
+    parser.add_argument("--port", type=int, default=0, help="Port du simulateur (libre par défaut)")
+    parser.add_argument("--scenes", type=int, default=20, help="Nombre de scènes par scénario")
+    parser.add_argument("--max-steps", type=int, default=4, help="Plafond d'étapes par prompt")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--json", action="store_true", help="Sortie JSON")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Simulateur ComfyUI pour mesurer le pipeline de génération sans GPU.
+
+Implémente la partie de l'API ComfyUI utilisée par Madsea :
+/prompt, /history, /view, /upload/image, /queue, /interrupt, /system_stats,
+/object_info et le WebSocket /ws (événements status, execution_start,
+executing, progress, executed, execution_success, execution_error,
+execution_interrupted, et en option les aperçus binaires).
+
+- Latence configurable par étape de sampler, par chargement de modèle et par nœud
+- Cache des sorties de nœuds comme ComfyUI : un nœud dont les entrées (et celles de
+  ses ancêtres) n'ont pas changé depuis le prompt précédent n'est pas réexécuté
+- Injection de pannes (erreurs d'exécution, réponses HTTP 503)
+- Images de sortie déterministes : le même workflow donne toujours les mêmes pixels
+
+Usage :
+    python scripts/comfyui_simulator.py --port 8188 --step-latency 0.05
+"""
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import struct
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from aiohttp import web, WSMsgType
+from PIL import Image, ImageDraw
+
+logger = logging.getLogger("comfyui_simulator")
+
+SAMPLER_CLASSES = ("KSampler", "KSamplerAdvanced")
+OUTPUT_CLASSES = ("SaveImage", "PreviewImage")
+VOLATILE_INPUTS = ("filename_prefix",)
+
+# Spécifications d'entrée minimales renvoyées par /object_info
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {"required": {"ckpt_name": [[]]}},
+    "CLIPTextEncode": {"required": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}},
+    "LoadImage": {"required": {"image": [[], {"image_upload": True}]}},
+    "ControlNetLoader": {"required": {"control_net_name": [[]]}},
+    "ControlNetApply": {"required": {"conditioning": ["CONDITIONING"], "control_net": ["CONTROL_NET"],
+                                     "image": ["IMAGE"], "strength": ["FLOAT", {"default": 1.0}]}},
+    "LoraLoader": {"required": {"model": ["MODEL"], "clip": ["CLIP"], "lora_name": [[]],
+                                "strength_model": ["FLOAT", {"default": 1.0}],
+                                "strength_clip": ["FLOAT", {"default": 1.0}]}},
+    "KSampler": {"required": {"model": ["MODEL"], "seed": ["INT", {"default": 0}], "steps": ["INT", {"default": 20}],
+                              "cfg": ["FLOAT", {"default": 8.0}], "sampler_name": [["euler", "euler_ancestral"]],
+                              "scheduler": [["normal", "karras"]], "positive": ["CONDITIONING"],
+                              "negative": ["CONDITIONING"], "latent_image": ["LATENT"]}},
+    "EmptyLatentImage": {"required": {"width": ["INT", {"default": 512}], "height": ["INT", {"default": 512}],
+                                      "batch_size": ["INT", {"default": 1}]}},
+    "VAEDecode": {"required": {"samples": ["LATENT"], "vae": ["VAE"]}},
+    "SaveImage": {"required": {"images": ["IMAGE"], "filename_prefix": ["STRING", {"default": "ComfyUI"}]}},
+    "PreviewImage": {"required": {"images": ["IMAGE"]}},
+}
+
+
+class ComfyUISimulator:
+    """Serveur ComfyUI factice, piloté par un event loop asyncio."""
+
+    def __init__(self, data_dir=None, step_latency=0.02, node_latency=0.002, default_steps=20, max_steps=None,
+                 fail_rate=0.0, http_error_rate=0.0, previews=False, seed=0, load_latency=0.05):
+        """
+        Args:
+            data_dir (str, optional): Dossier des images input/output (temporaire par défaut)
+            step_latency (float): Durée simulée d'une étape de sampler, en secondes
+            node_latency (float): Durée simulée des autres nœuds, en secondes
+            default_steps (int): Étapes utilisées si le workflow n'en précise pas
+            max_steps (int, optional): Plafond du nombre d'étapes (accélère les benchmarks)
+            fail_rate (float): Probabilité qu'une exécution échoue (execution_error)
+            http_error_rate (float): Probabilité de répondre 503 sur /prompt, /view et /upload/image
+            previews (bool): Envoyer des aperçus JPEG binaires à chaque étape
+            seed (int): Graine des tirages de pannes
+            load_latency (float): Durée simulée d'un nœud de chargement (checkpoint, ControlNet, LoRA...)
+        """
+        self.data_dir = Path(data_dir or tempfile.mkdtemp(prefix="comfyui-sim-"))
+        self.input_dir = self.data_dir / "input"
+        self.output_dir = self.data_dir / "output"
+        os.makedirs(self.input_dir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.step_latency = step_latency
+        self.node_latency = node_latency
+        self.load_latency = load_latency
+        self.default_steps = default_steps
+        self.max_steps = max_steps
+        self.fail_rate = fail_rate
+        self.http_error_rate = http_error_rate
+        self.previews = previews
+        self.rng = random.Random(seed)
+
+        self.queue = []  # [(number, prompt_id, prompt, extra_data, output_nodes)]
+        self.running = None
+        self.history = {}
+        self.clients = {}  # clientId -> WebSocketResponse
+        self.counter = 0
+        self.image_counter = 0
+        self.interrupt_requested = False
+        self.stats = {"prompts": 0, "executed": 0, "failed": 0, "uploads": 0, "views": 0, "execution_seconds": 0.0,
+                      "nodes_executed": 0, "nodes_cached": 0}
+        self.node_cache = {}  # node_id -> signature de la dernière exécution
+        self._wakeup = None
+        self._worker = None
+        self._runner = None
+
+    # --- Application ---
+
+    def build_app(self):
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_get("/", self.handle_root)
+        app.router.add_get("/ws", self.handle_ws)
+        app.router.add_post("/prompt", self.handle_prompt)
+        app.router.add_get("/prompt", self.handle_prompt_info)
+        app.router.add_get("/history", self.handle_history)
+        app.router.add_get("/history/{prompt_id}", self.handle_history)
+        app.router.add_get("/view", self.handle_view)
+        app.router.add_post("/upload/image", self.handle_upload)
+        app.router.add_get("/queue", self.handle_queue)
+        app.router.add_post("/queue", self.handle_queue_edit)
+        app.router.add_post("/interrupt", self.handle_interrupt)
+        app.router.add_get("/system_stats", self.handle_system_stats)
+        app.router.add_get("/object_info", self.handle_object_info)
+        app.router.add_get("/object_info/{node_class}", self.handle_object_info)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app):
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.create_task(self._work())
+
+    async def _on_cleanup(self, app):
+        if self._worker:
+            self._worker.cancel()
+        for ws in list(self.clients.values()):
+            await ws.close()
+
+    async def start(self, host="127.0.0.1", port=8188):
+        """ Démarre le serveur dans l'event loop courant. """
+        self._runner = web.AppRunner(self.build_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Simulateur ComfyUI sur http://{host}:{port} (données: {self.data_dir})")
+
+    async def stop(self):
+        # Fermer d'abord les WebSockets, sinon l'arrêt du serveur attend leur fin
+        for ws in list(self.clients.values()):
+            await ws.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _http_fault(self):
+        return self.http_error_rate and self.rng.random() < self.http_error_rate
+
+    # --- WebSocket ---
+
+    async def send(self, event_type, data, sid=None):
+        """ Envoie un événement au client sid, ou à tous (même règle que ComfyUI). """
+        message = json.dumps({"type": event_type, "data": data})
+        targets = [self.clients[sid]] if sid in self.clients else ([] if sid else list(self.clients.values()))
+        for ws in targets:
+            try:
+                await ws.send_str(message)
+            except ConnectionResetError:
+                pass
+
+    async def send_preview(self, image, sid):
+        if sid not in self.clients:
+            return
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=60)
+        # Type d'événement 1 (PREVIEW_IMAGE), format 1 (JPEG), puis l'image
+        frame = struct.pack(">II", 1, 1) + buffer.getvalue()
+        try:
+            await self.clients[sid].send_bytes(frame)
+        except ConnectionResetError:
+            pass
+
+    def _queue_status(self):
+        return {"status": {"exec_info": {"queue_remaining": len(self.queue) + (1 if self.running else 0)}}}
+
+    async def handle_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sid = request.query.get("clientId") or uuid.uuid4().hex
+        self.clients[sid] = ws
+        await ws.send_str(json.dumps({"type": "status", "data": {**self._queue_status(), "sid": sid}}))
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+                # Comme ComfyUI, les messages entrants sont ignorés
+        finally:
+            if self.clients.get(sid) is ws:
+                del self.clients[sid]
+        return ws
+
+    # --- HTTP ---
+
+    async def handle_root(self, request):
+        return web.Response(text="ComfyUI simulator")
+
+    def _validate(self, prompt):
+        """ Retourne les erreurs de validation par nœud (format node_errors de ComfyUI). """
+        node_errors = {}
+        outputs = []
+        for node_id, node in prompt.items():
+            errors = []
+            if not isinstance(node, dict) or "class_type" not in node or not isinstance(node.get("inputs"), dict):
+                node_errors[node_id] = {"errors": [{"type": "invalid_node", "message": "class_type/inputs missing"}],
+                                        "class_type": None}
+                continue
+            for name, value in node["inputs"].items():
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and value[0] not in prompt:
+                    errors.append({"type": "missing_link", "message": f"Input {name} links to missing node {value[0]}"})
+            if node["class_type"] == "LoadImage":
+                image = node["inputs"].get("image")
+                if not image or not (self.input_dir / str(image)).is_file():
+                    errors.append({"type": "value_not_in_list", "message": f"Invalid image file: {image}"})
+            if errors:
+                node_errors[node_id] = {"errors": errors, "class_type": node["class_type"]}
+            if node["class_type"] in OUTPUT_CLASSES:
+                outputs.append(node_id)
+        return node_errors, outputs
+
+    async def handle_prompt(self, request):
+        if self._http_fault():
+            return web.json_response({"error": "Simulated overload"}, status=503)
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            return web.json_response({"error": "Invalid JSON"}, status=400)
+        prompt = body.get("prompt")
+        if not isinstance(prompt, dict) or not prompt:
+            return web.json_response({"error": {"type": "invalid_prompt", "message": "No prompt"},
+                                      "node_errors": {}}, status=400)
+        node_errors, outputs = self._validate(prompt)
+        if not outputs:
+            return web.json_response({"error": {"type": "prompt_no_outputs", "message": "Prompt has no outputs"},
+                                      "node_errors": node_errors}, status=400)
+        if node_errors:
+            return web.json_response({"error": {"type": "prompt_outputs_failed_validation",
+                                                "message": "Prompt outputs failed validation"},
+                                      "node_errors": node_errors}, status=400)
+
+        prompt_id = str(uuid.uuid4())
+        number = self.counter
+        self.counter += 1
+        extra_data = {"client_id": body.get("client_id")}
+        self.queue.append((number, prompt_id, prompt, extra_data, outputs))
+        self.stats["prompts"] += 1
+        self._wakeup.set()
+        await self.send("status", self._queue_status())
+        return web.json_response({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+
+    async def handle_prompt_info(self, request):
+        return web.json_response({"exec_info": self._queue_status()["status"]["exec_info"]})
+
+    async def handle_history(self, request):
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id:
+            return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+        max_items = int(request.query.get("max_items", 0)) or None
+        items = list(self.history.items())
+        return web.json_response(dict(items[-max_items:] if max_items else items))
+
+    async def handle_view(self, request):
+        if self._http_fault():
+            return web.json_response({"error": "Simulated overload"}, status=503)
+        filename = request.query.get("filename", "")
+        folder = self.input_dir if request.query.get("type") == "input" else self.output_dir
+        path = (folder / request.query.get("subfolder", "") / filename).resolve()
+        if folder.resolve() not in path.parents or not path.is_file():
+            return web.Response(status=404)
+        self.stats["views"] += 1
+        return web.FileResponse(path)
+
+    async def handle_upload(self, request):
+        if self._http_fault():
+            return web.json_response({"error": "Simulated overload"}, status=503)
+        reader = await request.multipart()
+        fields, data, filename = {}, None, None
+        async for part in reader:
+            if part.name == "image":
+                filename = os.path.basename(part.filename or "upload.png")
+                data = await part.read()
+            else:
+                fields[part.name] = await part.text()
+        if data is None:
+            return web.Response(status=400)
+        folder = self.input_dir / fields.get("subfolder", "")
+        os.makedirs(folder, exist_ok=True)
+        target = folder / filename
+        if target.exists() and fields.get("overwrite", "").lower() != "true" and target.read_bytes() != data:
+            # Même règle que ComfyUI : un nom existant au contenu différent est renommé
+            stem, suffix, i = target.stem, target.suffix, 1
+            while target.exists():
+                target = folder / f"{stem} ({i}){suffix}"
+                i += 1
+        target.write_bytes(data)
+        self.stats["uploads"] += 1
+        return web.json_response({"name": target.name, "subfolder": fields.get("subfolder", ""), "type": "input"})
+
+    async def handle_queue(self, request):
+        return web.json_response({
+            "queue_running": [list(self.running)] if self.running else [],
+            "queue_pending": [list(item) for item in self.queue],
+        })
+
+    async def handle_queue_edit(self, request):
+        body = await request.json()
+        if body.get("clear"):
+            self.queue.clear()
+        for prompt_id in body.get("delete", []):
+            self.queue = [item for item in self.queue if item[1] != prompt_id]
+        await self.send("status", self._queue_status())
+        return web.Response(status=200)
+
+    async def handle_interrupt(self, request):
+        if self.running:
+            self.interrupt_requested = True
+        return web.Response(status=200)
+
+    async def handle_system_stats(self, request):
+        return web.json_response({
+            "system": {"os": os.name, "python_version": "simulator", "embedded_python": False},
+            "devices": [{"name": "simulator", "type": "cpu", "index": 0, "vram_total": 0, "vram_free": 0,
+                         "torch_vram_total": 0, "torch_vram_free": 0}],
+        })
+
+    async def handle_object_info(self, request):
+        info = {}
+        for node_class, inputs in OBJECT_INFO.items():
+            inputs = json.loads(json.dumps(inputs))
+            if node_class == "LoadImage":
+                inputs["required"]["image"][0] = sorted(p.name for p in self.input_dir.iterdir() if p.is_file())
+            info[node_class] = {"input": inputs, "output_node": node_class in OUTPUT_CLASSES,
+                                "name": node_class, "display_name": node_class, "category": "simulator"}
+        node_class = request.match_info.get("node_class")
+        if node_class:
+            return web.json_response({node_class: info[node_class]} if node_class in info else {})
+        return web.json_response(info)
+
+    # --- Exécution ---
+
+    def _render(self, prompt, width, height):
+        """ Image déterministe : dépend uniquement du contenu du workflow. """
+        stable = {node_id: {**node, "inputs": {k: v for k, v in node["inputs"].items() if k not in VOLATILE_INPUTS}}
+                  for node_id, node in prompt.items()}
+        digest = hashlib.sha256(json.dumps(stable, sort_keys=True, default=str).encode("utf-8")).digest()
+        rng = random.Random(digest)
+        image = Image.new("RGB", (width, height), tuple(digest[:3]))
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            x1, y1 = min(width, x0 + rng.randrange(width // 2 + 1)), min(height, y0 + rng.randrange(height // 2 + 1))
+            draw.rectangle([x0, y0, x1, y1], fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        return image
+
+    @staticmethod
+    def _signatures(prompt):
+        """ Signature de chaque nœud : classe, entrées littérales et signatures de ses ancêtres. """
+        signatures = {}
+
+        def signature(node_id, visiting=()):
+            if node_id in signatures:
+                return signatures[node_id]
+            node = prompt[node_id]
+            inputs = {}
+            for name, value in node["inputs"].items():
+                if isinstance(value, list) and len(value) == 2 and str(value[0]) in prompt and str(value[0]) not in visiting:
+                    inputs[name] = [signature(str(value[0]), visiting + (node_id,)), value[1]]
+                else:
+                    inputs[name] = value
+            payload = json.dumps([node["class_type"], inputs], sort_keys=True, default=str)
+            signatures[node_id] = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+            return signatures[node_id]
+
+        for node_id in prompt:
+            signature(node_id)
+        return signatures
+
+    async def _work(self):
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self.running = self.queue.pop(0)
+            started = time.monotonic()
+            try:
+                await self._execute(*self.running)
+            except Exception as e:
+                logger.exception(f"Erreur du simulateur: {e}")
+            finally:
+                self.stats["execution_seconds"] += time.monotonic() - started
+                self.running = None
+                self.interrupt_requested = False
+                await self.send("status", self._queue_status())
+
+    async def _execute(self, number, prompt_id, prompt, extra_data, output_nodes):
+        sid = extra_data.get("client_id")
+        messages = []
+
+        async def emit(event_type, data):
+            messages.append([event_type, {**data, "timestamp": int(time.time() * 1000)}])
+            await self.send(event_type, data, sid)
+
+        latent = next((n["inputs"] for n in prompt.values() if n["class_type"] == "EmptyLatentImage"), {})
+        width, height = int(latent.get("width", 512)), int(latent.get("height", 512))
+        failing_node = None
+        if self.fail_rate and self.rng.random() < self.fail_rate:
+            failing_node = self.rng.choice(list(prompt))
+
+        signatures = self._signatures(prompt)
+        # Les nœuds de sortie sont toujours exécutés
+        cached = [node_id for node_id, node in prompt.items()
+                  if node["class_type"] not in OUTPUT_CLASSES and self.node_cache.get(node_id) == signatures[node_id]]
+        await emit("execution_start", {"prompt_id": prompt_id})
+        await emit("execution_cached", {"nodes": cached, "prompt_id": prompt_id})
+        self.stats["nodes_cached"] += len(cached)
+        outputs, status = {}, "success"
+        image = None
+        for node_id, node in prompt.items():
+            if node_id in cached:
+                continue
+            self.stats["nodes_executed"] += 1
+            await self.send("executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id}, sid)
+            if node_id == failing_node:
+                status = "error"
+                await emit("execution_error", {"prompt_id": prompt_id, "node_id": node_id, "node_type": node["class_type"],
+                                               "exception_message": "Simulated failure", "exception_type": "RuntimeError",
+                                               "traceback": [], "executed": []})
+                break
+            if node["class_type"] in SAMPLER_CLASSES:
+                steps = int(node["inputs"].get("steps", self.default_steps))
+                if self.max_steps:
+                    steps = min(steps, self.max_steps)
+                for step in range(1, steps + 1):
+                    if self.interrupt_requested:
+                        break
+                    await asyncio.sleep(self.step_latency)
+                    await self.send("progress", {"value": step, "max": steps, "prompt_id": prompt_id, "node": node_id}, sid)
+                    if self.previews:
+                        await self.send_preview(Image.new("RGB", (64, 64), (step * 10 % 256, 0, 0)), sid)
+            elif "Loader" in node["class_type"]:
+                await asyncio.sleep(self.load_latency)
+            else:
+                await asyncio.sleep(self.node_latency)
+            if self.interrupt_requested:
+                status = "interrupted"
+                await emit("execution_interrupted", {"prompt_id": prompt_id, "node_id": node_id,
+                                                     "node_type": node["class_type"], "executed": []})
+                break
+            if node["class_type"] in OUTPUT_CLASSES:
+                if image is None:
+                    image = self._render(prompt, width, height)
+                self.image_counter += 1
+                prefix = os.path.basename(str(node["inputs"].get("filename_prefix", "ComfyUI")))
+                filename = f"{prefix}_{self.image_counter:05d}_.png"
+                await asyncio.get_running_loop().run_in_executor(None, image.save, str(self.output_dir / filename))
+                output = {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}
+                outputs[node_id] = output
+                await self.send("executed", {"node": node_id, "display_node": node_id, "output": output,
+                                             "prompt_id": prompt_id}, sid)
+
+        if status == "success":
+            self.node_cache = signatures
+            await emit("execution_success", {"prompt_id": prompt_id})
+            self.stats["executed"] += 1
+        else:
+            self.stats["failed"] += 1
+        await self.send("executing", {"node": None, "prompt_id": prompt_id}, sid)
+        self.history[prompt_id] = {
+            "prompt": [number, prompt_id, prompt, extra_data, output_nodes],
+            "outputs": outputs,
+            "status": {"status_str": "success" if status == "success" else "error",
+                       "completed": status == "success", "messages": messages},
+        }
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Simulateur ComfyUI (sans GPU)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--data-dir", default=None, help="Dossier input/output (temporaire par défaut)")
+    parser.add_argument("--step-latency", type=float, default=0.02, help="Secondes par étape de sampler")
+    parser.add_argument("--node-latency", type=float, default=0.002, help="Secondes par autre nœud")
+    parser.add_argument("--load-latency", type=float, default=0.05, help="Secondes par nœud de chargement")
+    parser.add_argument("--default-steps", type=int, default=20)
+    parser.add_argument("--max-steps", type=int, default=None, help="Plafond d'étapes par prompt")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Probabilité d'échec d'une exécution")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="Probabilité de réponse 503")
+    parser.add_argument("--previews", action="store_true", help="Envoyer des aperçus binaires")
+    parser.add_argument("--seed", type=int, default=0, help="Graine des pannes injectées")
+    return parser
+
+
+def simulator_from_args(args):
+    return ComfyUISimulator(data_dir=args.data_dir, step_latency=args.step_latency, node_latency=args.node_latency,
+                            default_steps=args.default_steps, max_steps=args.max_steps, fail_rate=args.fail_rate,
+                            http_error_rate=args.http_error_rate, previews=args.previews, seed=args.seed,
+                            load_latency=args.load_latency)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = build_arg_parser().parse_args()
+    simulator = simulator_from_args(args)
+    print(f"[comfyui_simulator] http://{args.host}:{args.port} - données: {simulator.data_dir}")
+    web.run_app(simulator.build_app(), host=args.host, port=args.port, print=None)
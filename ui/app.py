@@ -20,14 +20,20 @@ import threading
 import asyncio
 import uuid
 from pathlib import Path
-from flask import Flask, request, render_template, jsonify, send_file, redirect, url_for, current_app, send_from_directory
+from flask import Flask, Response, request, render_template, jsonify, send_file, redirect, url_for, current_app, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
 
 # Add the project root to the Python path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from parsing.parser import StoryboardParser
-from generation.generator import ImageGenerator
+from generation.generator import ImageGenerator, QUALITY_DRAFT, QUALITY_FINAL
+from generation.scheduler import Priority
+from generation.affinity import order_by_affinity
+from generation.job_journal import get_job_journal
+from generation.cancellation import GenerationCancelled, cancel_scope, get_cancel_token, release_cancel_token
+from generation.previews import get_preview_buffer, mjpeg_chunks
+from generation.similarity import get_similarity_index
 from styles.manager import StyleManager
 from video.assembler import VideoAssembler
 from utils.config import load_config, save_config
@@ -49,6 +55,10 @@ app.config['PROJECTS_BASE_DIR'] = Path('projects') # Base directory for projects
 # Key: task_id (str), Value: dict with status, progress, message, result_path, etc.
 background_tasks = {}
 
+def get_task_journal(config):
+    """ Returns the on-disk journal of generation tasks (survives server restarts). """
+    return get_job_journal(Path(config.get('cache_dir', 'cache')) / 'generation_tasks.jsonl')
+
 @app.before_request
 def ensure_managers_initialized():
     # This check ensures managers are available for every request
@@ -210,10 +220,18 @@ async def generate(project_name):
         style_name = data.get('style', config.get("style", "default"))
         use_cloud = data.get('use_cloud', config.get("use_cloud", False))
         output_filename = data.get('output_filename', f"{project_name}_video_{int(time.time())}.mp4")
+        # "draft" renders every scene quickly for review; "final" renders the approved scenes (all if omitted)
+        mode = data.get('mode', QUALITY_FINAL)
+        selected_scenes = data.get('scenes')
+        # Episodes with a deadline may burst to the cloud when the local queue is saturated (routing config)
+        deadline_minutes = data.get('deadline_minutes')
+        deadline = time.time() + float(deadline_minutes) * 60 if deadline_minutes else None
         
         # Validate parameters
         if not storyboard_filename:
             return jsonify({'error': 'Storyboard filename required'}), 400
+        if mode not in (QUALITY_DRAFT, QUALITY_FINAL):
+            return jsonify({'error': f'Invalid mode: {mode}'}), 400
 
         storyboard_path = project_dir / 'uploads' / secure_filename(storyboard_filename)
         if not storyboard_path.exists():
@@ -232,16 +250,21 @@ async def generate(project_name):
             'start_time': time.time()
         }
 
-        # Define project-specific paths for this task
-        project_config = config.copy() # Use a copy to avoid modifying global config
-        project_config["project_dir"] = project_dir # Store project path
-        project_config["temp_dir"] = project_dir / 'temp'
-        project_config["output_path"] = project_dir / 'results' / secure_filename(output_filename)
-        project_config["style"] = style_name
-        project_config["use_cloud"] = use_cloud
-        # Ensure these paths exist
-        os.makedirs(project_config["temp_dir"], exist_ok=True)
-        os.makedirs(project_config["output_path"].parent, exist_ok=True)
+        project_config = build_task_config(config, project_dir, style_name, use_cloud, output_filename,
+                                           mode, selected_scenes, deadline)
+        background_tasks[task_id]['mode'] = mode
+        background_tasks[task_id]['deadline'] = deadline
+        # Recorded so that the task can be resumed if the server stops before it ends
+        get_task_journal(config).start_job(task_id, "pipeline", {
+            'project_name': project_name,
+            'storyboard_path': str(storyboard_path),
+            'style': style_name,
+            'use_cloud': use_cloud,
+            'output_filename': output_filename,
+            'mode': mode,
+            'scenes': selected_scenes,
+            'deadline': deadline
+        })
 
         logger.info(f"Starting generation task {task_id} for project '{project_name}'...")
         # Start generation in background using asyncio
@@ -260,9 +283,35 @@ async def generate(project_name):
         logger.error(f"Error starting generation for project '{project_name}': {e}", exc_info=True)
         return jsonify({"error": "Failed to start generation"}), 500
 
+def build_task_config(config, project_dir, style_name, use_cloud, output_filename, mode=QUALITY_FINAL,
+                      selected_scenes=None, deadline=None):
+    """ Builds the configuration of a generation task (project-specific paths) and creates its directories. """
+    # Define project-specific paths for this task
+    project_config = config.copy() # Use a copy to avoid modifying global config
+    project_config["project_dir"] = project_dir # Store project path
+    project_config["temp_dir"] = project_dir / 'temp'
+    project_config["output_path"] = project_dir / 'results' / secure_filename(output_filename)
+    project_config["style"] = style_name
+    project_config["use_cloud"] = use_cloud
+    project_config["generation_mode"] = mode
+    project_config["selected_scenes"] = selected_scenes # Scene indices to generate (None = all)
+    project_config["deadline"] = deadline # Epoch time the episode must be done by (None = no deadline)
+    # Ensure these paths exist
+    os.makedirs(project_config["temp_dir"], exist_ok=True)
+    os.makedirs(project_config["output_path"].parent, exist_ok=True)
+    return project_config
+
 async def run_generation_pipeline(task_id, project_dir, parser, generator, assembler, storyboard_path, config):
     """ The actual pipeline logic, runs in background. NO VIDEO ASSEMBLY YET """
     global background_tasks
+    journal = get_task_journal(config)
+    # Scenes finished before a server restart are not generated again
+    journaled = (journal.job_state(task_id) or {}).get('scenes', {})
+    cancel_token = get_cancel_token(task_id)
+    # Every prompt queued for a scene is journaled: after a restart, the scene reattaches to it
+    # instead of queuing it again
+    cancel_token.on_track = lambda prompt_id, base_url, scene_key, details: journal.scene_submitted(
+        task_id, scene_key, prompt_id, base_url=base_url, **details)
     # Log the start with task_id
     logger.info(f"[Task {task_id}] Starting pipeline for storyboard: {storyboard_path}")
     try:
@@ -285,15 +334,59 @@ async def run_generation_pipeline(task_id, project_dir, parser, generator, assem
         if not scenes:
              raise ValueError("Scene data not found in task.")
         
-        background_tasks[task_id]['status'] = 'generating'
         total_scenes = len(scenes)
         generated_image_paths = [None] * total_scenes # Initialize list for results
 
+        quality = config.get('generation_mode', QUALITY_FINAL)
+        selected = config.get('selected_scenes')
+        selected = None if selected is None else {int(index) for index in selected}
+        
+        # Preprocess every reference image in one batch before submission starts
+        background_tasks[task_id]['status'] = 'preprocessing'
+        background_tasks[task_id]['message'] = 'Preparing reference images...'
+        await generator.preprocess_batch(
+            [str(scene.get('image', '')) for scene in scenes if scene and scene.get('image')],
+            style_name=config.get('style', 'default')
+        )
+
+        # Rewrite every scene text into an image prompt in a few batched LLM calls (cached)
+        if generator.prompt_enricher.enabled:
+            background_tasks[task_id]['status'] = 'enriching'
+            background_tasks[task_id]['message'] = 'Enriching scene prompts...'
+            await generator.enrich_prompts([scene.get('text', '') for scene in scenes if scene])
+
+        background_tasks[task_id]['status'] = 'generating'
+
+        # Scenes using the same checkpoint/LoRA run back to back (fewer model swaps in ComfyUI),
+        # no scene being delayed by more than the scheduler's affinity window
+        default_style = config.get('style', 'default')
+        signatures = {}
+        for scene_data in scenes:
+            style = (scene_data or {}).get('style') or default_style
+            if style not in signatures:
+                signatures[style] = generator.model_signature(style)
+        order = order_by_affinity(
+            [index for index in range(total_scenes) if selected is None or index in selected],
+            lambda index: signatures[(scenes[index] or {}).get('style') or default_style],
+            window=config.get('scheduler', {}).get('affinity_window', 8)
+        )
+
         # 2. Generate images sequentially (can be parallelized later)
-        for i, scene_data in enumerate(scenes):
+        for position, i in enumerate(order):
+             scene_data = scenes[i]
              current_scene_num = i + 1
+             entry = journaled.get(str(i)) or {}
+             previous = entry.get('result') or {}
+             if previous.get('status') == 'complete' and previous.get('generated_image_path') \
+                     and Path(previous['generated_image_path']).exists():
+                 generated_image_paths[i] = previous['generated_image_path']
+                 if scenes[i]: scenes[i].update(status='complete', generated_image_path=previous['generated_image_path'])
+                 continue
+             if cancel_token.is_cancelled(i) or previous.get('status') == 'cancelled':
+                 if scenes[i]: scenes[i]['status'] = 'cancelled'
+                 continue
              background_tasks[task_id]['message'] = f'Generating image for scene {current_scene_num}/{total_scenes}'
-             background_tasks[task_id]['progress'] = i # Progress based on starting scene
+             background_tasks[task_id]['progress'] = position # Progress based on scenes started
              background_tasks[task_id]['current_scene'] = current_scene_num
              if scenes[i]: scenes[i]['status'] = 'generating' # Update scene status
 
@@ -308,18 +401,39 @@ async def run_generation_pipeline(task_id, project_dir, parser, generator, assem
                  if scenes[i]: scenes[i]['error'] = 'Original image missing'
                  continue # Skip this scene
 
+             # Prompt queued before a restart and not collected: its image is fetched if ComfyUI still has it
+             reattach = None
+             if entry.get('status') == 'submitted' and entry.get('prompt_id'):
+                 reattach = {'prompt_id': entry['prompt_id'], **(entry.get('details') or {})}
+                 logger.info(f"Task {task_id}: Reattaching scene {i} to prompt {entry['prompt_id']}")
+
              try:
                  # Call the main generator's generate method
                  # Pass style from the config used for this task
-                 generated_path = await generator.generate(
-                     original_img_path,
-                     scene_text,
-                     style_name=config.get('style', 'default'), 
-                     scene_index=i
-                 )
+                 # Cancelling the task or this scene removes its prompt from ComfyUI
+                 with cancel_scope(cancel_token, i):
+                     generated_path = await generator.generate(
+                         original_img_path,
+                         scene_text,
+                         style_name=scene_data.get('style') or default_style,
+                         scene_index=i,
+                         seed=(reattach or {}).get('seed'),
+                         priority=Priority.BATCH,
+                         project=Path(project_dir).name,
+                         quality=quality,
+                         deadline=config.get('deadline'),
+                         reattach=reattach
+                     )
                  
-                 if generated_path:
+                 if generated_path and generator.is_placeholder(generated_path):
+                      # Shown in place of the image, but recorded as a failure so that a resume retries it
+                      generated_image_paths[i] = generated_path
+                      logger.error(f"Task {task_id}: Generation failed for scene {i}, placeholder written")
+                      if scenes[i]: scenes[i].update(status='error', error='Generation failed',
+                                                     generated_image_path=generated_path)
+                 elif generated_path:
                      generated_image_paths[i] = generated_path
+                     if scenes[i]: scenes[i]['quality'] = quality
                      # --- IMPORTANT: Update the scene data with the path --- 
                      if scenes[i]: scenes[i]['generated_image_path'] = generated_path 
                      if scenes[i]: scenes[i]['status'] = 'complete'
@@ -328,15 +442,27 @@ async def run_generation_pipeline(task_id, project_dir, parser, generator, assem
                       logger.error(f"Task {task_id}: Failed to generate image for scene {i}")
                       if scenes[i]: scenes[i]['status'] = 'error'
                       if scenes[i]: scenes[i]['error'] = 'Generation failed'
+             except GenerationCancelled:
+                 logger.info(f"Task {task_id}: Scene {i} cancelled")
+                 if scenes[i]: scenes[i]['status'] = 'cancelled'
              except Exception as scene_e:
                  logger.error(f"Task {task_id}: Error during generation for scene {i}: {scene_e}", exc_info=True)
                  if scenes[i]: scenes[i]['status'] = 'error'
                  if scenes[i]: scenes[i]['error'] = f'Error: {scene_e}'
+             journal.scene_done(task_id, i, {'status': (scenes[i] or {}).get('status'),
+                                             'generated_image_path': generated_image_paths[i],
+                                             'error': (scenes[i] or {}).get('error')})
 
         # 3. Update final task status (NO VIDEO ASSEMBLY)
-        background_tasks[task_id]['status'] = 'complete'
-        background_tasks[task_id]['message'] = 'Image generation complete.'
-        background_tasks[task_id]['progress'] = total_scenes
+        if cancel_token.cancelled:
+            background_tasks[task_id]['status'] = 'cancelled'
+            background_tasks[task_id]['message'] = 'Generation cancelled.'
+            journal.end_job(task_id, 'cancelled')
+        else:
+            background_tasks[task_id]['status'] = 'complete'
+            background_tasks[task_id]['message'] = 'Image generation complete.'
+            background_tasks[task_id]['progress'] = total_scenes
+            journal.end_job(task_id, 'completed')
         # Result is the list of generated image paths (or None)
         # background_tasks[task_id]['result_images'] = generated_image_paths 
 
@@ -344,6 +470,9 @@ async def run_generation_pipeline(task_id, project_dir, parser, generator, assem
         logger.error(f"Error in background generation pipeline for task {task_id}: {e}", exc_info=True)
         background_tasks[task_id]['status'] = 'error'
         background_tasks[task_id]['message'] = str(e)
+        journal.end_job(task_id, 'error', str(e))
+    finally:
+        release_cancel_token(task_id)
 
 # --- Status Endpoint ---
 @app.route('/status/<task_id>')
@@ -358,6 +487,57 @@ def get_status(task_id):
     else:
         return jsonify({"error": "Task not found"}), 404
 
+@app.route('/tasks/<task_id>/cancel', methods=['POST'])
+def cancel_task(task_id):
+    """
+    Cancel a generation task, or one of its scenes ({"scene_index": n}).
+    Queued prompts of the task are removed from ComfyUI and its running prompt is interrupted.
+    """
+    task = background_tasks.get(task_id)
+    if task is None:
+        return jsonify({"error": "Task not found"}), 404
+    if task.get('status') in ('complete', 'error', 'cancelled'):
+        return jsonify({"error": f"Task already {task['status']}"}), 409
+    scene_index = (request.get_json(silent=True) or {}).get('scene_index')
+    summary = get_cancel_token(task_id).cancel(scene_index)
+    if scene_index is None:
+        task['message'] = 'Cancelling...'
+    return jsonify({'success': True, 'task_id': task_id, 'scene_index': scene_index, **summary})
+
+@app.route('/tasks/<task_id>/preview')
+def get_task_preview(task_id):
+    """
+    Latest sampling preview of a running task (204 when there is none yet).
+    Pass ?after=<seq> to only get a preview newer than the one already shown.
+    """
+    if task_id not in background_tasks:
+        return jsonify({"error": "Task not found"}), 404
+    preview = get_preview_buffer().latest(task_id, after=request.args.get('after', 0, type=int))
+    if preview is None:
+        return '', 204
+    response = Response(preview.to_bytes(), mimetype=preview.mime_type)
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Preview-Seq'] = str(preview.seq)
+    response.headers['X-Preview-Step'] = '' if preview.step is None else str(preview.step)
+    response.headers['X-Preview-Max-Steps'] = '' if preview.max_steps is None else str(preview.max_steps)
+    return response
+
+@app.route('/tasks/<task_id>/preview/stream')
+def stream_task_preview(task_id):
+    """
+    Stream the sampling previews of a task as multipart/x-mixed-replace (usable as an <img> source),
+    throttled to previews.stream_fps. The stream ends with the task.
+    """
+    if task_id not in background_tasks:
+        return jsonify({"error": "Task not found"}), 404
+    previews_config = current_app.config['config'].get('previews', {}) or {}
+    interval = 1.0 / max(0.1, float(previews_config.get('stream_fps', 2)))
+    def task_finished():
+        return background_tasks.get(task_id, {}).get('status') in (None, 'complete', 'error', 'cancelled')
+    previews = get_preview_buffer().stream(task_id, interval=interval, is_finished=task_finished)
+    return Response(stream_with_context(mjpeg_chunks(previews)), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
 @app.route('/tasks')
 def get_tasks():
     """ Returns a summary of all current tasks. """
@@ -588,10 +768,58 @@ def start_web_app(app_config, api_manager, model_manager, cache_manager, securit
     app.config['RESULT_FOLDER'].mkdir(parents=True, exist_ok=True)
     app.config['PROJECTS_BASE_DIR'].mkdir(parents=True, exist_ok=True)
 
+    resume_generation_tasks(app_config, app.config['style_manager'], api_manager, model_manager, cache_manager,
+                            security_manager)
+
     logger.info(f"Starting Flask web server on http://{host}:{port}")
     # Use waitress or gunicorn for production instead of Flask dev server
     app.run(host=host, port=port, debug=debug)
 
+def resume_generation_tasks(config, style_manager, api_manager, model_manager, cache_manager, security_manager):
+    """
+    Resume the generation tasks interrupted by a server stop, from the task journal.
+    
+    Each task runs again in a background thread; scenes whose image was generated
+    before the stop are restored from the journal instead of being generated again,
+    and scenes whose prompt was still queued or running in ComfyUI reattach to it
+    (see ImageGenerator.generate) instead of queuing it a second time.
+    """
+    journal = get_task_journal(config)
+    journal.compact()
+    for state in journal.unfinished_jobs(kind="pipeline"):
+        task_id = state['job_id']
+        params = state['params']
+        project_dir = get_project_dir(params['project_name'])
+        storyboard_path = Path(params['storyboard_path'])
+        if not storyboard_path.exists():
+            journal.end_job(task_id, 'error', 'Storyboard no longer exists')
+            continue
+        project_config = build_task_config(config, project_dir, params['style'], params['use_cloud'],
+                                           params['output_filename'], params.get('mode', QUALITY_FINAL),
+                                           params.get('scenes'), params.get('deadline'))
+        background_tasks[task_id] = {
+            'status': 'queued',
+            'progress': 0,
+            'total': 0,
+            'current_scene': 0,
+            'message': 'Generation resumed after restart',
+            'result_video': None,
+            'project_name': params['project_name'],
+            'start_time': state.get('started') or time.time()
+        }
+        parser = StoryboardParser(project_config, cache_manager=cache_manager)
+        generator = ImageGenerator(project_config, style_manager, model_manager, api_manager, cache_manager,
+                                   security_manager)
+        assembler = VideoAssembler(project_config, cache_manager=cache_manager)
+        logger.info(f"Resuming generation task {task_id} for project '{params['project_name']}'")
+        threading.Thread(
+            target=asyncio.run,
+            args=(run_generation_pipeline(task_id, project_dir, parser, generator, assembler, storyboard_path,
+                                          project_config),),
+            name=f"resume-{task_id}",
+            daemon=True
+        ).start()
+
 # Note: Need to adjust startup.py to call this modified start_web_app
 
 @app.route('/projects/<project_name>/preview_scene', methods=['POST'])
@@ -612,6 +840,9 @@ async def preview_scene(project_name):
     scene_index = data.get('scene_index')
     style_name = data.get('style')
     use_cloud = data.get('use_cloud', False)
+    # Seed of a similar prior plan (see /similar_scene), or warm_start to pick it automatically
+    seed = data.get('seed')
+    warm_start = data.get('warm_start')
 
     # --- Input Validation ---
     if task_id not in background_tasks:
@@ -666,7 +897,11 @@ async def preview_scene(project_name):
             original_image_path,
             text,
             style_name,
-            scene_index=scene_index # Pass index for consistent naming/caching
+            scene_index=scene_index, # Pass index for consistent naming/caching
+            priority=Priority.INTERACTIVE, # Jumps ahead of batch jobs at the next free slot
+            project=project_name,
+            seed=seed,
+            warm_start=warm_start
         )
 
         if generated_image_path:
@@ -679,7 +914,8 @@ async def preview_scene(project_name):
             # Let's return the full path and fix the serving route if needed.
             return jsonify({
                 "success": True,
-                "generated_image_path": str(generated_image_path)
+                "generated_image_path": str(generated_image_path),
+                "placeholder": generator.is_placeholder(generated_image_path)
             })
         else:
             logger.error(f"Preview generation failed for scene index {scene_index}.")
@@ -690,6 +926,32 @@ async def preview_scene(project_name):
         return jsonify({"success": False, "error": f"An internal error occurred: {str(e)}"}), 500
 
 
+@app.route('/projects/<project_name>/similar_scene', methods=['POST'])
+def similar_scene(project_name):
+    """ Find prior generations (any project or episode) of a plan similar to a scene, for reuse or as a warm start. """
+    data = request.json or {}
+    task_id = data.get('task_id')
+    scene_index = data.get('scene_index')
+    if task_id not in background_tasks:
+        return jsonify({"error": "Task ID not found or task data unavailable"}), 404
+    scenes = background_tasks[task_id].get('scenes', [])
+    if not isinstance(scene_index, int) or scene_index < 0 or scene_index >= len(scenes):
+        return jsonify({"error": f"Invalid scene index: {scene_index}"}), 400
+
+    scene_data = scenes[scene_index]
+    if not scene_data.get('image') or not Path(scene_data['image']).exists():
+        return jsonify({"error": f"Original image for scene {scene_index+1} not found"}), 400
+
+    index = get_similarity_index(current_app.config['config'])
+    try:
+        matches = index.query(scene_data['image'], scene_data.get('text'), style=data.get('style'),
+                              limit=int(data.get('limit', 3)), min_score=data.get('min_score'))
+    except Exception as e:
+        logger.error(f"Similar plan lookup failed for scene {scene_index} of task {task_id}: {e}", exc_info=True)
+        return jsonify({"error": f"Similar plan lookup failed: {str(e)}"}), 500
+    return jsonify({"success": True, "matches": matches})
+
+
 if __name__ == '__main__':
     # This allows running the UI directly for development,
     # but managers won't be properly initialized without startup.py
@@ -22,16 +22,19 @@ import logging
 import requests
 import uuid
 import time
+import queue
 import base64
 from pathlib import Path
 from werkzeug.utils import secure_filename
-from flask import Blueprint, render_template, request, jsonify, send_file, Response, url_for
+from flask import Blueprint, render_template, request, jsonify, send_file, Response, url_for, stream_with_context
 
 # Add the project root to the Python path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from parsing.parser import StoryboardParser
 from generation.generator import ImageGenerator
+from generation.status_hub import get_status_hub, FINAL_STATUSES
+from generation.previews import mjpeg_chunks
 from video.assembler import VideoAssembler
 from styles.manager import StyleManager
 from utils.config import load_config
@@ -50,6 +53,7 @@ assembler = None
 comfyui_host = None
 comfyui_port = None
 workflow_dir = None
+status_hub = None
 
 # Dictionary to track generation jobs
 generation_jobs = {}
@@ -67,7 +71,7 @@ def init_comfyui_integration(app_config):
     Args:
         app_config (dict): Application configuration
     """
-    global config, style_manager, parser, generator, assembler, comfyui_host, comfyui_port, workflow_dir
+    global config, style_manager, parser, generator, assembler, comfyui_host, comfyui_port, workflow_dir, status_hub
     
     config = app_config
     style_manager = StyleManager(config)
@@ -88,6 +92,9 @@ def init_comfyui_integration(app_config):
     generator = ImageGenerator(config, style_manager)
     assembler = VideoAssembler(config)
     
+    # Single event subscription to ComfyUI, shared by every status request
+    status_hub = get_status_hub(f"http://{comfyui_host}:{comfyui_port}")
+    
     logger.info(f"ComfyUI integration initialized with host {comfyui_host}:{comfyui_port}")
     logger.info("Storyboard-to-Video components initialized")
 
@@ -662,7 +669,9 @@ def generate_scene():
         response = requests.post(
             f"http://{comfyui_host}:{comfyui_port}/prompt",
             json={
-                'prompt': workflow
+                'prompt': workflow,
+                # Events are only sent to the client that queued the prompt
+                'client_id': status_hub.client_id
             }
         )
         
@@ -684,6 +693,7 @@ def generate_scene():
             'start_time': time.time(),
             'output_image': None
         }
+        status_hub.track(prompt_id, job_id=job_id, scene_id=scene_id)
         
         return jsonify({
             'success': True,
@@ -695,10 +705,79 @@ def generate_scene():
         return jsonify({'error': f"Error generating scene: {str(e)}"}), 500
 
 
+def _resolve_prompt_id(job_id, prompt_id):
+    """ Returns the prompt ID of a job, or the given prompt ID. Raises KeyError for an unknown job. """
+    if job_id:
+        if job_id not in generation_jobs:
+            raise KeyError(job_id)
+        return generation_jobs[job_id].get('prompt_id')
+    return prompt_id
+
+
+def _completed_job_payload(job_id):
+    """
+    Status response of a job already recorded as completed, None otherwise
+    
+    Answers without the status hub, which may have lost the prompt's state
+    (process restart, trimmed states, ComfyUI history cleared).
+    """
+    job = generation_jobs.get(job_id) if job_id else None
+    if not job or job.get('status') != 'completed' or not job.get('output_image'):
+        return None
+    return {
+        'status': 'completed',
+        'job_id': job_id,
+        'scene_id': job.get('scene_id'),
+        'prompt_id': job.get('prompt_id'),
+        'progress': 100,
+        'images': [{
+            'url': job.get('output_image'),
+            'filename': os.path.basename(job.get('output_image'))
+        }]
+    }
+
+
+def _status_payload(job_id, prompt_id, state):
+    """
+    Build the status response of a generation from a status hub snapshot
+    
+    Args:
+        job_id (str): Job ID (may be None)
+        prompt_id (str): ComfyUI prompt ID
+        state (dict): Status hub snapshot, None if the prompt is not known yet
+    """
+    if state is None:
+        return {'status': 'queued', 'job_id': job_id, 'prompt_id': prompt_id, 'progress': 0}
+    
+    payload = {
+        'status': state['status'],
+        'job_id': job_id or state['meta'].get('job_id'),
+        'scene_id': state['meta'].get('scene_id'),
+        'prompt_id': prompt_id,
+        'node': state['node'],
+        'step': state['step'],
+        'max_steps': state['max_steps'],
+        'progress': state['progress']
+    }
+    if state['status'] == 'completed':
+        payload['images'] = [{
+            'url': f"/comfyui/view_image/{img['filename']}",
+            'filename': img['filename']
+        } for img in state['images']]
+        if job_id and payload['images']:
+            generation_jobs[job_id]['status'] = 'completed'
+            generation_jobs[job_id]['output_image'] = payload['images'][0]['url']
+    elif state['status'] in ('error', 'interrupted'):
+        payload['error'] = state['error'] or f"Generation {state['status']}"
+    return payload
+
+
 @comfyui_bp.route('/check_generation_status', methods=['GET'])
 def check_generation_status():
     """
     Check the status of a generation job
+    
+    Answered from the in-memory status hub: ComfyUI is not queried.
     """
     job_id = request.args.get('job_id')
     prompt_id = request.args.get('prompt_id')
@@ -707,76 +786,97 @@ def check_generation_status():
         return jsonify({'error': 'No job ID or prompt ID provided'}), 400
     
     try:
-        # If job ID is provided, get prompt ID from job
-        if job_id:
-            if job_id not in generation_jobs:
-                return jsonify({'error': f"Job {job_id} not found"}), 404
-            
-            job = generation_jobs[job_id]
-            prompt_id = job.get('prompt_id')
-            
-            # If job is already completed, return result
-            if job.get('status') == 'completed' and job.get('output_image'):
-                return jsonify({
-                    'status': 'completed',
-                    'job_id': job_id,
-                    'scene_id': job.get('scene_id'),
-                    'images': [{
-                        'url': job.get('output_image'),
-                        'filename': os.path.basename(job.get('output_image'))
-                    }]
-                })
-        
-        # Check status with ComfyUI
-        response = requests.get(f"http://{comfyui_host}:{comfyui_port}/history/{prompt_id}")
-        
-        if response.status_code != 200:
-            return jsonify({'error': f"ComfyUI returned status code {response.status_code}"}), 500
-        
-        history_data = response.json()
-        
-        # Check if generation is completed
-        if prompt_id in history_data and 'outputs' in history_data[prompt_id]:
-            outputs = history_data[prompt_id]['outputs']
-            
-            # Find image outputs
-            images = []
-            for node_id, output in outputs.items():
-                if 'images' in output:
-                    for img in output['images']:
-                        # Get image URL
-                        img_filename = img['filename']
-                        img_url = f"/comfyui/view_image/{img_filename}"
-                        
-                        # Save image URL to job
-                        if job_id:
-                            generation_jobs[job_id]['status'] = 'completed'
-                            generation_jobs[job_id]['output_image'] = img_url
-                        
-                        images.append({
-                            'url': img_url,
-                            'filename': img_filename
-                        })
-            
-            if images:
-                return jsonify({
-                    'status': 'completed',
-                    'job_id': job_id,
-                    'prompt_id': prompt_id,
-                    'images': images
-                })
-        
-        # If not completed, return running status
-        return jsonify({
-            'status': 'running',
-            'job_id': job_id,
-            'prompt_id': prompt_id
-        })
+        prompt_id = _resolve_prompt_id(job_id, prompt_id)
+    except KeyError:
+        return jsonify({'error': f"Job {job_id} not found"}), 404
+    
+    completed = _completed_job_payload(job_id)
+    if completed is not None:
+        return jsonify(completed)
+    
+    try:
+        return jsonify(_status_payload(job_id, prompt_id, status_hub.get_status(prompt_id)))
     except Exception as e:
         logger.error(f"Error checking generation status: {e}")
         return jsonify({'error': f"Error checking generation status: {str(e)}"}), 500
 
 
+@comfyui_bp.route('/generation_events', methods=['GET'])
+def generation_events():
+    """
+    Stream the progress of a generation as Server-Sent Events
+    
+    Each event carries the same payload as check_generation_status; the stream
+    ends once the generation is completed, failed or interrupted.
+    """
+    job_id = request.args.get('job_id')
+    prompt_id = request.args.get('prompt_id')
+    
+    if not job_id and not prompt_id:
+        return jsonify({'error': 'No job ID or prompt ID provided'}), 400
+    
+    try:
+        prompt_id = _resolve_prompt_id(job_id, prompt_id)
+    except KeyError:
+        return jsonify({'error': f"Job {job_id} not found"}), 404
+    
+    def event_stream():
+        completed = _completed_job_payload(job_id)
+        if completed is not None:
+            yield f"data: {json.dumps(completed)}\n\n"
+            return
+        subscriber = status_hub.subscribe(prompt_id)
+        try:
+            state = status_hub.get_status(prompt_id)
+            while True:
+                yield f"data: {json.dumps(_status_payload(job_id, prompt_id, state))}\n\n"
+                if state is not None and state['status'] in FINAL_STATUSES:
+                    break
+                try:
+                    state = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # Keep the connection open through proxies
+                    yield ": keep-alive\n\n"
+                    state = status_hub.get_status(prompt_id)
+        finally:
+            status_hub.unsubscribe(subscriber)
+    
+    return Response(stream_with_context(event_stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@comfyui_bp.route('/generation_preview', methods=['GET'])
+def generation_preview():
+    """
+    Stream the sampling previews of a generation as multipart/x-mixed-replace
+    
+    Usable as the source of an <img> tag; frames are sent at most
+    previews.stream_fps times per second and the stream ends with the generation.
+    """
+    job_id = request.args.get('job_id')
+    prompt_id = request.args.get('prompt_id')
+    
+    if not job_id and not prompt_id:
+        return jsonify({'error': 'No job ID or prompt ID provided'}), 400
+    
+    try:
+        prompt_id = _resolve_prompt_id(job_id, prompt_id)
+    except KeyError:
+        return jsonify({'error': f"Job {job_id} not found"}), 404
+    
+    fps = float((config.get('previews', {}) or {}).get('stream_fps', 2))
+    
+    def finished():
+        if _completed_job_payload(job_id) is not None:
+            return True
+        state = status_hub.get_status(prompt_id)
+        return state is not None and state['status'] in FINAL_STATUSES
+    
+    previews = status_hub.previews.stream(prompt_id, interval=1.0 / max(0.1, fps), is_finished=finished)
+    return Response(stream_with_context(mjpeg_chunks(previews)), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+
 @comfyui_bp.route('/view_image/<path:filename>')
 def view_image(filename):
     """
@@ -303,25 +303,8 @@ class MCPProtocol {
                 throw new Error(data.error || 'Failed to start generation');
             }
 
-            // Poll for generation status
-            const promptId = data.prompt_id;
-            let isCompleted = false;
-            let result = null;
-            
-            while (!isCompleted) {
-                // Wait for 1 second before checking status
-                await new Promise(resolve => setTimeout(resolve, 1000));
-                
-                const statusResponse = await fetch(`/comfyui/check_generation_status?prompt_id=${promptId}`);
-                const statusData = await statusResponse.json();
-                
-                if (statusData.status === 'completed') {
-                    isCompleted = true;
-                    result = statusData;
-                } else if (statusData.error) {
-                    throw new Error(statusData.error);
-                }
-            }
+            // Wait for the generation to finish (pushed by the server)
+            const result = await this.waitForGeneration(data.prompt_id);
 
             // Update scene with generated image
             if (result && result.images && result.images.length > 0) {
@@ -347,6 +330,71 @@ class MCPProtocol {
         }
     }
 
+    /**
+     * Wait for a generation to complete
+     * Uses the server-sent event stream, falling back to polling if it is unavailable
+     * @param {string} promptId - ComfyUI prompt ID
+     * @param {Function} progressCallback - Optional callback receiving each status update
+     * @returns {Promise} - Promise that resolves with the final status
+     */
+    waitForGeneration(promptId, progressCallback) {
+        if (typeof EventSource === 'undefined') {
+            return this.pollGeneration(promptId, progressCallback);
+        }
+
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(`/comfyui/generation_events?prompt_id=${promptId}`);
+            let received = false;
+
+            source.onmessage = (event) => {
+                received = true;
+                const statusData = JSON.parse(event.data);
+                if (progressCallback) {
+                    progressCallback(statusData);
+                }
+                if (statusData.status === 'completed') {
+                    source.close();
+                    resolve(statusData);
+                } else if (statusData.error) {
+                    source.close();
+                    reject(new Error(statusData.error));
+                }
+            };
+
+            source.onerror = () => {
+                if (!received) {
+                    // Stream not supported by the server: poll instead
+                    source.close();
+                    this.pollGeneration(promptId, progressCallback).then(resolve, reject);
+                }
+            };
+        });
+    }
+
+    /**
+     * Poll the generation status every second until it completes
+     * @param {string} promptId - ComfyUI prompt ID
+     * @param {Function} progressCallback - Optional callback receiving each status update
+     * @returns {Promise} - Promise that resolves with the final status
+     */
+    async pollGeneration(promptId, progressCallback) {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+
+            const statusResponse = await fetch(`/comfyui/check_generation_status?prompt_id=${promptId}`);
+            const statusData = await statusResponse.json();
+            if (progressCallback) {
+                progressCallback(statusData);
+            }
+
+            if (statusData.status === 'completed') {
+                return statusData;
+            } else if (statusData.error) {
+                throw new Error(statusData.error);
+            }
+        }
+    }
+
     /**
      * Generate all scenes sequentially
      * @returns {Promise} - Promise that resolves when all generations are complete
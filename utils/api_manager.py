@@ -3,15 +3,265 @@
 
 """
 Module de gestion centralisée des appels API externes.
+
+Chaque API peut avoir une politique (section "api_policies" de la config) :
+nombre maximum de requêtes simultanées, nombre de tentatives et délais de
+reprise. Les erreurs transitoires (429, 5xx, coupure réseau, timeout) sont
+retentées avec un backoff exponentiel aléatoire (full jitter) qui respecte
+l'en-tête Retry-After. La latence de chaque requête est mesurée (get_stats).
+
+Le débit de chaque API peut être limité par un seau à jetons (rate_limit :
+limit requêtes par period secondes, avec une rafale de burst requêtes).
+
+Options de résilience, par API :
+- circuit_breaker : après failure_threshold échecs transitoires consécutifs,
+  les appels échouent immédiatement (ou partent vers l'API de secours
+  "fallback") pendant reset_timeout secondes, puis un appel d'essai décide
+  de la réouverture.
+- hedge : si la réponse tarde au-delà du percentile de latence observé, une
+  seconde requête part (vers "fallback" s'il est défini, sinon la même API) ;
+  la première réponse valide est retenue, l'autre requête est annulée.
 """
 
 import asyncio
+import contextlib
+import email.utils
+import functools
 import logging
+import os
+import random
+import threading
 import time
+import weakref
+from collections import deque
+from datetime import datetime, timezone
+
 import aiohttp
 
 logger = logging.getLogger(__name__)
 
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+DEFAULT_POLICY = {
+    "max_concurrency": 4,     # Requêtes simultanées vers l'API
+    "max_retries": 3,         # Tentatives supplémentaires après un échec transitoire
+    "backoff_base": 1.0,      # Secondes, doublé à chaque tentative
+    "backoff_max": 30.0,      # Plafond du backoff exponentiel
+    "retry_after_max": 120.0  # Plafond appliqué à Retry-After
+}
+
+
+def parse_retry_after(value):
+    """
+    Convertit un en-tête Retry-After (secondes ou date HTTP) en secondes.
+
+    Returns:
+        float or None: Délai en secondes, None si l'en-tête est absent ou invalide
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class TokenBucket:
+    """
+    Seau à jetons partagé par toutes les boucles asyncio.
+
+    Chaque appel réserve un jeton sous verrou (le solde peut devenir négatif)
+    puis attend, hors verrou, que ce jeton soit produit. Les appels concurrents
+    sont ainsi servis dans l'ordre, au débit maximal autorisé, sans jamais le
+    dépasser.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Args:
+            rate (float): Jetons produits par seconde
+            burst (int): Capacité du seau (requêtes pouvant partir d'un coup)
+        """
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, rate_limit):
+        """Crée un seau depuis {"limit": 10, "period": 60, "burst": 10} (burst vaut limit par défaut)."""
+        limit = float(rate_limit["limit"])
+        period = float(rate_limit.get("period", 1.0))
+        return cls(limit / period, rate_limit.get("burst", limit))
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Réserve un jeton. Returns: float, délai d'attente en secondes avant de l'utiliser."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if wait:
+                self.waits += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def refund(self):
+        """Rend un jeton réservé mais inutilisé (attente annulée)."""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.refund()
+                raise
+        return wait
+
+    def get_stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"rate": self.rate, "burst": self.burst, "tokens": round(self.tokens, 3), "waits": self.waits,
+                    "total_wait": round(self.total_wait, 3), "max_wait": round(self.max_wait, 3)}
+
+
+class CircuitBreaker:
+    """Disjoncteur par API : closed (normal), open (échec immédiat), half_open (un appel d'essai)."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        Args:
+            failure_threshold (int): Échecs transitoires consécutifs avant ouverture
+            reset_timeout (float): Secondes en état ouvert avant un appel d'essai
+        """
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns: bool, True si un appel peut partir."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "closed":
+                return True
+            if self.state == "open" and now - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            # Un seul appel d'essai à la fois (un essai abandonné expire après reset_timeout)
+            if self.trial_started is not None and now - self.trial_started < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.trial_started = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("Circuit closed again after a successful trial call.")
+            self.state = "closed"
+            self.failures = 0
+            self.trial_started = None
+
+    def record_failure(self):
+        """Returns: bool, True si cet échec ouvre le circuit."""
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trial_started = None
+                self.times_opened += 1
+                return True
+            return False
+
+    def get_stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures,
+                    "times_opened": self.times_opened, "rejected": self.rejected}
+
+
+class ConcurrencyLimiter:
+    """Sémaphore utilisable depuis plusieurs boucles asyncio (Flask exécute chaque vue dans sa propre boucle)."""
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self._waiters = deque()  # (boucle, future)
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                still_waiting = waiter in self._waiters
+                if still_waiting:
+                    self._waiters.remove(waiter)
+            if not still_waiting:
+                # La place a été accordée pendant l'annulation : la rendre
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.active = max(0, self.active - 1)
+            while self._waiters and self.active < self.limit:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(_grant, future)
+                except RuntimeError:
+                    continue  # Boucle fermée
+                self.active += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
 class APIManager:
     """Gère les appels aux différentes API externes."""
 
@@ -24,37 +274,150 @@ class APIManager:
         """
         self.config = config
         self.api_keys = config.get("api_keys", {})
-        self.rate_limits = {}  # Ex: {"openai": {"limit": 10, "period": 60, "last_call": 0, "count": 0}}
-        self.session = None # aiohttp.ClientSession
+        self.policies = config.get("api_policies", {}) or {}
+        # URL de base par API : config["api_endpoints"], puis register_api(endpoint=...)
+        self.endpoints = {}
+        for name, endpoint in (config.get("api_endpoints", {}) or {}).items():
+            if endpoint:
+                self.endpoints[name] = endpoint.rstrip("/")
+        # Seaux à jetons par API, configurés par api_policies[nom]["rate_limit"] ou register_api
+        self.rate_limits = {}  # Ex: {"openai": TokenBucket(rate=10/60, burst=10)}
+        for name, policy in self.policies.items():
+            if (policy or {}).get("rate_limit"):
+                self.rate_limits[name] = TokenBucket.from_config(policy["rate_limit"])
+        self.session = None # aiohttp.ClientSession (la plus récente)
+        # Une session aiohttp est liée à sa boucle : une session par boucle
+        self._sessions = weakref.WeakKeyDictionary()
+        self._limiters = {}
+        self._breakers = {}
+        self._stats = {}
+        self._stats_lock = threading.Lock()
 
     async def _get_session(self):
-        """Crée ou retourne la session aiohttp."""
-        if self.session is None or self.session.closed:
-            self.session = aiohttp.ClientSession()
-        return self.session
+        """Crée ou retourne la session aiohttp de la boucle courante."""
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession()
+            self._sessions[loop] = session
+        self.session = session
+        return session
+
+    def _policy(self, api_name):
+        """Politique de l'API : valeurs par défaut complétées par config["api_policies"][api_name]."""
+        return {**DEFAULT_POLICY, **(self.policies.get(api_name) or {})}
+
+    def _limiter(self, api_name):
+        with self._stats_lock:
+            limiter = self._limiters.get(api_name)
+            if limiter is None:
+                limiter = ConcurrencyLimiter(self._policy(api_name)["max_concurrency"])
+                self._limiters[api_name] = limiter
+            return limiter
+
+    def _breaker(self, api_name):
+        """Disjoncteur de l'API, None si la politique n'en définit pas."""
+        settings = self._policy(api_name).get("circuit_breaker")
+        if not settings:
+            return None
+        with self._stats_lock:
+            breaker = self._breakers.get(api_name)
+            if breaker is None:
+                breaker = CircuitBreaker(**settings)
+                self._breakers[api_name] = breaker
+            return breaker
+
+    def _breaker_allows(self, api_name):
+        breaker = self._breaker(api_name)
+        if breaker is None or breaker.allow():
+            return True
+        self._count(api_name, "rejected")
+        return False
+
+    def _report_health(self, api_name, healthy):
+        """Informe le disjoncteur de l'API du résultat d'une tentative (réponse obtenue ou échec transitoire)."""
+        breaker = self._breaker(api_name)
+        if breaker is None:
+            return
+        if healthy:
+            breaker.record_success()
+        elif breaker.record_failure():
+            logger.warning(f"Circuit opened for API '{api_name}': failing fast for {breaker.reset_timeout:g}s.")
+
+    def _retry_delay(self, policy, attempt, retry_after=None):
+        """Délai avant la tentative suivante : Retry-After s'il est fourni, sinon backoff exponentiel à full jitter."""
+        if retry_after is not None:
+            # Un léger aléa évite que toutes les requêtes limitées repartent ensemble
+            return min(retry_after, policy["retry_after_max"]) + random.uniform(0, policy["backoff_base"])
+        return random.uniform(0, min(policy["backoff_max"], policy["backoff_base"] * (2 ** attempt)))
+
+    def _api_stats(self, api_name):
+        """Compteurs de l'API. L'appelant détient _stats_lock."""
+        return self._stats.setdefault(api_name, {"requests": 0, "success": 0, "error": 0, "retry": 0,
+                                                 "rejected": 0, "hedged": 0, "hedge_won": 0,
+                                                 "latencies": deque(maxlen=500)})
+
+    def _record(self, api_name, latency=None, outcome="success"):
+        """Enregistre une requête (outcome: success, error, retry)."""
+        with self._stats_lock:
+            stats = self._api_stats(api_name)
+            stats["requests"] += 1
+            stats[outcome] += 1
+            if latency is not None:
+                stats["latencies"].append(latency)
+
+    def _count(self, api_name, counter):
+        """Incrémente un compteur sans requête associée (rejected, hedged, hedge_won)."""
+        with self._stats_lock:
+            self._api_stats(api_name)[counter] += 1
+
+    def latency_percentile(self, api_name, percentile):
+        """
+        Percentile des latences récentes d'une API.
+
+        Args:
+            api_name (str): Nom de l'API
+            percentile (float): Entre 0 et 100
+
+        Returns:
+            float or None: Latence en secondes, None sans mesure
+        """
+        with self._stats_lock:
+            latencies = sorted(self._stats.get(api_name, {}).get("latencies", []))
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(percentile / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def get_stats(self):
+        """Statistiques par API : requêtes, succès, erreurs, reprises, latences (s) et file d'attente."""
+        with self._stats_lock:
+            names = list(self._stats)
+            snapshot = {name: {k: v for k, v in stats.items() if k != "latencies"} for name, stats in self._stats.items()}
+        for name in names:
+            with self._stats_lock:
+                latencies = list(self._stats[name]["latencies"])
+            limiter = self._limiters.get(name)
+            bucket = self.rate_limits.get(name)
+            breaker = self._breakers.get(name)
+            snapshot[name].update({
+                "rate_limit": bucket.get_stats() if bucket else None,
+                "circuit": breaker.get_stats() if breaker else None,
+                "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+                "latency_p50": self.latency_percentile(name, 50),
+                "latency_p95": self.latency_percentile(name, 95),
+                "in_flight": limiter.active if limiter else 0,
+                "waiting": limiter.waiting if limiter else 0,
+            })
+        return snapshot
 
     async def _rate_limit(self, api_name):
-        """Applique un rate limiting simple."""
-        if api_name in self.rate_limits:
-            limit_info = self.rate_limits[api_name]
-            now = time.time()
-            elapsed = now - limit_info.get("last_call", 0)
-
-            if elapsed < limit_info["period"]:
-                if limit_info.get("count", 0) >= limit_info["limit"]:
-                    wait_time = limit_info["period"] - elapsed
-                    logger.warning(f"Rate limit reached for {api_name}. Waiting {wait_time:.2f} seconds.")
-                    await asyncio.sleep(wait_time)
-                    limit_info["count"] = 0 # Reset count after waiting
-                    limit_info["last_call"] = time.time() # Update last_call after waiting
-                else:
-                     limit_info["count"] = limit_info.get("count", 0) + 1
-            else:
-                # Reset count if period has passed
-                limit_info["count"] = 1
-                limit_info["last_call"] = now
-        # Update the rate limit info, adding api if not exists
-        self.rate_limits[api_name] = limit_info if api_name in self.rate_limits else {"last_call": time.time(), "count": 1}
+        """Attend un jeton du seau de l'API (sans limite configurée, passe immédiatement)."""
+        bucket = self.rate_limits.get(api_name)
+        if bucket is not None:
+            wait = await bucket.acquire()
+            if wait > 1:
+                logger.info(f"Rate limit for {api_name}: waited {wait:.2f} seconds.")
 
 
     def register_api(self, name, api_key=None, endpoint=None, rate_limit=None):
@@ -66,38 +429,107 @@ class APIManager:
             api_key (str, optional): Clé API. Si None, essaie de la récupérer depuis la config.
             endpoint (str, optional): URL de base de l'API.
             rate_limit (dict, optional): Dictionnaire de configuration du rate limiting
-                                         (ex: {"limit": 10, "period": 60}).
+                                         (ex: {"limit": 10, "period": 60, "burst": 5}).
         """
         if api_key:
             self.api_keys[name] = api_key
         elif name not in self.api_keys:
              self.api_keys[name] = self.config.get("api_keys", {}).get(name)
 
-        # TODO: Store endpoint if provided
+        if endpoint:
+            self.endpoints[name] = endpoint.rstrip("/")
 
         if rate_limit:
-            self.rate_limits[name] = rate_limit
-            self.rate_limits[name]["last_call"] = 0
-            self.rate_limits[name]["count"] = 0
+            self.rate_limits[name] = TokenBucket.from_config(rate_limit)
         logger.info(f"API '{name}' registered.")
 
 
-    async def call_api(self, api_name, method="POST", endpoint_suffix="", data=None, headers=None, params=None, timeout=30):
+    async def call_api(self, api_name, method="POST", endpoint_suffix="", data=None, headers=None, params=None, timeout=30,
+                       files=None, max_retries=None):
         """
         Effectue un appel à une API enregistrée.
 
+        Les erreurs transitoires sont retentées selon la politique de l'API, et le
+        nombre de requêtes simultanées vers une même API est limité.
+
         Args:
             api_name (str): Nom de l'API à appeler.
             method (str): Méthode HTTP (GET, POST, etc.).
             endpoint_suffix (str): Suffixe à ajouter à l'URL de base de l'API.
             data (dict, optional): Données à envoyer dans le corps de la requête (pour POST/PUT).
+                                   Champs du formulaire si files est fourni.
             headers (dict, optional): En-têtes HTTP supplémentaires.
             params (dict, optional): Paramètres d'URL (pour GET).
             timeout (int): Délai d'attente pour la requête en secondes.
+            files (dict, optional): Fichiers envoyés en multipart/form-data, {champ: chemin} ou
+                                    {champ: (chemin, content_type)}. Lus en flux depuis le disque.
+            max_retries (int, optional): Remplace le nombre de tentatives de la politique.
 
         Returns:
             dict or None: La réponse JSON de l'API ou None en cas d'erreur.
         """
+        policy = self._policy(api_name)
+        fallback = policy.get("fallback")
+        call = functools.partial(self._call_with_retries, method=method, endpoint_suffix=endpoint_suffix, data=data,
+                                 params=params, timeout=timeout, files=files, max_retries=max_retries)
+        # L'API de secours utilise sa propre clé
+        fallback_headers = {k: v for k, v in (headers or {}).items() if k.lower() != "authorization"}
+
+        if not self._breaker_allows(api_name):
+            if fallback and self._breaker_allows(fallback):
+                logger.warning(f"Circuit open for API '{api_name}', using fallback '{fallback}'.")
+                return await call(fallback, headers=fallback_headers)
+            logger.error(f"Circuit open for API '{api_name}': call rejected.")
+            return None
+
+        hedge_delay = self._hedge_delay(api_name, policy.get("hedge"))
+        if hedge_delay is None:
+            return await call(api_name, headers=headers)
+        return await self._hedged(api_name, call, headers, fallback, fallback_headers, hedge_delay)
+
+    def _hedge_delay(self, api_name, hedge):
+        """Délai avant la requête de couverture, None si elle n'est pas configurée ou trop peu de mesures."""
+        if not hedge:
+            return None
+        with self._stats_lock:
+            samples = len(self._stats.get(api_name, {}).get("latencies", []))
+        if samples < hedge.get("min_samples", 20):
+            return None
+        return max(float(hedge.get("min_delay", 1.0)), self.latency_percentile(api_name, hedge.get("percentile", 95)))
+
+    async def _hedged(self, api_name, call, headers, fallback, fallback_headers, delay):
+        """Lance l'appel, puis une requête de couverture s'il n'a pas répondu après delay secondes."""
+        primary = asyncio.ensure_future(call(api_name, headers=headers))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if primary in done:
+                return primary.result()
+            hedge_name, hedge_headers = (fallback, fallback_headers) if fallback else (api_name, headers)
+            if not self._breaker_allows(hedge_name):
+                return await primary
+            self._count(api_name, "hedged")
+            logger.info(f"API '{api_name}' slower than {delay:.1f}s, hedging with '{hedge_name}'.")
+            secondary = asyncio.ensure_future(call(hedge_name, headers=hedge_headers))
+            pending = {primary, secondary}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result is not None:
+                        if task is secondary:
+                            self._count(api_name, "hedge_won")
+                        return result
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _call_with_retries(self, api_name, method, endpoint_suffix, data, headers, params, timeout, files,
+                                 max_retries):
+        """Appel d'une API avec reprises, limite de concurrence et seau à jetons (voir call_api)."""
         if api_name not in self.api_keys:
              # Try to register from config if not explicitly registered
             self.register_api(api_name)
@@ -105,8 +537,9 @@ class APIManager:
                  logger.error(f"API '{api_name}' not configured or missing API key.")
                  return None
 
-        # TODO: Get base endpoint for the api_name
-        base_url = self.config.get("api_endpoints", {}).get(api_name, "") # Placeholder
+        base_url = self.endpoints.get(api_name, "")
+        if not base_url:
+            logger.warning(f"No endpoint registered for API '{api_name}'.")
         full_url = f"{base_url}{endpoint_suffix}"
 
         # Prepare headers
@@ -114,46 +547,102 @@ class APIManager:
         if headers:
             request_headers.update(headers)
 
-        # Apply rate limiting
-        await self._rate_limit(api_name)
-
+        policy = self._policy(api_name)
+        if max_retries is None:
+            max_retries = int(policy["max_retries"])
+        limiter = self._limiter(api_name)
         session = await self._get_session()
-        logger.debug(f"Calling {method} {full_url}")
-        try:
-            async with session.request(
-                method,
-                full_url,
-                json=data,
-                headers=request_headers,
-                params=params,
-                timeout=aiohttp.ClientTimeout(total=timeout)
-            ) as response:
-                response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-                logger.debug(f"API '{api_name}' call successful (Status: {response.status})")
-                # Handle different content types if necessary
-                if 'application/json' in response.headers.get('Content-Type', ''):
-                    return await response.json()
-                else:
-                    return await response.read() # Return raw bytes for images/other data
-        except aiohttp.ClientResponseError as e:
-             logger.error(f"API Error for '{api_name}': {e.status} - {e.message} - URL: {full_url}")
-             try:
-                 error_details = await e.response.text()
-                 logger.error(f"Error details: {error_details[:500]}") # Log first 500 chars
-             except Exception:
-                 pass # Ignore if reading response fails
-             return None
-        except asyncio.TimeoutError:
-            logger.error(f"API call to '{api_name}' timed out after {timeout} seconds. URL: {full_url}")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error calling API '{api_name}': {e}. URL: {full_url}")
-            return None
+
+        for attempt in range(max_retries + 1):
+            # Apply rate limiting
+            await self._rate_limit(api_name)
+
+            retry_after = None
+            async with limiter.slot():
+                logger.debug(f"Calling {method} {full_url} (attempt {attempt + 1})")
+                started = time.perf_counter()
+                try:
+                    with contextlib.ExitStack() as open_files:
+                        body = self._multipart(files, data, open_files) if files else None
+                        async with session.request(
+                            method,
+                            full_url,
+                            json=None if files else data,
+                            data=body,
+                            headers=request_headers,
+                            params=params,
+                            timeout=aiohttp.ClientTimeout(total=timeout)
+                        ) as response:
+                            self._report_health(api_name, response.status not in RETRY_STATUSES)
+                            if response.status in RETRY_STATUSES and attempt < max_retries:
+                                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                                self._record(api_name, time.perf_counter() - started, "retry")
+                                logger.warning(f"API '{api_name}' returned {response.status}, retrying "
+                                               f"({attempt + 1}/{max_retries})")
+                            else:
+                                response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+                                # Handle different content types if necessary
+                                if 'application/json' in response.headers.get('Content-Type', ''):
+                                    result = await response.json()
+                                else:
+                                    result = await response.read() # Return raw bytes for images/other data
+                                self._record(api_name, time.perf_counter() - started, "success")
+                                logger.debug(f"API '{api_name}' call successful (Status: {response.status})")
+                                return result
+                except aiohttp.ClientResponseError as e:
+                    self._record(api_name, time.perf_counter() - started, "error")
+                    logger.error(f"API Error for '{api_name}': {e.status} - {e.message} - URL: {full_url}")
+                    return None
+                except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                    self._report_health(api_name, False)
+                    if attempt >= max_retries:
+                        self._record(api_name, time.perf_counter() - started, "error")
+                        logger.error(f"API call to '{api_name}' failed after {attempt + 1} attempts "
+                                     f"({type(e).__name__}: {e}). URL: {full_url}")
+                        return None
+                    self._record(api_name, time.perf_counter() - started, "retry")
+                    logger.warning(f"API call to '{api_name}' failed ({type(e).__name__}), retrying "
+                                   f"({attempt + 1}/{max_retries})")
+                except Exception as e:
+                    self._record(api_name, time.perf_counter() - started, "error")
+                    logger.error(f"Unexpected error calling API '{api_name}': {e}. URL: {full_url}")
+                    return None
+
+            # Attendre hors du limiteur : les autres requêtes peuvent partir pendant le backoff
+            await asyncio.sleep(self._retry_delay(policy, attempt, retry_after))
+            if not self._breaker_allows(api_name):
+                logger.error(f"Circuit open for API '{api_name}': giving up retries.")
+                return None
+        return None
+
+    @staticmethod
+    def _multipart(files, fields, open_files):
+        """
+        Construit un corps multipart/form-data dont les fichiers sont lus en flux.
+
+        Args:
+            files (dict): {champ: chemin} ou {champ: (chemin, content_type)}
+            fields (dict, optional): Champs texte
+            open_files (contextlib.ExitStack): Ferme les fichiers après la requête
+
+        Returns:
+            aiohttp.FormData: Corps de la requête
+        """
+        form = aiohttp.FormData()
+        for name, value in (fields or {}).items():
+            if value is not None:
+                form.add_field(name, str(value))
+        for name, spec in files.items():
+            path, content_type = spec if isinstance(spec, tuple) else (spec, "application/octet-stream")
+            form.add_field(name, open_files.enter_context(open(path, "rb")), filename=os.path.basename(str(path)),
+                           content_type=content_type)
+        return form
 
     async def close_session(self):
-        """Ferme la session aiohttp."""
-        if self.session and not self.session.closed:
-            await self.session.close()
+        """Ferme la session aiohttp de la boucle courante."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None) or self.session
+        if session and not session.closed:
+            await session.close()
             logger.info("API Manager session closed.")
 
 # Example Usage (optional, for testing)
@@ -21,6 +21,11 @@ from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Points d'accès des modèles de texte (partagés avec generation/prompt_enricher.py)
+OLLAMA_URL = "http://localhost:11434"
+QWEN_MODEL = "qwen2:1.5b"
+GEMINI_GENERATE_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
+
 
 class ExternalModelsManager:
     """Gestionnaire des modèles externes pour le projet Madsea"""
@@ -76,7 +81,7 @@ class ExternalModelsManager:
                 return
             
             # Vérifier si le modèle Qwen est déjà installé
-            if "qwen2:1.5b" in result.stdout:
+            if QWEN_MODEL in result.stdout:
                 logger.info("Modèle Qwen 2.1 déjà installé dans Ollama")
                 self.models_status["qwen"] = {
                     "status": "available",
@@ -125,7 +130,7 @@ class ExternalModelsManager:
             }
             
             response = requests.post(
-                "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent",
+                GEMINI_GENERATE_URL,
                 headers=headers,
                 json=data
             )
@@ -195,7 +200,7 @@ class ExternalModelsManager:
                 }
             
             # Vérifier si le modèle est déjà installé
-            if "qwen2:1.5b" in result.stdout:
+            if QWEN_MODEL in result.stdout:
                 logger.info("Modèle Qwen 2.1 déjà installé")
                 self.models_status["qwen"] = {
                     "status": "available",
@@ -206,7 +211,7 @@ class ExternalModelsManager:
             # Installer le modèle
             logger.info("Téléchargement et installation du modèle Qwen 2.1...")
             install_result = subprocess.run(
-                ["ollama", "pull", "qwen2:1.5b"],
+                ["ollama", "pull", QWEN_MODEL],
                 capture_output=True,
                 text=True
             )
@@ -259,7 +264,7 @@ class ExternalModelsManager:
             }
             
             response = requests.post(
-                "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent",
+                GEMINI_GENERATE_URL,
                 headers=headers,
                 json=data
             )
@@ -327,7 +332,7 @@ class ExternalModelsManager:
         try:
             # Préparer la requête pour Ollama
             data = {
-                "model": "qwen2:1.5b",
+                "model": QWEN_MODEL,
                 "prompt": prompt,
                 "stream": False,
                 "options": {
@@ -337,7 +342,7 @@ class ExternalModelsManager:
             
             # Envoyer la requête
             response = requests.post(
-                "http://localhost:11434/api/generate",
+                f"{OLLAMA_URL}/api/generate",
                 json=data
             )
             
@@ -377,7 +382,7 @@ class ExternalModelsManager:
             
             # Envoyer la requête
             response = requests.post(
-                "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent",
+                GEMINI_GENERATE_URL,
                 headers=headers,
                 json=data
             )